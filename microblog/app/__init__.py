@@ -1,68 +1,117 @@
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import os
-from flask import Flask, request
+import click
+from flask import Flask, request, current_app
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel
+from app.database import Database
 
-# name variable is a Python prededined variable set to the name of the module in which it is used
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app) # database
-migrate = Migrate(app, db) # migration engine
-login = LoginManager(app)
+# the extensions are created without an application and bound to each application that create_app makes with init_app
+# this way nothing is set up at import time, and tests (or a pre-fork server) can create applications with a configuration of their own
+# Database is Flask-SQLAlchemy with the engine settings and read replicas of config.py (see app/database.py)
+db = Database() # database
+login = LoginManager()
 # to be able to give certain pages that he user must login to see, Flask-Login needs to know what the view function is that handles logins - pass the login page to login.login_view
-login.login_view = 'login'
-mail = Mail(app)
+# the view is in the main blueprint, so its endpoint is prefixed with the name of the blueprint
+login.login_view = 'main.login'
+mail = Mail()
 # bootstrap is the flask_bootstap extension that gives a ready to use base template
 # flask is also fully compatible with CSS classes and bootstrap.min.js etc.
-bootstap = Bootstrap(app)
+bootstrap = Bootstrap()
 # moment is calling flask_moment which is a python wrapper around moment.js
-moment = Moment(app)
+moment = Moment()
 #babel is used for enabling translation services easily
-babel = Babel(app)
-
-# routes module is imported below as it imports from the app variable assigned above
-from app import routes, models, errors
-# routes are different URLs that the application implements
-# models will define the structure of the database
-
-
-if not app.debug:
-    if app.config['MAIL_SERVER']:
-        auth = None
-        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-        secure = None
-        if app.config['MAIL_USE_TLS']:
-            secure = ()
-        mail_handler = SMTPHandler(
-            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-            toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-            credentials=auth, secure=secure)
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
-
-    # keep a log file
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    # RotatingGileHandler keeps logs up to a maximum amout and the last backupCount number of logs
-    file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240,
-                                       backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('Microblog startup')
+babel = Babel()
+
+
+def create_app(config_class=Config):
+    '''
+    Application factory: builds an application configured from config_class, with the extensions, blueprints and commands registered on it
+    Subsystems that keep state of their own (caches, the mail queue, ...) are only set up when they are first used, so creating an application stays cheap
+    '''
+    # name variable is a Python prededined variable set to the name of the module in which it is used
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+
+    db.init_app(app)
+    login.init_app(app)
+    mail.init_app(app)
+    bootstrap.init_app(app)
+    moment.init_app(app)
+    babel.init_app(app)
+    # the migration engine is only needed by the flask db commands, and importing it pulls in the whole of Alembic, so it is only set up when the app is loaded by the flask command
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+    # the blueprints are imported here rather than at the top, as they import the extensions above from this module
+    # routes are the different URLs that the application implements, errors the pages shown when something goes wrong
+    from app.errors import bp as errors_bp
+    app.register_blueprint(errors_bp)
+    from app.routes import bp as main_bp
+    app.register_blueprint(main_bp)
+    # api serves the feeds as JSON, under the version number and under /api for the current version (url_for builds the versioned URLs, which are registered first)
+    from app import api
+    app.register_blueprint(api.bp, url_prefix='/api/v{}'.format(api.VERSION))
+    app.register_blueprint(api.bp, url_prefix='/api')
+
+    # cli adds the maintenance commands to the flask command
+    from app import cli
+    cli.register(app)
+    # fragments caches the rendered HTML of posts for the feed templates
+    from app.fragments import fragment_cache
+    fragment_cache.init_app(app)
+    # search keeps the full-text index of posts up to date
+    from app.search import search
+    search.init_app(app)
+    # metrics times the SQL, templates and total latency of every request and serves the numbers at /metrics
+    from app import metrics
+    metrics.init_app(app)
+    # the mail queue, the last_seen tracker and the trending and archive jobs work outside of requests, so they keep the application to get a context from
+    from app.email import mail_queue, MailQueueHandler
+    mail_queue.init_app(app)
+    from app.last_seen import tracker, flush_job
+    tracker.init_app(app)
+    flush_job.init_app(app)
+    # the trending job ranks recent posts in the background for /explore?mode=trending
+    from app.trending import trending_job
+    trending_job.init_app(app)
+    # the archive job moves old posts out of the post table (see app/archive.py)
+    from app.archive import archive_job
+    archive_job.init_app(app)
+
+    # every request gets an id that its log records carry (see app/logs.py)
+    from app.logs import log_pipeline, RateLimitFilter
+    log_pipeline.init_app(app)
+
+    if not app.debug and not app.testing:
+        if app.config['MAIL_SERVER']:
+            # errors are emailed to the admins through the mail queue (see app/email.py), so the request that logs the error doesn't wait for the SMTP server
+            # the server, port, credentials and TLS setting are the MAIL_* settings that Flask-Mail already uses
+            mail_handler = MailQueueHandler(
+                mail_queue, fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+                toaddrs=app.config['ADMINS'], subject='Microblog Failure')
+            mail_handler.setLevel(logging.ERROR)
+            # the same error logged by every request for a while shouldn't turn into as many emails
+            mail_handler.addFilter(RateLimitFilter(app.config['LOG_RATE_LIMIT'],
+                                                   app.config['LOG_RATE_WINDOW']))
+            app.logger.addHandler(mail_handler)
+
+        # keep a log file, written by a background thread so that requests only put their records on a queue
+        log_pipeline.start()
+
+        app.logger.setLevel(logging.INFO)
+        app.logger.info('Microblog startup')
+
+    # the compiled templates are cached in files shared by the workers, and with TEMPLATE_WARMUP all of them are loaded here rather than by the first requests (see app/template_cache.py)
+    from app import template_cache
+    template_cache.init_app(app)
+
+    return app
+
 
 @babel.localeselector
 def get_locale():
@@ -72,4 +121,8 @@ def get_locale():
 
     The use of this function is not yet implemented, please see: https://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-xiii-i18n-and-l10n
     '''
-    return request.accept_languages.best_match(app.config['LANGUAGES'])
+    return request.accept_languages.best_match(current_app.config['LANGUAGES'])
+
+
+# models will define the structure of the database, they are imported here so that the tables are known to db as soon as the package is
+from app import models
@@ -0,0 +1,140 @@
+from functools import wraps
+from flask import Blueprint, jsonify, request, url_for, current_app
+from flask_login import current_user
+from werkzeug.http import HTTP_STATUS_CODES
+from app import db
+from app.models import User, Post, ArchivedPost
+from app.feeds import home_feed, explore_feed, user_feed, explore_archive, user_archive
+from app.pagination import Key, fetch_posts, find_key
+
+# JSON API for reading the feeds, e.g. for clients that poll for new posts instead of reloading whole pages
+# create_app registers the blueprint under /api/v1, and under /api for whichever version is the current one, so a client can pin the version it was written for
+# requests are authenticated by the same session cookie as the pages
+#
+# every feed is read in pages of newest first posts:
+#   ?max_id=<id>    posts older than post <id>, to scroll back through the feed
+#   ?since_id=<id>  posts newer than post <id>, to pick up what was posted since the client's newest post
+#   ?count=<n>      number of posts to return
+# posts are compared by (timestame, id), the order the feeds are in, so that the (timestame, id) indexes on post do the work
+# the archived posts (see app/archive.py) follow on from the recent ones, a post keeps its id when it is archived so the ids a client has stay valid
+# the response links to the next request in either direction and lists each author only once, however many of their posts are on the page
+
+VERSION = 1
+
+bp = Blueprint('api', __name__)
+
+
+class APIError(Exception):
+    'raised by the views of this blueprint, answered with a JSON error'
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+@bp.errorhandler(APIError)
+def error_response(error):
+    payload = {'error': HTTP_STATUS_CODES.get(error.status, 'Unknown error')}
+    if error.message:
+        payload['message'] = error.message
+    response = jsonify(payload)
+    response.status_code = error.status
+    return response
+
+
+def login_required(view):
+    'like flask_login.login_required, but answers with a 401 error instead of redirecting to the login page'
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise APIError(401, 'Log in to use the API.')
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def post_key(name, partitions):
+    '''
+    The Key of the post whose id is in the name argument, in the feed made of partitions, None if the argument was not given
+    A post that isn't in the feed (e.g. one of a user the client has unfollowed since) is still a point in time: it is placed at the first partition for max_id and at the last one for since_id, and fetch_posts bounds every partition it reads by it
+    '''
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        id = int(value)
+    except ValueError:
+        raise APIError(400, '{} must be a post id.'.format(name))
+    key = find_key(partitions, id)
+    if key is not None:
+        return key
+    for model in (Post, ArchivedPost):
+        key = db.session.query(model.timestame, model.id).filter(model.id == id).first()
+        if key is not None:
+            return Key(key.timestame, key.id, len(partitions) - 1 if name == 'since_id' else 0)
+    raise APIError(400, '{} {} is not a post.'.format(name, id))
+
+
+def user_dict(user):
+    return {'id': user.id, 'username': user.username, 'avatar': user.avatar(70)}
+
+
+def post_dict(post):
+    return {'id': post.id, 'body': post.body, 'timestamp': post.timestame.isoformat() + 'Z',
+            'author_id': post.user_id}
+
+
+def feed_response(partitions, endpoint, **values):
+    'the page of the feed made of partitions (see fetch_posts in app/pagination.py) asked for by since_id, max_id and count, as a JSON response'
+    count = request.args.get('count', current_app.config['API_POSTS_PER_PAGE'], type=int)
+    count = max(1, min(count, current_app.config['API_MAX_POSTS_PER_PAGE']))
+    since, until = post_key('since_id', partitions), post_key('max_id', partitions)
+    # the posts right after since_id are returned first, so a client that is far behind catches up one page at a time without skipping any posts
+    # one row more than asked for tells whether there are more posts in this direction
+    posts = [post for partition, post in fetch_posts(
+        partitions, count + 1, older=until, newer=since)]
+    has_more = len(posts) > count
+    posts = posts[:count]
+    if since is not None:
+        posts.reverse()
+
+    links = {}
+    # the client polls this link for new posts, it stays the same as long as nothing new comes in
+    newest_id = posts[0].id if posts else since and since.id
+    links['newer'] = url_for(endpoint, since_id=newest_id, count=count, **values) \
+        if newest_id is not None else url_for(endpoint, count=count, **values)
+    if posts and (since is not None or has_more):
+        links['older'] = url_for(endpoint, max_id=posts[-1].id, count=count, **values)
+    authors = {}
+    for post in posts:
+        authors.setdefault(post.author.id, post.author)
+    return jsonify({'version': VERSION,
+                    'posts': [post_dict(post) for post in posts],
+                    'users': [user_dict(user) for user in authors.values()],
+                    'has_more': has_more,
+                    '_links': links})
+
+
+@bp.route('/timeline')
+@login_required
+def timeline():
+    'the home timeline of the logged in user'
+    return feed_response(home_feed(current_user), 'api.timeline')
+
+
+@bp.route('/users/<username>/posts')
+@login_required
+@db.read_only
+def user_posts(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise APIError(404, 'There is no user {}.'.format(username))
+    return feed_response([user_feed(user), user_archive(user)], 'api.user_posts',
+                         username=username)
+
+
+@bp.route('/explore')
+@login_required
+@db.read_only
+def explore():
+    return feed_response([explore_feed(), explore_archive()], 'api.explore')
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, and_, or_
+from flask import current_app
+from app import db
+from app.models import Post, ArchivedPost, Timeline, TrendingPost
+from app.jobs import PeriodicJob
+
+# nearly every page view reads the posts of the last few weeks, but the post table and its indexes hold the whole history
+# posts older than ARCHIVE_AFTER_DAYS are moved to the post_archive table by a background job, so the post table and its indexes stay the size of the recent posts
+# the feeds read the recent posts first and only go on to the archive once a page gets past the last of them (see fetch_posts in app/pagination.py), search, the API and exports see both tables
+# the archive is a table in the same database rather than a second ATTACHed database file, so a move is a single transaction of the one database and works on databases other than SQLite
+
+
+def cutoff(now=None, days=None):
+    '''
+    Posts older than this are moved, days (ARCHIVE_AFTER_DAYS by default) before now, None when there are no posts
+    The post with the highest id is never moved: SQLite gives new posts the highest id in the table plus one, so an emptied table would hand out ids that archived posts have already. Since the cutoff is never after that post, every archived post stays older than every post left in the table
+    '''
+    now = now or datetime.utcnow()
+    days = current_app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    last = db.session.query(Post.timestame).order_by(Post.id.desc()).first()
+    if last is None:
+        return None
+    return min(now - timedelta(days=days), last.timestame)
+
+
+def archive_posts(now=None, days=None, batch_size=None):
+    '''
+    Moves the posts older than days (ARCHIVE_AFTER_DAYS by default) to the archive, oldest first, and returns the number moved
+    Each batch of ARCHIVE_BATCH_SIZE posts is moved and committed in a transaction of its own, so the lock on the database is only held for a short while and a failure only loses the batch it happened in
+    '''
+    batch_size = batch_size or current_app.config['ARCHIVE_BATCH_SIZE']
+    before = cutoff(now, days)
+    if before is None:
+        return 0
+    post = Post.__table__
+    moved = 0
+    while True:
+        # the last post of the batch, which bounds the batch by (timestame, id) so that every statement below reads the same posts through the (timestame, id) index
+        last = db.session.query(Post.timestame, Post.id).filter(
+            Post.timestame < before).order_by(Post.timestame, Post.id).offset(
+                batch_size - 1).first()
+        batch = post.c.timestame < before
+        if last is not None:
+            batch = and_(batch, or_(post.c.timestame < last.timestame, and_(
+                post.c.timestame == last.timestame, post.c.id <= last.id)))
+        ids = select([post.c.id]).where(batch)
+        count = db.session.execute(ArchivedPost.__table__.insert().from_select(
+            ['id', 'body', 'timestame', 'user_id'],
+            select([post.c.id, post.c.body, post.c.timestame, post.c.user_id]).where(batch))).rowcount
+        if count:
+            # the timelines only keep recent posts, and the trending snapshot only ranks them, so the rows pointing at the moved posts go
+            # the search index keeps its rows, archived posts can still be found (see app/search.py)
+            db.session.execute(Timeline.__table__.delete().where(Timeline.post_id.in_(ids)))
+            db.session.execute(TrendingPost.__table__.delete().where(TrendingPost.post_id.in_(ids)))
+            db.session.execute(post.delete().where(batch))
+        db.session.commit()
+        moved += count
+        if last is None or not count:
+            return moved
+
+
+def partition_sizes():
+    'the number of posts in the post table and in the archive, with the times of the oldest and the newest post of each'
+    sizes = []
+    for model in (Post, ArchivedPost):
+        count, oldest, newest = db.session.query(
+            db.func.count(), db.func.min(model.timestame), db.func.max(model.timestame)).one()
+        sizes.append({'table': model.__tablename__, 'posts': count,
+                      'oldest': oldest, 'newest': newest})
+    return sizes
+
+
+class ArchiveJob(PeriodicJob):
+    '''
+    Moves old posts to the archive every ARCHIVE_INTERVAL seconds (0, the default, leaves the thread off, e.g. to run flask archive run from cron instead)
+    When the jobs of several workers run at the same time, the database lets one write at a time and the others find nothing left to move
+    '''
+
+    name = 'archive'
+    interval_setting = 'ARCHIVE_INTERVAL'
+    done_message = '%s: moved %d posts in %.1f ms'
+
+    def task(self):
+        return archive_posts()
+
+
+archive_job = ArchiveJob()
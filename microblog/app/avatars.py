@@ -0,0 +1,134 @@
+import os
+import struct
+import tempfile
+import zlib
+from flask import current_app, url_for
+
+# avatars made by the site itself instead of fetched by every visitor from Gravatar: an identicon, a symmetric 5 x 5 pattern in a colour, both taken from the MD5 digest of the email
+# each image is drawn once per digest and size and kept in AVATAR_CACHE_DIR, and served with headers that let browsers keep it for a year
+# the picture only depends on the digest, the size and the drawing code, and all three are in the URL (VERSION for the drawing code), so a cached copy is never out of date
+# AVATAR_BACKEND set to 'gravatar' goes back to Gravatar URLs
+
+# bump when the drawing changes, so that browsers fetch the new images
+VERSION = 1
+GRID = 5
+BACKGROUND = (240, 240, 240)
+
+
+def identicon_cells(digest):
+    'the 5 x 5 grid of booleans for digest, the right two columns mirror the left two'
+    # the first bytes of the digest, the colour is taken from the last ones
+    bits = int(digest[:8], 16)
+    half = (GRID + 1) // 2
+    rows = []
+    for y in range(GRID):
+        left = [bool(bits >> (y * half + x) & 1) for x in range(half)]
+        rows.append(left + left[GRID - half - 1::-1])
+    return rows
+
+
+def identicon_colour(digest):
+    'a colour from the last bytes of digest, kept away from white and black so that it shows on the background'
+    red, green, blue = bytes.fromhex(digest[-6:])
+    return tuple(48 + value * 160 // 255 for value in (red, green, blue))
+
+
+def png(width, height, rows):
+    'encodes rows (each a bytes object of width RGB pixels) as a PNG file'
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    # every row starts with filter type 0, no filtering
+    raw = b''.join(b'\x00' + row for row in rows)
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+                     chunk(b'IDAT', zlib.compress(raw, 9)),
+                     chunk(b'IEND', b'')])
+
+
+def identicon(digest, size):
+    'the PNG of the identicon of digest, size pixels square'
+    cells = identicon_cells(digest)
+    foreground, background = bytes(identicon_colour(digest)), bytes(BACKGROUND)
+    # a margin of half a cell on every side, like Gravatar's identicons
+    cell = size / (GRID + 1)
+    margin = cell / 2
+
+    def cell_index(position):
+        index = int((position - margin) // cell)
+        return index if position >= margin and index < GRID else None
+    columns = [cell_index(x) for x in range(size)]
+    empty = background * size
+    # there are only GRID different rows of pixels, each is built once and repeated
+    patterns = [b''.join(foreground if column is not None and cells[y][column] else background
+                         for column in columns) for y in range(GRID)]
+    rows = []
+    for y in range(size):
+        index = cell_index(y)
+        rows.append(empty if index is None else patterns[index])
+    return png(size, size, rows)
+
+
+class AvatarCache(object):
+    '''
+    The PNG files of the avatars served so far, one per digest and size, in AVATAR_CACHE_DIR which all the workers of a machine share
+    When the directory holds more than AVATAR_CACHE_SIZE files the oldest ones are removed, like FileSystemBackend in app/fragments.py does
+    '''
+
+    prune_every = 100
+
+    def __init__(self):
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, digest, size):
+        'the file of the avatar, drawing it first if it is not there yet'
+        directory = current_app.config['AVATAR_CACHE_DIR']
+        path = os.path.join(directory, '{}-{}-v{}.png'.format(digest, size, VERSION))
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+        self.misses += 1
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # written to a temporary file and moved into place, so that other workers never send half an image
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(identicon(digest, size))
+        os.replace(tmp, path)
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            self.prune(directory)
+        return path
+
+    def prune(self, directory):
+        paths = [os.path.join(directory, name)
+                 for name in os.listdir(directory) if not name.startswith('.')]
+        limit = current_app.config['AVATAR_CACHE_SIZE']
+        if len(paths) <= limit:
+            return
+        paths.sort(key=lambda path: os.path.getmtime(path))
+        for path in paths[:len(paths) - limit]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+avatar_cache = AvatarCache()
+
+
+def avatar_size(size):
+    'the smallest of AVATAR_SIZES that is at least size (or the largest), so that only a few sizes of every avatar are ever drawn'
+    sizes = sorted(current_app.config['AVATAR_SIZES'])
+    for allowed in sizes:
+        if allowed >= size:
+            return allowed
+    return sizes[-1]
+
+
+def avatar_url(digest, size):
+    if current_app.config['AVATAR_BACKEND'] == 'gravatar':
+        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+    return url_for('main.avatar', digest=digest, size=avatar_size(size), v=VERSION)
@@ -0,0 +1,140 @@
+import click
+from app import db
+from app.models import User, Timeline
+from app.search import search as post_search
+from app.seed import seed as seed_data
+from app import export as exports
+from app import suggestions as follow_suggestions
+from app.trending import trending_job
+from app import archive as post_archive
+from app import template_cache
+
+# commands are added to the flask command line, e.g. flask counters repair
+# the commands are defined inside register, which create_app calls with the application to add them to
+
+
+def register(app):
+    @app.cli.group()
+    def counters():
+        'Maintenance of the denormalized counters on User.'
+        pass
+
+    @counters.command()
+    def repair():
+        'Recompute the follower, following and post counters of every user.'
+        updated = User.repair_counters()
+        db.session.commit()
+        click.echo('Recomputed the counters of {} users.'.format(updated))
+
+    @app.cli.group()
+    def search():
+        'Maintenance of the full-text search index of posts.'
+        pass
+
+    @search.command()
+    def reindex():
+        'Rebuild the search index from all existing posts.'
+        if not post_search.enabled:
+            raise click.ClickException('Search is turned off (SEARCH_BACKEND).')
+        indexed = post_search.reindex()
+        db.session.commit()
+        click.echo('Indexed {} posts.'.format(indexed))
+
+    @app.cli.group()
+    def timeline():
+        'Maintenance of the materialized home timelines.'
+        pass
+
+    @timeline.command('rebuild')
+    def rebuild_timeline():
+        'Rebuild the timeline of every user from the posts and the follow graph.'
+        copied = Timeline.rebuild()
+        db.session.commit()
+        click.echo('Copied {} posts to the timelines.'.format(copied))
+
+    @app.cli.group()
+    def suggestions():
+        'Maintenance of the suggestions of users to follow.'
+        pass
+
+    @suggestions.command()
+    def rebuild():
+        'Recompute the suggestions of every user from the follow graph.'
+        written = follow_suggestions.rebuild()
+        db.session.commit()
+        click.echo('Wrote {} suggestions.'.format(written))
+
+    @app.cli.group()
+    def trending():
+        'Maintenance of the trending posts of /explore.'
+        pass
+
+    @trending.command('rebuild')
+    def rebuild_trending():
+        'Rank the recent posts and replace the trending snapshot.'
+        ranked = trending_job.run()
+        click.echo('Ranked {} posts.'.format(ranked))
+
+    @app.cli.group()
+    def archive():
+        'The archive of old posts.'
+        pass
+
+    @archive.command()
+    def status():
+        'Show the number of posts in the post table and in the archive.'
+        for size in post_archive.partition_sizes():
+            click.echo('{}: {} posts{}'.format(
+                size['table'], size['posts'], ', {} to {}'.format(
+                    size['oldest'], size['newest']) if size['posts'] else ''))
+
+    @archive.command('run')
+    @click.option('--days', type=int, help='Move the posts older than this many days (ARCHIVE_AFTER_DAYS).')
+    @click.option('--batch-size', type=int, help='Posts moved per transaction (ARCHIVE_BATCH_SIZE).')
+    def run_archive(days, batch_size):
+        'Move the old posts to the archive.'
+        moved = post_archive.archive_posts(days=days, batch_size=batch_size)
+        click.echo('Moved {} posts to the archive.'.format(moved))
+
+    @app.cli.group()
+    def templates():
+        'The compiled templates.'
+        pass
+
+    @templates.command('compile')
+    def compile_templates():
+        'Compile every template into the bytecode cache, e.g. once per deploy before the workers start.'
+        if app.config['TEMPLATE_CACHE'] != 'filesystem':
+            raise click.ClickException('The template cache is turned off (TEMPLATE_CACHE).')
+        names = template_cache.warm_up(app)
+        click.echo('Compiled {} templates into {}.'.format(
+            len(names), app.config['TEMPLATE_CACHE_DIR']))
+
+    @app.cli.command()
+    @click.option('--users', default=1000, help='Number of users to add.')
+    @click.option('--posts', default=20000, help='Number of posts to add.')
+    @click.option('--follows', default=20, help='Average number of users each user follows.')
+    @click.option('--exponent', default=1.0, help='Zipf exponent of popularity, higher is more uneven.')
+    @click.option('--days', default=90, help='Posts are spread over this many past days.')
+    @click.option('--seed', 'random_seed', type=int, help='Random seed, for repeatable data.')
+    def seed(users, posts, follows, exponent, days, random_seed):
+        'Fill the database with synthetic users, follows and posts.'
+        edges = seed_data(users, posts, mean_follows=follows, exponent=exponent, days=days,
+                          random_seed=random_seed, progress=click.echo)
+        click.echo('Added {} users, {} follows and {} posts.'.format(users, edges, posts))
+
+    @app.cli.command()
+    @click.argument('kind', type=click.Choice(sorted(exports.EXPORTS)))
+    @click.argument('username')
+    @click.option('--format', 'format', type=click.Choice(exports.FORMATS), default='ndjson',
+                  help='Newline delimited JSON or CSV.')
+    @click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+    @click.option('--output', '-o', type=click.File('wb'), default='-',
+                  help='File to write to, standard output by default.')
+    def export(kind, username, format, compress, output):
+        'Export all the posts or follows of a user.'
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException('There is no user {}.'.format(username))
+        for chunk in exports.export(user, kind, format, compress):
+            output.write(chunk)
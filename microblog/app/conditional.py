@@ -0,0 +1,33 @@
+from hashlib import md5
+from flask import request, session, make_response, current_app
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+# conditional GET for pages that clients poll: the page is only rendered when the version the client already has (sent back as If-None-Match) is out of date, otherwise the answer is an empty 304 Not Modified
+# the version is worked out from a few cheap values (the newest post in the feed, the version of a profile, ...) that change whenever the page would, so that it costs far less than running the feed query and rendering the page
+# the pages are different for each logged in user, so they may only be kept by the browser (private) and have to be checked with the server before each use (no-cache)
+
+
+def page_etag(*versions):
+    'the ETag of a page showing versions to the current user, whose name, avatar and follows appear on every page too'
+    viewer = (current_user.id, current_user.author_version(), current_user.following_count) \
+        if current_user.is_authenticated else None
+    return md5(repr((viewer,) + versions).encode('utf-8')).hexdigest()
+
+
+def conditional_page(render, *versions):
+    '''
+    Answers with 304 Not Modified if the client has the page for versions already, otherwise with the page returned by render
+    The page is validated by its ETag only. No Last-Modified is sent: the time of the newest post doesn't change when a profile or the viewer's follows do, so a client that only sends If-Modified-Since would be told a stale copy is still good
+    '''
+    etag = page_etag(*versions)
+    # a message waiting to be flashed is shown by the next page that is rendered, so it has to be rendered
+    if '_flashes' not in session and not is_resource_modified(request.environ, etag=etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -0,0 +1,90 @@
+import random
+from functools import partial, wraps
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+
+# the database layer: engine settings for SQLite and for database servers, and read replicas for the pages that only read
+# replicas are served by ordinary Flask-SQLAlchemy binds named replica0, replica1, ..., so their engines are created and configured just like the one of the primary
+# a replica may be a little behind the primary, so only pages where that is acceptable are sent to one, e.g. a post that was just written can take a moment to show up on /explore
+
+
+def replica_bind(index):
+    return 'replica{}'.format(index)
+
+
+def set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    'runs on every new SQLite connection, the pragmas only last as long as the connection'
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute('PRAGMA {}={}'.format(name, value))
+    cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Session that runs the queries of a read-only view (see Database.read_only) on the replica picked for it
+    Flushes always go to the primary, so a read-only view that writes after all still writes to the right database
+    '''
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return get_state(self.app).db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class Database(SQLAlchemy):
+    '''
+    Flask-SQLAlchemy with the engine settings of config.py applied and with a bind for each of DATABASE_REPLICA_URLS
+    SQLite connections get the SQLITE_* pragmas (write-ahead logging lets readers carry on while a write is in progress), server databases get a pool of DATABASE_POOL_SIZE connections plus up to DATABASE_MAX_OVERFLOW more, each replaced after DATABASE_POOL_RECYCLE seconds
+    '''
+
+    def init_app(self, app):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for index, url in enumerate(app.config['DATABASE_REPLICA_URLS']):
+            binds[replica_bind(index)] = url
+        app.config['SQLALCHEMY_BINDS'] = binds
+        SQLAlchemy.init_app(self, app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            pragmas = [('synchronous', app.config['SQLITE_SYNCHRONOUS']),
+                       ('cache_size', -app.config['SQLITE_CACHE_SIZE'])]
+            # an in-memory database has no file to keep a log next to
+            if sa_url.database not in (None, '', ':memory:'):
+                pragmas.insert(0, ('journal_mode', app.config['SQLITE_JOURNAL_MODE']))
+            # not an argument of create_engine, create_engine below takes it out again
+            options['sqlite_pragmas'] = pragmas
+        else:
+            # these replace the defaults Flask-SQLAlchemy picks for MySQL, SQLALCHEMY_ENGINE_OPTIONS still has the last word
+            options['pool_size'] = app.config['DATABASE_POOL_SIZE']
+            options['max_overflow'] = app.config['DATABASE_MAX_OVERFLOW']
+            options['pool_recycle'] = app.config['DATABASE_POOL_RECYCLE']
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', partial(set_sqlite_pragmas, pragmas))
+        return engine
+
+    def read_only(self, view):
+        'decorator for views that only read, their queries run on a replica picked at random when there are any'
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            replicas = len(self.get_app().config['DATABASE_REPLICA_URLS'])
+            if not replicas:
+                return view(*args, **kwargs)
+            session = self.session()
+            session.info['replica'] = replica_bind(random.randrange(replicas))
+            try:
+                return view(*args, **kwargs)
+            finally:
+                # whatever runs after the view in the same session reads from the primary again, objects loaded from the replica are reloaded from it when next used
+                del session.info['replica']
+                session.expire_all()
+        return wrapped
@@ -0,0 +1,159 @@
+import atexit
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler
+from flask import render_template, current_app
+from flask_mail import Message
+from app import mail
+
+
+class MailQueue(object):
+    '''
+    Sends email from background threads so that a request (or a logging call) never waits for the SMTP server
+    Messages wait in a queue of at most MAIL_QUEUE_SIZE messages, which MAIL_WORKERS threads empty in batches of up to MAIL_BATCH_SIZE messages sent over one SMTP connection. A batch that fails is retried up to MAIL_MAX_RETRIES times, waiting MAIL_RETRY_BACKOFF seconds before the first retry and twice as long before each one after that
+    '''
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.queue = None
+        self.workers = []
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def init_app(self, app):
+        'the workers send with the configuration of app, in an application context of their own'
+        self.app = app
+
+    def start(self):
+        'starts the worker threads, called on the first submit'
+        with self.lock:
+            if self.queue is not None:
+                return
+            self.queue = queue.Queue(maxsize=self.app.config['MAIL_QUEUE_SIZE'])
+            for i in range(self.app.config['MAIL_WORKERS']):
+                # daemon threads don't keep the process alive, stop() gives them the chance to finish at exit
+                worker = threading.Thread(target=self.work, name='mail-{}'.format(i))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, msg):
+        'queues msg for sending, returns False if the queue is full and the message was dropped'
+        self.start()
+        try:
+            self.queue.put_nowait(msg)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            # a warning rather than an error, errors are themselves emailed and would only add to the queue
+            self.app.logger.warning('Mail queue is full, dropped "%s"', msg.subject)
+            return False
+        return True
+
+    def join(self):
+        'waits until every queued message has been sent or given up on'
+        if self.queue is not None:
+            self.queue.join()
+
+    def stop(self, timeout=10):
+        'asks the workers to finish the queued messages and exit, waiting at most timeout seconds for each'
+        if self.queue is None:
+            return
+        for worker in self.workers:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def work(self):
+        # Flask-Mail needs an application context to send
+        with self.app.app_context():
+            stop = False
+            while not stop:
+                msg = self.queue.get()
+                if msg is None:
+                    self.queue.task_done()
+                    break
+                batch = [msg]
+                # take whatever else is already waiting, so that it goes over the same connection
+                while len(batch) < self.app.config['MAIL_BATCH_SIZE']:
+                    try:
+                        msg = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if msg is None:
+                        self.queue.task_done()
+                        stop = True
+                        break
+                    batch.append(msg)
+                try:
+                    self.send_batch(batch)
+                finally:
+                    for msg in batch:
+                        self.queue.task_done()
+
+    def send_batch(self, batch):
+        pending = list(batch)
+        retries = self.app.config['MAIL_MAX_RETRIES']
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.app.config['MAIL_RETRY_BACKOFF'] * 2 ** (attempt - 1))
+            try:
+                with mail.connect() as connection:
+                    while pending:
+                        connection.send(pending[0])
+                        pending.pop(0)
+                        with self.lock:
+                            self.sent += 1
+                return
+            except Exception as e:
+                self.app.logger.warning('Sending %d email(s) failed (attempt %d of %d): %s',
+                                        len(pending), attempt + 1, retries + 1, e)
+        with self.lock:
+            self.failed += len(pending)
+
+
+mail_queue = MailQueue()
+# send what is still queued before the worker process exits
+atexit.register(mail_queue.stop)
+
+
+class MailQueueHandler(QueueHandler):
+    '''
+    Logging handler that emails each record through the mail queue, replacing SMTPHandler which connected to the SMTP server from the thread that logged the record
+    QueueHandler formats the record in the calling thread, enqueue then turns it into a message for the mail queue
+    '''
+
+    def __init__(self, mail_queue, fromaddr, toaddrs, subject):
+        QueueHandler.__init__(self, mail_queue)
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+
+    def enqueue(self, record):
+        self.queue.submit(Message(self.subject, sender=self.fromaddr,
+                                  recipients=self.toaddrs, body=record.msg))
+
+
+def send_email(subject, sender, recipients, text_body, html_body):
+    'builds the message in the calling thread (templates need the request) and leaves the sending to the mail queue'
+    msg = Message(subject, sender=sender, recipients=recipients)
+    msg.body = text_body
+    msg.html = html_body
+    return mail_queue.submit(msg)
+
+
+def send_password_reset_email(user):
+    token = user.get_reset_password_token()
+    send_email('[Microblog] Reset Your Password',
+               sender=current_app.config['ADMINS'][0],
+               recipients=[user.email],
+               text_body=render_template('email/reset_password.txt',
+                                         user=user, token=token),
+               html_body=render_template('email/reset_password.html',
+                                         user=user, token=token))
@@ -1,11 +1,14 @@
-from flask import render_template
-from app import app, db
+from flask import Blueprint, render_template
+from app import db
 
-@app.errorhandler(404)
+# the error pages are a blueprint of their own, app_errorhandler makes them handle the errors of the whole application rather than only those of this blueprint
+bp = Blueprint('errors', __name__)
+
+@bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     # 500 error occur when there is a database error, meaning that you want to undo changes made to the database so that they don't interfere with other session - apply rollback
     db.session.rollback()
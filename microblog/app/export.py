@@ -0,0 +1,102 @@
+import csv
+import io
+import json
+import zlib
+from sqlalchemy.orm import aliased
+from app import db
+from app.models import User, Post, ArchivedPost, followers
+
+# full exports of the posts and follows of a user, as newline delimited JSON or CSV
+# the rows are read with yield_per, which fetches them from the database a batch at a time (with a server-side cursor where the database has them) and skips the identity map, and they are encoded and compressed as they come, so an export takes the same memory whatever the size of the account
+# the same generators feed the download views in app/routes.py and the flask export command
+
+FORMATS = ('ndjson', 'csv')
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+
+def post_rows(user):
+    'the archived posts of the user and then the recent ones, every archived post is older than the recent ones (see app/archive.py)'
+    for model in (ArchivedPost, Post):
+        query = db.session.query(model.id, model.timestame, model.body).filter(
+            model.user_id == user.id).order_by(model.id)
+        for id, timestame, body in query.yield_per(BATCH_SIZE):
+            yield id, timestame.isoformat() + 'Z', body
+
+
+def follow_rows(user):
+    'every follow edge the user is on either end of, the users they follow first'
+    follower, followed = aliased(User), aliased(User)
+    for column in (followers.c.follower_id, followers.c.followed_id):
+        query = db.session.query(follower.id, follower.username, followed.id, followed.username) \
+            .select_from(followers) \
+            .join(follower, follower.id == followers.c.follower_id) \
+            .join(followed, followed.id == followers.c.followed_id) \
+            .filter(column == user.id).order_by(followers.c.follower_id, followers.c.followed_id)
+        for row in query.yield_per(BATCH_SIZE):
+            yield tuple(row)
+
+
+# what can be exported: name -> (column names, function returning the rows for a user)
+EXPORTS = {
+    'posts': (('id', 'timestamp', 'body'), post_rows),
+    'follows': (('follower_id', 'follower', 'followed_id', 'followed'), follow_rows),
+}
+
+
+def ndjson_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+
+
+def csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def chunks(lines):
+    'joins the lines into UTF-8 chunks of about CHUNK_SIZE bytes, fewer larger writes are cheaper to send'
+    chunk, size = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        chunk.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def gzipped(chunks):
+    'compresses a stream of chunks into a gzip file as it goes'
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(user, kind, format, compress=False):
+    'generator of the bytes of the kind export of user in format, gzipped if compress is True'
+    columns, rows = EXPORTS[kind]
+    lines = (ndjson_lines if format == 'ndjson' else csv_lines)(columns, rows(user))
+    stream = chunks(lines)
+    return gzipped(stream) if compress else stream
+
+
+def filename(user, kind, format, compress=False):
+    return '{}-{}.{}{}'.format(user.username, kind, format, '.gz' if compress else '')
+
+
+def mimetype(format, compress=False):
+    if compress:
+        return 'application/gzip'
+    return 'application/x-ndjson' if format == 'ndjson' else 'text/csv'
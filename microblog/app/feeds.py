@@ -0,0 +1,88 @@
+from sqlalchemy import false
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models import Post, ArchivedPost, Timeline, TrendingPost, followers
+from app.pagination import Source
+
+# the queries behind the feed pages
+# every post in a feed is rendered with its author's name and avatar (see _post.html), so the authors are loaded in the same query as the posts with a join, instead of one extra query per post when post.author is first used
+
+
+def with_authors(query):
+    'adds the eager loading of post authors to a query of posts'
+    return query.options(joinedload(Post.author))
+
+
+def home_timeline(user, fanout_on_read=()):
+    'the posts in the materialized timeline of user, newest first, without those of the users in fanout_on_read'
+    return with_authors(user.timeline_posts(fanout_on_read))
+
+
+def home_feed(user):
+    '''
+    Posts of user and of the users they follow, newest first, as the list of partitions that fetch_posts reads (see app/pagination.py)
+    The timeline is paged by its own copies of (timestame, post_id), which are in the order of its index. The posts of followed users with too many followers to be copied to the timeline are merged in from the (user_id, timestame, id) index of post
+    The timeline only holds the posts after the horizon of user (see User.timeline_horizon), the posts from before it are read through the follow edges like the archive
+    '''
+    fanout_on_read = user.fanout_on_read_ids()
+    horizon = user.timeline_horizon
+    recent = [Source(home_timeline(user, fanout_on_read), Timeline.timestame, Timeline.post_id)]
+    if fanout_on_read:
+        popular = Post.query.filter(Post.user_id.in_(fanout_on_read))
+        if horizon is not None:
+            popular = popular.filter(Post.timestame > horizon)
+        recent.append(with_authors(popular))
+    # the partition is there even when it is empty, so that the partition of a cursor handed out before the horizon moved still means the same one
+    before_horizon = user.followed_posts().filter(
+        Post.timestame <= horizon if horizon is not None else false())
+    return [recent, with_authors(before_horizon), home_archive(user)]
+
+
+def explore_feed():
+    'all posts, newest first'
+    return with_authors(Post.query.order_by(Post.timestame.desc()))
+
+
+def trending_feed(after_rank, count):
+    'the count posts of the trending snapshot (see app/trending.py) that come after after_rank, best first'
+    return with_authors(Post.query.join(TrendingPost, TrendingPost.post_id == Post.id).filter(
+        TrendingPost.rank > after_rank, TrendingPost.rank <= after_rank + count).order_by(
+            TrendingPost.rank))
+
+
+def user_feed(user):
+    'posts written by user, newest first'
+    return with_authors(user.posts.order_by(Post.timestame.desc()))
+
+
+# the archived posts that continue each feed once it gets past the recent posts (see app/archive.py and fetch_posts in app/pagination.py)
+
+def home_archive(user):
+    'archived posts of user and of the users they follow. The timeline table only holds recent posts, so the archive is read through the follow edges and the (user_id, timestame, id) index instead'
+    followed = db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user.id)
+    return ArchivedPost.query.options(joinedload(ArchivedPost.author)).filter(
+        (ArchivedPost.user_id == user.id) | ArchivedPost.user_id.in_(followed))
+
+
+def explore_archive():
+    'all archived posts'
+    return ArchivedPost.query.options(joinedload(ArchivedPost.author))
+
+
+def user_archive(user):
+    'archived posts written by user'
+    return ArchivedPost.query.options(joinedload(ArchivedPost.author)).filter(
+        ArchivedPost.user_id == user.id)
+
+
+def newest_post(user=None):
+    '(timestame, id) of the newest post, of all posts or of those written by user, None if there are none. Only reads the index the feeds are ordered by, and the archive only when there are no recent posts'
+    for model in (Post, ArchivedPost):
+        query = db.session.query(model.timestame, model.id)
+        if user is not None:
+            query = query.filter(model.user_id == user.id)
+        newest = query.order_by(model.timestame.desc(), model.id.desc()).first()
+        if newest is not None:
+            return newest
+    return None
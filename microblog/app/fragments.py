@@ -0,0 +1,182 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from hashlib import md5
+from flask import render_template, current_app
+from jinja2 import Markup
+from sqlalchemy import event
+from app.models import Post
+
+# cache of the HTML that _post.html renders for each post, so that a feed page only runs the template for posts it hasn't seen before
+# an entry is stored under the post id together with the version of the author it was rendered for (see User.author_version), so when the author changes their username or email the version no longer matches and the post is simply rendered again
+# the time of the post is rendered by moment.js in the browser from the absolute timestamp, so a cached fragment never goes out of date by itself
+
+
+class MemoryBackend(object):
+    'least recently used entries in a dictionary of the worker process, at most FRAGMENT_CACHE_SIZE of them'
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['FRAGMENT_CACHE_SIZE'])
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, version, html):
+        with self.lock:
+            self.entries[key] = (version, html)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FileSystemBackend(object):
+    '''
+    One file per entry in FRAGMENT_CACHE_DIR, which lets all the workers on a machine share the cache and keeps it across restarts
+    When the directory holds more than FRAGMENT_CACHE_SIZE files the oldest ones are removed
+    '''
+
+    # the number of files is only checked every so many writes, listing a large directory on every write would cost more than the cache saves
+    prune_every = 100
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['FRAGMENT_CACHE_SIZE'], config['FRAGMENT_CACHE_DIR'])
+
+    def __init__(self, size, directory):
+        self.size = size
+        self.directory = directory
+        self.writes = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, md5(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                version, _, html = f.read().partition('\n')
+        except (IOError, OSError):
+            return None
+        return version, html
+
+    def set(self, key, version, html):
+        # write to a temporary file and move it into place, so that other workers never read half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(version + '\n' + html)
+        os.replace(tmp, self.path(key))
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def prune(self):
+        paths = [os.path.join(self.directory, name)
+                 for name in os.listdir(self.directory) if not name.startswith('.')]
+        if len(paths) <= self.size:
+            return
+        paths.sort(key=lambda path: os.path.getmtime(path))
+        for path in paths[:len(paths) - self.size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class FragmentCache(object):
+    '''
+    Renders posts through the backend named by FRAGMENT_CACHE ('memory', 'filesystem' or 'none' to turn caching off)
+    The backend is created on first use so that the configuration can still be changed after import, e.g. by tests
+    '''
+
+    backends = {'memory': MemoryBackend, 'filesystem': FileSystemBackend}
+
+    def __init__(self):
+        self._backend = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            name = current_app.config['FRAGMENT_CACHE']
+            if name and name != 'none':
+                self._backend = self.backends[name].from_config(current_app.config)
+        return self._backend
+
+    def init_app(self, app):
+        'makes render_post available to the templates of app, the backend is then created from its configuration on first use'
+        # templates stitch the cached posts together with {{ render_post(post) }}
+        app.add_template_global(self.render_post, 'render_post')
+        self.reset()
+
+    def reset(self):
+        'forgets the backend, the next use creates it again from the configuration'
+        self._backend = None
+
+    @staticmethod
+    def key(post_id):
+        return 'post/{}'.format(post_id)
+
+    def render_post(self, post):
+        'the HTML of _post.html for post, from the cache if it is there for the current version of the author'
+        backend = self.backend
+        if backend is None:
+            return Markup(render_template('_post.html', post=post))
+        key = FragmentCache.key(post.id)
+        # the time of the post is part of the version too, so that a post id that is reused after a delete never picks up the old post
+        version = '{}/{}'.format(post.timestame.isoformat(), post.author.author_version())
+        entry = backend.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return Markup(entry[1])
+        self.misses += 1
+        html = render_template('_post.html', post=post)
+        backend.set(key, version, html)
+        return Markup(html)
+
+    def invalidate(self, post_id):
+        backend = self.backend
+        if backend is not None:
+            backend.delete(FragmentCache.key(post_id))
+
+
+fragment_cache = FragmentCache()
+
+# write-through: a post that is changed or deleted is dropped from the cache straight away
+@event.listens_for(Post, 'after_update')
+@event.listens_for(Post, 'after_delete')
+def invalidate_post_fragment(mapper, connection, post):
+    fragment_cache.invalidate(post.id)
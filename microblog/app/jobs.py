@@ -0,0 +1,96 @@
+import threading
+import time
+from app import db
+
+# background jobs that run in a thread of every worker process, e.g. the trending snapshot (app/trending.py) and the archive of old posts (app/archive.py)
+# the thread is started on the first request rather than by create_app, so that a pre-fork server starts one in every worker instead of in the parent process
+
+
+class PeriodicJob(object):
+    '''
+    Runs task in an application context every so many seconds, taken from the setting named by interval_setting (0 turns the thread off, the job can then still be run by a command, e.g. from cron)
+    The time taken by the last run and the number of runs and failures are kept for /metrics
+    '''
+
+    name = None
+    interval_setting = None
+    # logged after every run with the number task returned and the time taken
+    done_message = '%s: %d in %.1f ms'
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+
+    def init_app(self, app):
+        'the job runs in an application context of app'
+        self.app = app
+
+    def task(self):
+        'does the work of one run in the session of the job, returns a number for the log'
+        raise NotImplementedError
+
+    def start(self):
+        'starts the thread, if it isn\'t running yet and the interval isn\'t 0'
+        with self.lock:
+            if self.thread is not None or not self.app.config[self.interval_setting]:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.work, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=10):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopped.set()
+            thread.join(timeout)
+
+    def work(self):
+        interval = self.app.config[self.interval_setting]
+        with self.app.app_context():
+            while True:
+                try:
+                    wait = self.run_if_due()
+                except Exception:
+                    self.app.logger.exception('The %s job failed', self.name)
+                    wait = interval
+                finally:
+                    db.session.remove()
+                if self.stopped.wait(wait):
+                    break
+
+    def run_if_due(self):
+        'runs the job and returns the number of seconds until the next run, jobs that share their work between workers skip runs that another worker has done'
+        self.run()
+        return self.app.config[self.interval_setting]
+
+    def run(self):
+        'runs task and commits what it did, returns what task returned'
+        started = time.perf_counter()
+        try:
+            result = self.task()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self.lock:
+                self.failures += 1
+            raise
+        duration = time.perf_counter() - started
+        with self.lock:
+            self.runs += 1
+            self.last_duration = duration
+            self.total_duration += duration
+        self.app.logger.info(self.done_message, self.name, result, duration * 1000)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {'runs': self.runs, 'failures': self.failures,
+                    'last_duration': self.last_duration, 'total_duration': self.total_duration}
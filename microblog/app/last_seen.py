@@ -0,0 +1,107 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import bindparam
+from app import db
+from app.models import User
+from app.user_cache import user_cache
+from app.jobs import PeriodicJob
+
+
+class LastSeenTracker(object):
+    '''
+    Keeps last_seen updates in memory and writes them to the database in one bulk UPDATE, instead of committing the user row on every request
+    A new time is only recorded when it is more than LAST_SEEN_GRANULARITY seconds after the last one known for that user. The pending times are written once LAST_SEEN_FLUSH_SIZE users are waiting or LAST_SEEN_FLUSH_INTERVAL seconds have passed since the last write (checked by seen, and by LastSeenFlushJob below for a worker that gets no more requests), and when the process exits
+    '''
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+
+    def init_app(self, app):
+        'the times that are still pending when the process exits are written to the database of app'
+        self.app = app
+
+    def seen(self, user, when=None):
+        'records that user made a request at when (defaults to now), returns True if the time was recorded'
+        when = when or datetime.utcnow()
+        granularity = timedelta(seconds=current_app.config['LAST_SEEN_GRANULARITY'])
+        with self.lock:
+            known = self.pending.get(user.id) or user.last_seen
+            if known is not None and when - known < granularity:
+                return False
+            self.pending[user.id] = when
+            due = len(self.pending) >= current_app.config['LAST_SEEN_FLUSH_SIZE'] or \
+                time.time() - self.last_flush >= current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if due:
+            self.flush()
+        return True
+
+    def flush(self):
+        'writes all pending times in a single transaction, returns the number of users updated'
+        if not has_app_context():
+            # at exit there is no request going on, the application the tracker was set up with tells which database to write to
+            if self.app is None:
+                return 0
+            with self.app.app_context():
+                return self.flush()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        if not pending:
+            return 0
+        # the update runs on its own connection so that it never commits (or rolls back) whatever the request has in progress in db.session
+        update = User.__table__.update().where(
+            User.__table__.c.id == bindparam('user_id')).values(
+                last_seen=bindparam('seen'))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(update, [{'user_id': user_id, 'seen': seen}
+                                            for user_id, seen in pending.items()])
+        except Exception:
+            current_app.logger.exception('Could not write last_seen times')
+            # put the times back so they are retried on the next flush, unless a newer time came in meanwhile
+            with self.lock:
+                for user_id, seen in pending.items():
+                    self.pending.setdefault(user_id, seen)
+            return 0
+        # the new times bypass the ORM, so cached copies of these users are dropped for load_user to pick the times up
+        user_cache.invalidate(*pending)
+        return len(pending)
+
+
+class LastSeenFlushJob(PeriodicJob):
+    '''
+    Writes the pending times of tracker once LAST_SEEN_FLUSH_INTERVAL seconds have passed since the last write, seen only checks that when a request comes in, so the times of the last requests before a quiet spell would otherwise wait for the next one
+    '''
+
+    name = 'last_seen'
+    interval_setting = 'LAST_SEEN_FLUSH_INTERVAL'
+    done_message = '%s: wrote the times of %d users in %.1f ms'
+
+    def __init__(self, tracker):
+        PeriodicJob.__init__(self)
+        self.tracker = tracker
+
+    def task(self):
+        return self.tracker.flush()
+
+    def run_if_due(self):
+        'flushes the pending times when the interval has passed since the last write, by this thread or by seen, returns the number of seconds until it is next due'
+        interval = self.app.config['LAST_SEEN_FLUSH_INTERVAL']
+        wait = self.tracker.last_flush + interval - time.time()
+        if wait > 0:
+            return wait
+        if self.tracker.pending:
+            self.run()
+        return interval
+
+
+tracker = LastSeenTracker()
+flush_job = LastSeenFlushJob(tracker)
+# write whatever is still pending when the worker shuts down
+atexit.register(tracker.flush)
@@ -0,0 +1,221 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import g, request, current_app, has_request_context
+
+# the logging pipeline of production: request threads only put records on a queue, a QueueListener thread formats them and writes them to the log file, so a request never waits for the disk or for a rotation
+# records carry the id of the request that logged them (taken from an X-Request-ID header or made up, and sent back in the response) and how long the request had been running, and are written as JSON lines or as text
+# a flood of the same error is cut down to LOG_RATE_LIMIT records per LOG_RATE_WINDOW seconds, and only LOG_SAMPLE_RATE of the records below WARNING are kept
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+
+
+class RequestFilter(logging.Filter):
+    'adds the request id, method, path and the time the request has taken so far to records logged during a request'
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = getattr(g, 'request_id', None)
+            record.method = request.method
+            record.path = request.path
+            stats = getattr(g, 'metrics', None)
+            if stats is not None:
+                record.latency_ms = round((time.perf_counter() - stats['started']) * 1000, 3)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets through at most rate records logged by the same line with the same message (before the arguments are filled in, so 'Post %d failed' is one message whatever the post) every per seconds, and a fraction sample_rate of the records below WARNING
+    The first record let through after some were dropped says how many, in its suppressed attribute and at the end of its message
+    '''
+
+    def __init__(self, rate, per, sample_rate=1.0):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.per = per
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        # (pathname, lineno, msg) -> [start of the window, records let through in it, records dropped]
+        self.windows = {}
+        self.suppressed = 0
+        self.sampled_out = 0
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and self.sample_rate < 1 and \
+                random.random() >= self.sample_rate:
+            with self.lock:
+                self.sampled_out += 1
+            return False
+        if not self.rate:
+            return True
+        key = (record.pathname, record.lineno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                dropped = window[2] if window is not None else 0
+                window = self.windows[key] = [now, 0, 0]
+                if len(self.windows) > 10000:
+                    # forget the windows that are over, so that messages with ever changing text can't grow the dict without bound
+                    self.windows = {k: w for k, w in self.windows.items() if now - w[0] < self.per}
+                    self.windows[key] = window
+            else:
+                dropped = 0
+            if window[1] >= self.rate:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+            window[1] += 1
+        if dropped:
+            record.suppressed = dropped
+            record.msg = '{} ({} similar messages suppressed)'.format(record.msg, dropped)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    'formats each record as one line of JSON'
+
+    # attributes that RequestFilter and RateLimitFilter add, copied into the line when they are there
+    EXTRA = ('request_id', 'method', 'path', 'latency_ms', 'suppressed')
+
+    def format(self, record):
+        line = {'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                'location': '{}:{}'.format(record.pathname, record.lineno)}
+        for name in self.EXTRA:
+            value = getattr(record, name, None)
+            if value is not None:
+                line[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line['exception'] = record.exc_text
+        return json.dumps(line, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    'QueueHandler that drops records when the queue is full instead of blocking or raising in the request thread'
+
+    def __init__(self, queue):
+        QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        'merges the arguments into the message and renders the traceback while they are still what they were when logged, the layout of the line is left to the listener'
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline(object):
+    '''
+    Sets up the queue, the handler on the application logger and the listener thread writing to LOG_FILE
+    The file is rotated when it reaches LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files, LOG_FILE set to - writes to standard error instead
+    '''
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.handler = None
+        self.listener = None
+        self.rate_limit = None
+
+    def init_app(self, app):
+        'every request gets an id, which is sent back in the X-Request-ID header and logged with its records'
+        self.app = app
+        app.before_request(assign_request_id)
+        app.after_request(finish_request)
+
+    def start(self):
+        'adds the queue handler to the application logger and starts the listener, called by create_app outside of debug and testing'
+        with self.lock:
+            if self.listener is not None:
+                return
+            config = self.app.config
+            log_queue = queue.Queue(maxsize=config['LOG_QUEUE_SIZE'])
+            self.handler = DroppingQueueHandler(log_queue)
+            self.handler.setLevel(logging.INFO)
+            # filters on the queue handler run in the thread that logs, while the request is still there to be looked at
+            self.handler.addFilter(RequestFilter())
+            self.rate_limit = RateLimitFilter(config['LOG_RATE_LIMIT'], config['LOG_RATE_WINDOW'],
+                                              config['LOG_SAMPLE_RATE'])
+            self.handler.addFilter(self.rate_limit)
+            self.listener = QueueListener(log_queue, self.output_handler(),
+                                          respect_handler_level=True)
+            self.listener.start()
+            self.app.logger.addHandler(self.handler)
+
+    def output_handler(self):
+        config = self.app.config
+        if config['LOG_FILE'] == '-':
+            handler = logging.StreamHandler(sys.stderr)
+        else:
+            directory = os.path.dirname(config['LOG_FILE'])
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            handler = RotatingFileHandler(config['LOG_FILE'], maxBytes=config['LOG_MAX_BYTES'],
+                                          backupCount=config['LOG_BACKUP_COUNT'])
+        if config['LOG_FORMAT'] == 'json':
+            handler.setFormatter(JSONFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        return handler
+
+    def stop(self):
+        'writes the records still in the queue and stops the listener'
+        with self.lock:
+            listener, self.listener = self.listener, None
+            handler, self.handler = self.handler, None
+        if listener is None:
+            return
+        self.app.logger.removeHandler(handler)
+        listener.stop()
+        for output in listener.handlers:
+            output.close()
+
+    def stats(self):
+        return {'dropped': self.handler.dropped if self.handler else 0,
+                'suppressed': self.rate_limit.suppressed if self.rate_limit else 0,
+                'sampled_out': self.rate_limit.sampled_out if self.rate_limit else 0}
+
+
+def assign_request_id():
+    # an id given by a proxy in front of the application is kept, so that its logs and these can be matched up
+    g.request_id = request.headers.get('X-Request-ID', '')[:200] or uuid.uuid4().hex
+
+
+def finish_request(response):
+    request_id = getattr(g, 'request_id', None)
+    if request_id is not None:
+        response.headers['X-Request-ID'] = request_id
+    if current_app.config['LOG_REQUESTS']:
+        current_app.logger.info('%s %s %s', request.method, request.full_path, response.status_code)
+    return response
+
+
+log_pipeline = LogPipeline()
+# the listener is a thread of its own, stopping it at exit writes whatever is still queued
+atexit.register(log_pipeline.stop)
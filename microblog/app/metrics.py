@@ -0,0 +1,233 @@
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request, current_app, has_app_context, request_started, request_finished, \
+    before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.user_cache import user_cache
+from app.fragments import fragment_cache
+from app.email import mail_queue
+from app.passwords import password_hasher
+from app.avatars import avatar_cache
+from app.popups import popup_cache
+from app.trending import trending_job
+from app.archive import archive_job
+from app.logs import log_pipeline
+from app import template_cache
+
+# per-request instrumentation: how many SQL queries each request runs, how long they take, how long templates take to render and how long the whole request takes
+# the numbers are collected per endpoint in histograms and served in the Prometheus text format at /metrics
+# they are kept per worker process, so with several workers every worker has to be scraped (or the numbers added up) to see the whole site
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    'a Prometheus histogram with an endpoint label'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # endpoint -> [count in each bucket, sum, count]
+        self.series = {}
+
+    def observe(self, endpoint, value):
+        with self.lock:
+            series = self.series.get(endpoint)
+            if series is None:
+                series = self.series[endpoint] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for endpoint, (counts, total, count) in sorted(self.series.items()):
+                label = 'endpoint="{}"'.format(endpoint)
+                # Prometheus buckets are cumulative, each one counts every observation up to its bound
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, cumulative))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, count))
+                lines.append('{}_sum{{{}}} {}'.format(self.name, label, total))
+                lines.append('{}_count{{{}}} {}'.format(self.name, label, count))
+        return lines
+
+
+request_duration = Histogram('microblog_request_duration_seconds',
+                             'Time taken to handle a request.', LATENCY_BUCKETS)
+sql_queries = Histogram('microblog_request_sql_queries',
+                        'Number of SQL statements run by a request.', QUERY_BUCKETS)
+sql_duration = Histogram('microblog_request_sql_duration_seconds',
+                         'Time a request spent running SQL statements.', LATENCY_BUCKETS)
+render_duration = Histogram('microblog_request_render_duration_seconds',
+                            'Time a request spent rendering templates.', LATENCY_BUCKETS)
+histograms = [request_duration, sql_queries, sql_duration, render_duration]
+
+
+
+def cache_stats():
+    'the counters the caches, the mail queue and the password hasher already keep'
+    users = user_cache.stats()
+    hashes = password_hasher.stats()
+    popups = popup_cache.stats()
+    return [
+        ('microblog_user_cache_size', 'gauge', 'Users held in the user cache.', users['size']),
+        ('microblog_user_cache_hits_total', 'counter', 'User cache hits.', users['hits']),
+        ('microblog_user_cache_misses_total', 'counter', 'User cache misses.', users['misses']),
+        ('microblog_user_cache_evictions_total', 'counter', 'Users evicted from the user cache.', users['evictions']),
+        ('microblog_fragment_cache_hits_total', 'counter', 'Rendered posts served from the fragment cache.', fragment_cache.hits),
+        ('microblog_fragment_cache_misses_total', 'counter', 'Posts rendered because they were not in the fragment cache.', fragment_cache.misses),
+        ('microblog_popup_cache_hits_total', 'counter', 'Hover cards served from the popup cache.', popups['hits']),
+        ('microblog_popup_cache_misses_total', 'counter', 'Hover cards that had to be loaded and rendered.', popups['misses']),
+        ('microblog_avatar_cache_hits_total', 'counter', 'Avatars served from the avatar cache.', avatar_cache.hits),
+        ('microblog_avatar_cache_misses_total', 'counter', 'Avatars drawn because they were not in the avatar cache.', avatar_cache.misses),
+        ('microblog_mail_sent_total', 'counter', 'Emails sent by the mail queue.', mail_queue.sent),
+        ('microblog_mail_failed_total', 'counter', 'Emails given up on after retrying.', mail_queue.failed),
+        ('microblog_mail_dropped_total', 'counter', 'Emails dropped because the mail queue was full.', mail_queue.dropped),
+        ('microblog_password_hashes_total', 'counter', 'Passwords hashed or checked.', hashes['calls']),
+        ('microblog_password_hashes_rejected_total', 'counter', 'Password hashes refused because too many were pending.', hashes['rejected']),
+        ('microblog_password_hash_queue_seconds_total', 'counter', 'Time password hashes waited for a worker.', hashes['queue_time']),
+        ('microblog_password_hash_compute_seconds_total', 'counter', 'Time spent computing password hashes.', hashes['compute_time']),
+    ]
+
+
+def trending_stats():
+    'the runs of the trending job in this worker, and how old the snapshot in the database is'
+    stats = trending_job.stats()
+    metrics = [
+        ('microblog_trending_runs_total', 'counter', 'Rebuilds of the trending snapshot by this worker.', stats['runs']),
+        ('microblog_trending_failures_total', 'counter', 'Rebuilds of the trending snapshot that failed.', stats['failures']),
+        ('microblog_trending_last_duration_seconds', 'gauge', 'Time taken by the last rebuild of the trending snapshot.', stats['last_duration']),
+        ('microblog_trending_duration_seconds_total', 'counter', 'Time spent rebuilding the trending snapshot.', stats['total_duration']),
+    ]
+    # there is no age until the first snapshot has been written
+    if stats['age'] is not None:
+        metrics.append(('microblog_trending_snapshot_age_seconds', 'gauge', 'Time since the trending snapshot was computed.', stats['age']))
+    return metrics
+
+
+def archive_stats():
+    'the runs of the archive job in this worker'
+    stats = archive_job.stats()
+    return [
+        ('microblog_archive_runs_total', 'counter', 'Runs of the job moving old posts to the archive by this worker.', stats['runs']),
+        ('microblog_archive_failures_total', 'counter', 'Runs of the archive job that failed.', stats['failures']),
+        ('microblog_archive_last_duration_seconds', 'gauge', 'Time taken by the last run of the archive job.', stats['last_duration']),
+        ('microblog_archive_duration_seconds_total', 'counter', 'Time spent moving posts to the archive.', stats['total_duration']),
+    ]
+
+
+def template_stats():
+    'templates this worker loaded from the shared bytecode cache instead of compiling them, nothing when the cache is off'
+    templates = template_cache.stats(current_app)
+    if templates is None:
+        return []
+    return [
+        ('microblog_template_cache_loads_total', 'counter', 'Compiled templates loaded from the bytecode cache.', templates['loads']),
+        ('microblog_template_cache_writes_total', 'counter', 'Templates compiled and written to the bytecode cache.', templates['writes']),
+    ]
+
+
+def log_stats():
+    logs = log_pipeline.stats()
+    return [
+        ('microblog_log_records_dropped_total', 'counter', 'Log records dropped because the log queue was full.', logs['dropped']),
+        ('microblog_log_records_suppressed_total', 'counter', 'Log records dropped by the rate limit.', logs['suppressed']),
+        ('microblog_log_records_sampled_out_total', 'counter', 'Log records below WARNING left out by sampling.', logs['sampled_out']),
+    ]
+
+
+# functions returning (name, type, help, value) tuples, the values they return are included in /metrics
+collectors = [cache_stats, trending_stats, archive_stats, template_stats, log_stats]
+
+
+def render():
+    'all metrics in the Prometheus text exposition format'
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    for collector in collectors:
+        for name, type, help, value in collector():
+            lines.extend(['# HELP {} {}'.format(name, help),
+                          '# TYPE {} {}'.format(name, type),
+                          '{} {}'.format(name, value)])
+    return '\n'.join(lines) + '\n'
+
+
+def request_stats():
+    'the numbers collected so far for the current request'
+    return getattr(g, 'metrics', None)
+
+
+def init_app(app):
+    'times the requests and templates of app, the SQL statements of every engine are timed by the listeners at the bottom of this module'
+    request_started.connect(start_request, app)
+    request_finished.connect(finish_request, app)
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+
+
+def start_request(sender, **extra):
+    g.metrics = {'started': time.perf_counter(), 'queries': 0, 'sql_time': 0.0,
+                 'render_time': 0.0, 'render_starts': []}
+
+
+def finish_request(sender, response, **extra):
+    stats = request_stats()
+    if stats is None:
+        return
+    duration = time.perf_counter() - stats['started']
+    endpoint = request.endpoint or 'none'
+    request_duration.observe(endpoint, duration)
+    sql_queries.observe(endpoint, stats['queries'])
+    sql_duration.observe(endpoint, stats['sql_time'])
+    render_duration.observe(endpoint, stats['render_time'])
+    budget = current_app.config['METRICS_QUERY_BUDGET']
+    if budget and stats['queries'] > budget:
+        current_app.logger.warning('%s %s ran %d SQL queries (budget %d) in %.1f ms',
+                                   request.method, request.full_path, stats['queries'],
+                                   budget, duration * 1000)
+
+
+# templates can render other templates (render_post renders _post.html inside index.html), only the outermost one is timed so that nothing is counted twice
+def start_render(sender, template, context, **extra):
+    stats = request_stats() if has_app_context() else None
+    if stats is not None:
+        stats['render_starts'].append(time.perf_counter())
+
+
+def finish_render(sender, template, context, **extra):
+    stats = request_stats() if has_app_context() else None
+    if stats is not None and stats['render_starts']:
+        started = stats['render_starts'].pop()
+        if not stats['render_starts']:
+            stats['render_time'] += time.perf_counter() - started
+
+
+# listening on the Engine class catches the statements of every engine, including any added later
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(connection, cursor, statement, parameters, context, executemany):
+    if has_app_context() and request_stats() is not None:
+        connection.info.setdefault('query_starts', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_query(connection, cursor, statement, parameters, context, executemany):
+    starts = connection.info.get('query_starts')
+    if not starts or not has_app_context():
+        return
+    stats = request_stats()
+    started = starts.pop()
+    if stats is not None:
+        stats['queries'] += 1
+        stats['sql_time'] += time.perf_counter() - started
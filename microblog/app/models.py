@@ -1,26 +1,43 @@
 from hashlib import md5
 from app import login
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from app import db
 # import UserMixin class from Flask-Login which includes generic implementations for the four required items needed by Flask-Login and are appropriate for most standard database modes
 from flask_login import UserMixin
+from sqlalchemy import bindparam, event, exists, literal, select
+from sqlalchemy.orm import make_transient_to_detached, validates
 import time
 import jwt
-from app import app
+from flask import current_app
+from app.user_cache import user_cache
+from app.passwords import password_hasher
+from app.avatars import avatar_url
 
 # Flask-Login needs application's help in loading a user. Extension expects application to configure a user loader function, that can be called to load a user given the ID
 # The user loader is registered with Flask-Login with a decorator
 @login.user_loader
 def load_user(id):
     'The ID passed to the function is going to be a string and so it needs to be converted to an int'
-    return User.query.get(int(id))
+    id = int(id)
+    # the column values of recently loaded users are cached (see app/user_cache.py), so most requests don't need to query the user at all
+    values = user_cache.get(id)
+    if values is None:
+        user = User.query.get(id)
+        if user is not None:
+            user_cache.put(id, user.cache_values())
+        return user
+    # rebuild the user from the cached values as if it had been loaded from the database, then attach it to the session without running a query, so that relationships such as user.posts still work
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
 
 # to store the relationship between followers and those who are followe, create a table that stores all os the followers
 # this table is not in a model class since it only contains foreign keys
+# the primary key stops the same follow being stored twice and is the index for the users someone follows (is_following, following counts, the timeline), the second index serves the other direction, the followers of someone (follower counts, the fan-out of new posts)
 followers = db.Table('followers',
-                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 class User(UserMixin, db.Model):
@@ -33,12 +50,24 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
     password_hash = db.Column(db.String(128))
+    # MD5 digest of the email used for the avatar, stored so that it is computed once when the email changes instead of every time an avatar is rendered
+    avatar_hash = db.Column(db.String(32))
     # this is not an actuayl database field, but a high-leel view of the relationship between users and posts
     # backref argument defines the name of a field that will be added to the objects of the "many" class that points back to the "one" object (in a "many-to-one" relationship
     posts = db.relationship('Post', backref='author', lazy='dynamic')
 
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # denormalized counters so that a profile page doesn't have to count the followers table and the posts of the user every time it is shown
+    # they are kept up to date in the same transaction as the change they count, by follow/unfollow and by count_post below, and can be recomputed with repair_counters
+    followers_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    following_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    posts_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    # the materialized timeline (see Timeline below) holds every post of the home feed newer than this, or every post when it is None
+    # a timeline only takes the latest TIMELINE_LENGTH posts of each followed user, so following someone with more posts than that moves it up to the newest of theirs left out, home_feed reads the posts before it from the post table
+    timeline_horizon = db.Column(db.DateTime)
     
     followed = db.relationship(
         # User is the right side entity of the relationship (the left side entity is the parent class). Since this is self-referential, same class if used on both sides
@@ -57,25 +86,92 @@ class User(UserMixin, db.Model):
         'Tells Python how to print objects of this class) - useful for debugging'
         return '<User {}>'.format(self.username)
 
+    def cache_values(self):
+        'the column values stored in the user cache'
+        return {attr.key: getattr(self, attr.key)
+                for attr in User.__mapper__.column_attrs}
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # hashing is slow on purpose, password_hasher runs it in a separate process with a limit on how many run at once (see app/passwords.py)
+        self.password_hash = password_hasher.hash(password)
+        # the cached copy is also dropped when the change is flushed (see invalidate_cached_user), doing it here as well means a cached copy with the old password can't be handed out before then
+        user_cache.invalidate(self.id)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check(self.password_hash, password)
 
-    def avatar(self, size):
-        'Pulls in an avatar, if registered on Gravatar, or, alternatively, generates an identicon'
+    def password_needs_rehash(self):
+        'True if the stored hash was made with older settings than PASSWORD_HASH_METHOD and PASSWORD_SALT_LENGTH'
+        return password_hasher.needs_rehash(self.password_hash)
+
+    @staticmethod
+    def email_digest(email):
         # input is an MD5 hash which is generated from lowering the email address, converting it to bytes and then passing it into the hash function
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return md5(email.lower().encode('utf-8')).hexdigest()
+
+    # validates registers the function to be called whenever email is set, so the stored digest always matches the email
+    @validates('email')
+    def validate_email(self, key, email):
+        self.avatar_hash = User.email_digest(email) if email else None
+        return email
+
+    def author_version(self):
+        'changes whenever something shown next to the posts of this user (the username or the avatar) changes, used to key the cached HTML of their posts'
+        # the avatar URL also depends on where avatars come from
+        return md5('{}\n{}\n{}'.format(self.username, self.avatar_hash,
+                                       current_app.config['AVATAR_BACKEND']).encode('utf-8')).hexdigest()
+
+    def profile_version(self):
+        'changes whenever something shown on the profile of this user changes, part of the ETag of their profile page'
+        return md5('\n'.join(str(value) for value in (
+            self.author_version(), self.about_me, self.last_seen, self.followers_count,
+            self.following_count, self.posts_count)).encode('utf-8')).hexdigest()
+
+    def avatar(self, size):
+        'URL of the avatar of this user, an identicon drawn by the site or, with AVATAR_BACKEND set to gravatar, the image registered on Gravatar (see app/avatars.py)'
+        digest = self.avatar_hash or User.email_digest(self.email)
+        return avatar_url(digest, size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.update_follow_counters(user, 1)
+            # copy the most recent posts of the newly followed user into this user's materialized timeline so they show up straight away
+            self.backfill_timeline(user)
+            Suggestion.followed(self, user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.update_follow_counters(user, -1)
+            self.prune_timeline(user)
+            Suggestion.unfollowed(self, user)
+            limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+            if db.session.query(User.followers_count).filter(User.id == user.id).scalar() == limit:
+                # user has just dropped to the limit, so their new posts are copied to the timelines again, and home_feed stops merging in the posts they wrote while they were over it. Those are copied now, like for a new follow
+                Timeline.backfill(user, select([followers.c.follower_id.label('user_id')]).where(
+                    followers.c.followed_id == user.id))
+                user_cache.clear()
+
+    def update_follow_counters(self, user, change):
+        'adds change to the following counter of self and the followers counter of user'
+        # the counters are incremented by the database rather than in Python, so two requests following at the same time can't overwrite each other's count
+        # the statements run in the session's transaction, so they are committed or rolled back together with the follow itself
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == self.id).values(
+            following_count=table.c.following_count + change))
+        db.session.execute(table.update().where(table.c.id == user.id).values(
+            followers_count=table.c.followers_count + change))
+        # these updates bypass the ORM, so the cached copies have to be dropped by hand
+        user_cache.invalidate(self.id, user.id)
+
+    def suggestions(self):
+        'the users suggested to self to follow, with the number of users self follows who follow them, best first'
+        return db.session.query(User, Suggestion.score).join(
+            Suggestion, Suggestion.candidate_id == User.id).filter(
+                Suggestion.user_id == self.id).order_by(
+                    Suggestion.score.desc(), Suggestion.candidate_id).limit(
+                        current_app.config['SUGGESTIONS_PER_USER'])
 
     def is_following(self, user):
         return self.followed.filter(
@@ -83,27 +179,80 @@ class User(UserMixin, db.Model):
 
     def followed_posts(self):
         'return timestamp ordered posts of those followed'
-        # first, create a database join, merging by the post and followers tables by the condition that the ids of those being followed by a follower matches the id of the writer of the post - this gives a table of all posts, the, who wrote them and then person who followers that person
-        # second, retrieve all the posts where the person who follows that person is self
-        # finally, order by timestamp - using .desc() orders in descending order
-        # note, handling things using database calls like this can be much more efficient than by doing it in individual steps such as: finding all the people one followers, retieveing all their blog posts and then timestamp ordering
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
-                followers.c.follower_id == self.id)
-        # also retieve all of self posts for display
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestame.desc())
-    
+        # read straight from the post table, which is the whole feed but needs to look at the posts of every followed user to find the newest
+        # the home page reads the materialized timeline instead (see timeline_posts below and home_feed in app/feeds.py)
+        followed = select([followers.c.followed_id]).where(followers.c.follower_id == self.id)
+        return Post.query.filter((Post.user_id == self.id) | Post.user_id.in_(followed)).order_by(
+            Post.timestame.desc())
+
+    def timeline_posts(self, fanout_on_read=()):
+        '''
+        The posts in the materialized timeline of self, newest first in the order of the (user_id, timestame, post_id) index, so that a page of it is a range of that index
+        When a post is written it is copied into the timeline of the author and of every follower (fan-out-on-write, see fan_out_post below). Posts of the users in fanout_on_read are left out, they are read from the post table (see home_feed in app/feeds.py)
+        '''
+        query = Post.query.join(Timeline, Timeline.post_id == Post.id).filter(
+            Timeline.user_id == self.id)
+        if self.timeline_horizon is not None:
+            # the posts before the horizon may be incomplete, they are read from the post table
+            query = query.filter(Timeline.timestame > self.timeline_horizon)
+        if fanout_on_read:
+            # their posts from before they went over the limit were copied, leaving them out means no post is shown twice
+            query = query.filter(Post.user_id.notin_(fanout_on_read))
+        return query.order_by(Timeline.timestame.desc(), Timeline.post_id.desc())
+
+    def fans_out_on_write(self):
+        'True if new posts of this user are copied to the timelines of all followers'
+        return self.followers_count <= current_app.config['TIMELINE_FANOUT_LIMIT']
+
+    def fanout_on_read_ids(self):
+        'ids of followed users with too many followers to fan out on write'
+        return [followed_id for followed_id, in db.session.query(
+            followers.c.followed_id).join(
+                User, User.id == followers.c.followed_id).filter(
+                    followers.c.follower_id == self.id,
+                    User.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT'])]
+
+    def backfill_timeline(self, user):
+        'copy the latest TIMELINE_LENGTH posts of user into the timeline of self'
+        if not user.fans_out_on_write():
+            return
+        Timeline.backfill(user, select([literal(self.id).label('user_id')]))
+        # the horizon was updated by the database, so it is read again, and the cached copy is dropped
+        db.session.expire(self, ['timeline_horizon'])
+        user_cache.invalidate(self.id)
+
+    def prune_timeline(self, user):
+        'remove all posts of user from the timeline of self'
+        db.session.execute(Timeline.__table__.delete().where(
+            (Timeline.user_id == self.id) &
+            Timeline.post_id.in_(select([Post.id]).where(Post.user_id == user.id))))
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
-            {'reset_password': self.id, 'exp': time() + expires_in},
-            app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8') # decoding necessary since wkt returns token as a byte sequence
+            {'reset_password': self.id, 'exp': time.time() + expires_in},
+            current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8') # decoding necessary since wkt returns token as a byte sequence
+
+    @staticmethod
+    def repair_counters():
+        'recomputes the follower, following and post counters of every user in a single UPDATE, returns the number of users'
+        user = User.__table__
+        user_cache.clear()
+        return db.session.execute(user.update().values(
+            followers_count=select([db.func.count()]).where(
+                followers.c.followed_id == user.c.id).as_scalar(),
+            following_count=select([db.func.count()]).where(
+                followers.c.follower_id == user.c.id).as_scalar(),
+            # archived posts still count
+            posts_count=select([db.func.count()]).where(
+                Post.__table__.c.user_id == user.c.id).as_scalar() +
+            select([db.func.count()]).where(
+                ArchivedPost.__table__.c.user_id == user.c.id).as_scalar())).rowcount
 
     # a static method means that the function can e invoked directly from the class
     @staticmethod
     def verify_reset_password_token(token):
         try:
-            id=jwt.decode(token, app.config['SECRET_KEY'],
+            id=jwt.decode(token, current_app.config['SECRET_KEY'],
                           algorithms=['HS256'])['reset_password']
         except:
             return
@@ -112,9 +261,277 @@ class User(UserMixin, db.Model):
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
-    timestame = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    timestame = db.Column(db.DateTime, default=datetime.utcnow)
     # note is it good to work with utc time as then they are alway the same for the user and will be formatted into local time whereever the user is
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    # composite indexes matching the (timestame, id) order that feeds are paginated in (see app/pagination.py), for all posts and for the posts of one user
+    # the first also serves every lookup by timestame alone, so timestame has no index of its own
+    __table_args__ = (
+        db.Index('ix_post_timestame_id', 'timestame', 'id'),
+        db.Index('ix_post_user_id_timestame_id', 'user_id', 'timestame', 'id'))
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+class ArchivedPost(db.Model):
+    '''
+    Posts older than ARCHIVE_AFTER_DAYS, moved out of post by the archive job (see app/archive.py) so that the post table and its indexes only hold the recent posts that nearly all page views read
+    The columns are those of Post and a post keeps its id when it is moved. Every archived post is older than every post left in post, which lets the feeds read the archive only once they have gone past the newest archived post
+    '''
+    __tablename__ = 'post_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestame = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    author = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_post_archive_timestame_id', 'timestame', 'id'),
+        db.Index('ix_post_archive_user_id_timestame_id', 'user_id', 'timestame', 'id'))
+
+    def __repr__(self):
+        return '<ArchivedPost {}>'.format(self.body)
+
+class Timeline(db.Model):
+    '''
+    Materialized home timeline, holding one row for every post that should appear on the home page of a user. The timestamp of the post is copied in so that a page of the timeline can be read in order straight from the (user_id, timestame) index
+    '''
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    timestame = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_timeline_user_id_timestame_post_id',
+                 'user_id', 'timestame', 'post_id'),)
+
+    def __repr__(self):
+        return '<Timeline {} {}>'.format(self.user_id, self.post_id)
+
+    @staticmethod
+    def backfill(author, readers):
+        '''
+        Copies the latest TIMELINE_LENGTH posts of author into the timelines of readers, a select of user ids labelled user_id, leaving out those a timeline already has
+        The older posts of author are not copied, so the horizon of each reader moves up to the newest of them (see User.timeline_horizon)
+        '''
+        length = current_app.config['TIMELINE_LENGTH']
+        post, timeline, user = Post.__table__, Timeline.__table__, User.__table__
+        latest = select([post.c.id, post.c.timestame]).where(post.c.user_id == author.id).order_by(
+            post.c.timestame.desc(), post.c.id.desc()).limit(length).alias('latest')
+        reader = readers.alias('reader')
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestame'],
+            select([reader.c.user_id, latest.c.id, latest.c.timestame]).where(
+                ~exists().where((timeline.c.user_id == reader.c.user_id) &
+                                (timeline.c.post_id == latest.c.id)))))
+        horizon = db.session.query(Post.timestame).filter(Post.user_id == author.id).order_by(
+            Post.timestame.desc(), Post.id.desc()).offset(length).limit(1).scalar()
+        if horizon is not None:
+            # the horizon only ever moves up, the timeline may already be missing posts of other users from before it
+            db.session.execute(user.update().where(
+                user.c.id.in_(readers) &
+                ((user.c.timeline_horizon == None) | (user.c.timeline_horizon < horizon))).values(
+                    timeline_horizon=horizon))
+
+    @staticmethod
+    def rebuild():
+        '''
+        Rebuilds every timeline from the posts and followers tables, for data that was loaded without going through the ORM
+        Like the fan-out on write, posts of users with more than TIMELINE_FANOUT_LIMIT followers are left out, and each timeline keeps the latest TIMELINE_LENGTH posts. The horizon of each user is set to the newest post left out of their timeline
+        '''
+        db.session.execute(Timeline.__table__.delete())
+        # row_number() numbers the posts of each timeline from the newest, so only the first TIMELINE_LENGTH of them are kept
+        numbered = (
+            'SELECT reader, post_id, timestame FROM ('
+            '  SELECT reader, post_id, timestame, row_number() OVER ('
+            '    PARTITION BY reader ORDER BY timestame DESC, post_id DESC) AS n FROM ('
+            '      SELECT post.user_id AS reader, post.id AS post_id, post.timestame AS timestame '
+            '      FROM post'
+            '      UNION '
+            '      SELECT followers.follower_id, post.id, post.timestame '
+            # CROSS JOIN makes SQLite walk the follow edges and look up the posts of each followed user through the index on post.user_id, rather than the other way round
+            '      FROM followers CROSS JOIN post JOIN "user" ON "user".id = followers.followed_id '
+            '      WHERE post.user_id = followers.followed_id '
+            '      AND "user".followers_count <= :limit) AS entries) AS numbered ')
+        params = {'limit': current_app.config['TIMELINE_FANOUT_LIMIT'],
+                  'length': current_app.config['TIMELINE_LENGTH']}
+        count = db.session.execute(db.text(
+            'INSERT INTO timeline (user_id, post_id, timestame) ' + numbered +
+            'WHERE n <= :length'), params).rowcount
+        horizons = db.session.execute(db.text(numbered + 'WHERE n = :length + 1').columns(
+            reader=db.Integer, post_id=db.Integer, timestame=db.DateTime), params).fetchall()
+        user = User.__table__
+        user_cache.clear()
+        db.session.execute(user.update().values(timeline_horizon=None))
+        if horizons:
+            db.session.execute(user.update().where(user.c.id == bindparam('reader')).values(
+                timeline_horizon=bindparam('horizon')),
+                [{'reader': reader, 'horizon': timestame} for reader, post_id, timestame in horizons])
+        return count
+
+class Suggestion(db.Model):
+    '''
+    Precomputed "who to follow" suggestions: candidate_id is suggested to user_id because score of the users user_id follows follow candidate_id
+    The lists are built for every user by the batch job in app/suggestions.py, which keeps the best SUGGESTIONS_PER_USER candidates of each user, and are then kept up to date by follow and unfollow with followed and unfollowed below
+    '''
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    candidate_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_suggestion_user_id_score', 'user_id', 'score'),)
+
+    def __repr__(self):
+        return '<Suggestion {} {}>'.format(self.user_id, self.candidate_id)
+
+    # the statements below only touch the suggestion rows of the users whose counts change, and run in the transaction of the follow or unfollow
+    # they are written to give the same result whether or not the follow row itself has been flushed yet
+
+    @staticmethod
+    def followed(follower, user):
+        '''
+        follower just followed user: user is no longer a suggestion for follower, everyone user follows is followed by one more of follower's follows, and user is followed by one more of the follows of each of follower's followers
+        A candidate that wasn't in follower's list is added with a score of 1, which may be lower than their actual score when they had been left out of the list, the next rebuild puts that right. user is added to the lists of follower's followers that don't have them yet with their actual score
+        '''
+        table = Suggestion.__table__
+        db.session.execute(table.delete().where(
+            (table.c.user_id == follower.id) & (table.c.candidate_id == user.id)))
+        followed_by_user = select([followers.c.followed_id]).where(
+            followers.c.follower_id == user.id)
+        db.session.execute(table.update().where(
+            (table.c.user_id == follower.id) &
+            table.c.candidate_id.in_(followed_by_user)).values(score=table.c.score + 1))
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'candidate_id', 'score'],
+            select([literal(follower.id), followers.c.followed_id, literal(1)]).where(
+                (followers.c.follower_id == user.id) &
+                (followers.c.followed_id != follower.id) &
+                followers.c.followed_id.notin_(select([followers.c.followed_id]).where(
+                    followers.c.follower_id == follower.id)) &
+                followers.c.followed_id.notin_(select([table.c.candidate_id]).where(
+                    table.c.user_id == follower.id)))))
+        Suggestion.trim(follower)
+        followers_of_follower = select([followers.c.follower_id]).where(
+            followers.c.followed_id == follower.id)
+        db.session.execute(table.update().where(
+            (table.c.candidate_id == user.id) &
+            table.c.user_id.in_(followers_of_follower)).values(score=table.c.score + 1))
+        # adding user to the list of every follower of a popular user would write a row for each of them, so like the fan-out on write this stops at TIMELINE_FANOUT_LIMIT followers, the next rebuild adds the rest
+        if follower.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+            return
+        # the followers of follower that don't have user in their lists yet get them with the number of their follows who follow user: follower, and those of the others who do
+        reader, via, back = followers.alias(), followers.alias(), followers.alias()
+        score = select([db.func.count()]).where(
+            (via.c.follower_id == reader.c.follower_id) & (via.c.followed_id != follower.id) &
+            (back.c.follower_id == via.c.followed_id) &
+            (back.c.followed_id == user.id)).as_scalar() + 1
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'candidate_id', 'score'],
+            select([reader.c.follower_id, literal(user.id), score]).where(
+                (reader.c.followed_id == follower.id) &
+                (reader.c.follower_id != user.id) &
+                ~exists().where((via.c.follower_id == reader.c.follower_id) &
+                                (via.c.followed_id == user.id)) &
+                ~exists().where((table.c.user_id == reader.c.follower_id) &
+                                (table.c.candidate_id == user.id)))))
+        Suggestion.trim_all(followers_of_follower)
+
+    @staticmethod
+    def unfollowed(follower, user):
+        'follower just unfollowed user, the reverse of followed: the counts go down by one and user may now be suggested to follower'
+        table = Suggestion.__table__
+        followed_by_user = select([followers.c.followed_id]).where(
+            followers.c.follower_id == user.id)
+        db.session.execute(table.update().where(
+            (table.c.user_id == follower.id) &
+            table.c.candidate_id.in_(followed_by_user)).values(score=table.c.score - 1))
+        followers_of_follower = select([followers.c.follower_id]).where(
+            followers.c.followed_id == follower.id)
+        db.session.execute(table.update().where(
+            (table.c.candidate_id == user.id) &
+            table.c.user_id.in_(followers_of_follower)).values(score=table.c.score - 1))
+        # candidates that no follow leads to any more are dropped, both deletes go through the primary key like the updates
+        db.session.execute(table.delete().where(
+            (table.c.user_id == follower.id) & (table.c.score <= 0)))
+        db.session.execute(table.delete().where(
+            (table.c.candidate_id == user.id) & table.c.user_id.in_(followers_of_follower) &
+            (table.c.score <= 0)))
+        # how many of the users follower still follows follow user, counted through the follows of follower so that only their rows are read
+        via, back = followers.alias(), followers.alias()
+        score = db.session.scalar(select([db.func.count()]).where(
+            (via.c.follower_id == follower.id) &
+            (back.c.follower_id == via.c.followed_id) &
+            (back.c.followed_id == user.id)))
+        if score:
+            db.session.execute(table.delete().where(
+                (table.c.user_id == follower.id) & (table.c.candidate_id == user.id)))
+            db.session.execute(table.insert().values(
+                user_id=follower.id, candidate_id=user.id, score=score))
+            Suggestion.trim(follower)
+
+    @staticmethod
+    def trim(user):
+        'drops all but the best SUGGESTIONS_PER_USER suggestions of user'
+        table = Suggestion.__table__
+        best = select([table.c.candidate_id]).where(table.c.user_id == user.id).order_by(
+            table.c.score.desc(), table.c.candidate_id).limit(
+                current_app.config['SUGGESTIONS_PER_USER'])
+        db.session.execute(table.delete().where(
+            (table.c.user_id == user.id) & table.c.candidate_id.notin_(best)))
+
+    @staticmethod
+    def trim_all(users):
+        'trim for every user in users, a select of user ids, in one statement'
+        table = Suggestion.__table__
+        kept = table.alias()
+        best = select([kept.c.candidate_id]).where(kept.c.user_id == table.c.user_id).order_by(
+            kept.c.score.desc(), kept.c.candidate_id).limit(
+                current_app.config['SUGGESTIONS_PER_USER'])
+        db.session.execute(table.delete().where(
+            table.c.user_id.in_(users) & table.c.candidate_id.notin_(best)))
+
+class TrendingPost(db.Model):
+    '''
+    Snapshot of the trending posts, written as a whole by the job in app/trending.py. rank numbers the posts from 1, so a page of the trending feed is a range of the primary key
+    '''
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    # when the snapshot was computed, the same for every row
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<TrendingPost {} {}>'.format(self.rank, self.post_id)
+
+# the fan-out runs as part of the same flush that inserts the post, so every way of creating a post (the index view, the shell, tests) keeps the timelines up to date
+@event.listens_for(Post, 'after_insert')
+def fan_out_post(mapper, connection, post):
+    timeline = Timeline.__table__
+    post_table = Post.__table__
+    columns = ['user_id', 'post_id', 'timestame']
+    # the author always sees their own post
+    connection.execute(timeline.insert().from_select(columns, select(
+        [post_table.c.user_id, post_table.c.id, post_table.c.timestame]).where(
+            post_table.c.id == post.id)))
+    user = User.__table__
+    followers_count = connection.scalar(select([user.c.followers_count]).where(
+        user.c.id == post.user_id))
+    if followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+        # too many followers to copy the post to, home_feed merges it in at read time instead
+        return
+    connection.execute(timeline.insert().from_select(columns, select(
+        [followers.c.follower_id, post_table.c.id, post_table.c.timestame]).where(
+            (post_table.c.id == post.id) &
+            (followers.c.followed_id == post_table.c.user_id))))
+
+@event.listens_for(Post, 'after_insert')
+def count_post(mapper, connection, post):
+    user = User.__table__
+    connection.execute(user.update().where(user.c.id == post.user_id).values(
+        posts_count=user.c.posts_count + 1))
+    user_cache.invalidate(post.user_id)
+
+# any change to a user made through the ORM (edit_profile, set_password, reset_password) drops the cached copy of that user
+@event.listens_for(User, 'after_update')
+def invalidate_cached_user(mapper, connection, user):
+    user_cache.invalidate(user.id)
@@ -0,0 +1,228 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import namedtuple
+from datetime import datetime
+from flask import request, url_for, abort, current_app
+from sqlalchemy import select, union_all
+from app import db
+
+# keyset (cursor) pagination: instead of asking the database to skip the first (page - 1) * POSTS_PER_PAGE rows with OFFSET, which gets slower the deeper the page, every page starts right after the last post of the page before it
+# posts are ordered by (timestame, id) so that posts written in the same microsecond still have a stable order, and the (timestame, id) indexes on post let the database jump straight to the start of the page
+# a feed can be split into partitions, queries of posts that are each older than the one before, e.g. the recent posts in post and the old ones in post_archive (see app/archive.py): the partitions are read as if they were one query, and the archive is only queried once a page goes past the end of the recent posts
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# where a post is in a feed: its (timestame, id) and the index of the partition it is in, 0 for the first (the recent posts)
+Key = namedtuple('Key', 'timestame id partition')
+Key.__new__.__defaults__ = (0,)
+
+# a query of posts with the two columns it is ordered and paged by, the (timestame, id) of the post itself unless the posts are read through another table, e.g. the timeline, whose copies of them are in the order of its index (see home_feed in app/feeds.py)
+Source = namedtuple('Source', 'query timestame id')
+
+
+def encode_cursor(direction, post, partition=0):
+    '''
+    Builds the opaque token handed to the client in next_url/prev_url. direction is 'a' for posts after (older than) the given post and 'b' for posts before (newer than) it
+    The partition of the post is only added when it isn't the first, so tokens within the recent posts are the same as before feeds had partitions
+    '''
+    raw = '{}|{}|{}'.format(direction, post.timestame.strftime(CURSOR_TIME_FORMAT), post.id)
+    if partition:
+        raw += '|{}'.format(partition)
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    'returns (direction, Key) or aborts with 400 for a token that was not built by encode_cursor'
+    try:
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        direction, timestame, id, *partition = raw.split('|')
+        if direction not in ('a', 'b') or len(partition) > 1:
+            raise ValueError(direction)
+        partition = int(partition[0]) if partition else 0
+        if partition < 0:
+            raise ValueError(partition)
+        return direction, Key(datetime.strptime(timestame, CURSOR_TIME_FORMAT), int(id), partition)
+    except (ValueError, TypeError):
+        abort(400)
+
+
+class KeysetPage(object):
+    'one page of posts, with the cursors needed to link to the pages on either side of it'
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def source(query):
+    'the Source of a query of posts (of Post or ArchivedPost), paged by the columns of the post itself. A Source is returned as it is'
+    if isinstance(query, Source):
+        return query
+    model = query.column_descriptions[0]['entity']
+    return Source(query, model.timestame, model.id)
+
+
+def find_key(partitions, id):
+    'the Key of the post with id in the feed made of partitions (see fetch_posts), with the index of the partition that holds it, None if it isn\'t in the feed'
+    for index, partition in enumerate(partitions):
+        for part in partition if isinstance(partition, list) else [partition]:
+            part = source(part)
+            post = part.query.order_by(None).filter(part.id == id).first()
+            if post is not None:
+                return Key(post.timestame, post.id, index)
+    return None
+
+
+def older_than(source, timestame, id):
+    'limits the query of source to the posts that come after (timestame, id) in newest first order'
+    # the first condition is implied by the second, it is there so that the database seeks to (timestame, id) in the index instead of reading the index from the newest post down to it
+    return source.query.filter(source.timestame <= timestame).filter(
+        (source.timestame < timestame) | (source.id < id))
+
+
+def newer_than(source, timestame, id):
+    'limits the query of source to the posts that come before (timestame, id) in newest first order'
+    return source.query.filter(source.timestame >= timestame).filter(
+        (source.timestame > timestame) | (source.id > id))
+
+
+def fetch_source(source, limit, older=None, newer=None, ascending=False):
+    'up to limit posts of source that come after older and before newer, newest first or, with ascending, oldest first'
+    source = source._replace(query=source.query.order_by(None))
+    if older is not None:
+        source = source._replace(query=older_than(source, older.timestame, older.id))
+    if newer is not None:
+        source = source._replace(query=newer_than(source, newer.timestame, newer.id))
+    if ascending:
+        order = (source.timestame.asc(), source.id.asc())
+    else:
+        order = (source.timestame.desc(), source.id.desc())
+    return source.query.order_by(*order).limit(limit).all()
+
+
+def fetch_posts(partitions, limit, older=None, newer=None):
+    '''
+    Reads up to limit posts from partitions, a list of feeds of posts each older than the one before, as if they were one query ordered by (timestame, id)
+    A partition is a query of posts, a Source, or a list of those whose posts are interleaved in time, e.g. the timeline and the posts of popular users merged in when it is read, which are merged here
+    Only posts that come after the Key older and before the Key newer are read. Without newer the posts are returned newest first from older on, with newer they are the posts right after newer, oldest first
+    Returns a list of (partition, post) pairs. A partition is only queried when those read before it didn't fill the limit, and the partitions outside of older and newer are never queried
+    '''
+    first = older.partition if older is not None else 0
+    last = newer.partition if newer is not None else len(partitions) - 1
+    indexes = range(first, min(last, len(partitions) - 1) + 1)
+    if newer is not None:
+        indexes = reversed(indexes)
+    rows = []
+    for index in indexes:
+        partition = partitions[index]
+        sources = [source(part) for part in partition] if isinstance(partition, list) \
+            else [source(partition)]
+        # the partitions after the one a bound came from hold only posts past it anyway, the bound is applied to them as well so that a post that moved to another partition since the cursor was handed out (e.g. behind the horizon of a timeline) isn't shown twice
+        bounds = {'older': older, 'newer': newer, 'ascending': newer is not None}
+        wanted = limit - len(rows)
+        posts = []
+        for part in sources:
+            posts.extend(fetch_source(part, wanted, **bounds))
+        if len(sources) > 1:
+            # each source is read in order through an index of its own, the first posts of all of them together are the first of the partition
+            posts.sort(key=lambda post: (post.timestame, post.id), reverse=newer is None)
+            posts = posts[:wanted]
+        rows.extend((index, post) for post in posts)
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def keyset_paginate(feed, cursor, per_page):
+    '''
+    Returns the KeysetPage of feed that follows cursor (or the first page if cursor is None)
+    feed is a query of posts or a list of partitions (see fetch_posts), e.g. the recent posts followed by the archived ones. Any ordering the queries already have is replaced by (timestame, id) descending
+    '''
+    partitions = feed if isinstance(feed, list) else [feed]
+    if cursor is None:
+        direction, key = 'a', None
+    else:
+        direction, key = decode_cursor(cursor)
+        if key.partition >= len(partitions):
+            abort(400)
+    # fetching one row more than needed tells whether there is another page in this direction without running a COUNT
+    if direction == 'a':
+        rows = fetch_posts(partitions, per_page + 1, older=key)
+    else:
+        # newer posts are fetched closest first and flipped back into newest first order below
+        rows = fetch_posts(partitions, per_page + 1, newer=key)
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'b':
+        rows.reverse()
+    if not rows:
+        return KeysetPage([])
+    if direction == 'a':
+        has_next, has_prev = more, cursor is not None
+    else:
+        has_next, has_prev = True, more
+    next_cursor = encode_cursor('a', rows[-1][1], rows[-1][0]) if has_next else None
+    prev_cursor = encode_cursor('b', rows[0][1], rows[0][0]) if has_prev else None
+    return KeysetPage([post for partition, post in rows], next_cursor, prev_cursor)
+
+
+def key_at(partitions, position):
+    '''
+    The Key of the post at position (from 0, newest first) in the feed made of partitions, None if the feed is shorter
+    Only the (timestame, id) columns of the partitions are read, through an OFFSET in each partition, and partitions that end before position are skipped by their count
+    '''
+    for index, partition in enumerate(partitions):
+        sources = [source(part) for part in partition] if isinstance(partition, list) \
+            else [source(partition)]
+        keys = [part.query.order_by(None).with_entities(
+            part.timestame.label('timestame'), part.id.label('id')).statement for part in sources]
+        keys = (union_all(*keys) if len(keys) > 1 else keys[0]).alias('keys')
+        row = db.session.execute(select([keys.c.timestame, keys.c.id]).order_by(
+            keys.c.timestame.desc(), keys.c.id.desc()).offset(position).limit(1)).first()
+        if row is not None:
+            return Key(row.timestame, row.id, index)
+        position -= db.session.scalar(select([db.func.count()]).select_from(keys))
+    return None
+
+
+def offset_page(feed, page, per_page):
+    'page number page of feed, as (posts, has_next), for the old ?page= links'
+    if not isinstance(feed, list):
+        posts = feed.paginate(page, per_page, False)
+        return posts.items, posts.has_next
+    # a feed of several partitions has no single query to give an OFFSET to, so the last post before the page is found by key_at and the page is read from there like a cursor page, without loading the posts before it
+    older = None
+    if page > 1:
+        older = key_at(feed, (page - 1) * per_page - 1)
+        if older is None:
+            return [], False
+    posts = [post for partition, post in fetch_posts(feed, per_page + 1, older=older)]
+    return posts[:per_page], len(posts) > per_page
+
+
+def paginate_posts(feed, endpoint, **values):
+    '''
+    Paginates feed, a query of posts or a list of partitions (see fetch_posts), for a view and returns (posts, next_url, prev_url)
+    Pages are addressed with ?cursor= tokens. The old ?page= numbers are still understood so existing links keep working, in which case the links stay page numbers
+    '''
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if 'page' in request.args and 'cursor' not in request.args:
+        page = max(request.args.get('page', 1, type=int), 1)
+        posts, has_next = offset_page(feed, page, per_page)
+        next_url = url_for(endpoint, page=page + 1, **values) if has_next else None
+        prev_url = url_for(endpoint, page=page - 1, **values) if page > 1 else None
+        return posts, next_url, prev_url
+    posts = keyset_paginate(feed, request.args.get('cursor'), per_page)
+    next_url = url_for(endpoint, cursor=posts.next_cursor, **values) \
+        if posts.has_next else None
+    prev_url = url_for(endpoint, cursor=posts.prev_cursor, **values) \
+        if posts.has_prev else None
+    return posts.items, next_url, prev_url
@@ -0,0 +1,103 @@
+import atexit
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash, \
+    DEFAULT_PBKDF2_ITERATIONS
+from flask import current_app
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    'raised when too many passwords are already waiting to be hashed, Flask answers it with a 503'
+    description = 'Too many sign-ins at once, please try again in a moment.'
+
+
+def timed_call(function, *args):
+    'runs in the pool, returns the result together with the time the pool started on it'
+    return time.time(), function(*args)
+
+
+class PasswordHasher(object):
+    '''
+    Runs the deliberately slow password hashing functions in a pool of PASSWORD_HASH_WORKERS processes, so that a burst of logins can't take every CPU away from the rest of the site (0 workers hashes in the calling thread)
+    At most PASSWORD_HASH_MAX_PENDING hashes are queued or running at once, a caller that can't get a place within PASSWORD_HASH_QUEUE_TIMEOUT seconds gets a PasswordHasherBusy error
+    stats() reports how long hashes waited in the queue and how long they took to compute
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.slots = None
+        self.calls = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.compute_time = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.slots is None:
+                self.slots = threading.BoundedSemaphore(current_app.config['PASSWORD_HASH_MAX_PENDING'])
+                if current_app.config['PASSWORD_HASH_WORKERS'] > 0:
+                    # the pool is created on first use, so pre-fork servers give each worker process a pool of its own
+                    self.pool = ProcessPoolExecutor(current_app.config['PASSWORD_HASH_WORKERS'])
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+            self.pool = None
+            self.slots = None
+
+    def run(self, function, *args):
+        self.start()
+        if not self.slots.acquire(timeout=current_app.config['PASSWORD_HASH_QUEUE_TIMEOUT']):
+            with self.lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+        try:
+            submitted = time.time()
+            if self.pool is None:
+                started, result = timed_call(function, *args)
+            else:
+                started, result = self.pool.submit(timed_call, function, *args).result()
+            finished = time.time()
+        finally:
+            self.slots.release()
+        with self.lock:
+            self.calls += 1
+            self.queue_time += started - submitted
+            self.max_queue_time = max(self.max_queue_time, started - submitted)
+            self.compute_time += finished - started
+        return result
+
+    def method(self):
+        'the configured method, with the number of iterations spelled out the way werkzeug stores it'
+        method = current_app.config['PASSWORD_HASH_METHOD']
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            method += ':{}'.format(DEFAULT_PBKDF2_ITERATIONS)
+        return method
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method(),
+                        current_app.config['PASSWORD_SALT_LENGTH'])
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        'True if password_hash was made with another method, cost or salt length than the configured ones'
+        method, _, rest = password_hash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != self.method() or len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'rejected': self.rejected,
+                    'queue_time': self.queue_time, 'max_queue_time': self.max_queue_time,
+                    'compute_time': self.compute_time}
+
+
+password_hasher = PasswordHasher()
+atexit.register(password_hasher.shutdown)
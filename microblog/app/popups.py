@@ -0,0 +1,33 @@
+from flask import render_template
+from app.models import User
+from app.user_cache import UserCache
+
+# hover cards for the authors on a page: the page asks for the cards of all its authors in one request (see user_popups in app/routes.py), and the cards are loaded with one query for all the users that are not cached
+# the follower, following and post counts are columns of user (see User.followers_count), so a card needs nothing but the user row
+
+
+class PopupCache(UserCache):
+    'the rendered cards by username, each kept for POPUP_CACHE_TTL seconds, so a card can be up to that much behind the profile'
+
+    size_setting = 'POPUP_CACHE_SIZE'
+    ttl_setting = 'POPUP_CACHE_TTL'
+
+
+popup_cache = PopupCache()
+
+
+def render_popups(usernames):
+    'a dict of the HTML card of each of usernames, usernames of no user are left out'
+    cards = {}
+    missing = []
+    for username in usernames:
+        html = popup_cache.get(username)
+        if html is None:
+            missing.append(username)
+        else:
+            cards[username] = html
+    if missing:
+        for user in User.query.filter(User.username.in_(missing)):
+            html = cards[user.username] = render_template('user_popup.html', user=user)
+            popup_cache.put(user.username, html)
+    return cards
@@ -1,17 +1,33 @@
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request
+import hmac
+from flask import Blueprint, render_template, flash, redirect, url_for, request, g, current_app, \
+    Response, stream_with_context, send_file, abort, jsonify
 from werkzeug.urls import url_parse
-from app import app, db
-from app.forms import LoginForm, RegistrationForm, EditProfileForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm
+from app import db
+from app.forms import LoginForm, RegistrationForm, EditProfileForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm, SearchForm
 from app.email import send_password_reset_email
 from flask_login import current_user, login_user, logout_user, login_required
 from app.models import User, Post
+from app.pagination import paginate_posts
+from app.feeds import home_feed, explore_feed, trending_feed, user_feed, newest_post, \
+    explore_archive, user_archive
+from app.conditional import conditional_page
+from app.last_seen import tracker as last_seen_tracker, flush_job as last_seen_flush_job
+from app.search import search as post_search
+from app import metrics
+from app import export as exports
+from app import trending
+from app import archive
+from app.avatars import avatar_cache
+from app.popups import render_popups
+
+# the pages are registered on a blueprint, which create_app registers on the application, so the endpoints are named main.index, main.login, ...
+bp = Blueprint('main', __name__)
 
 # decorators modify function that follows it
 # here the decorators create an association between the URL and the function
 
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/index', methods=['GET', 'POST'])
 # in order to require login to view page, use login_required decorator
 # redirects to the location assigned in app/__init__.py to the login.login_required function
 # in the case of navigating to /index, this makes the complete URL: /login?next=/index, where next indicated where to go after login
@@ -20,34 +36,30 @@ def index():
     form = PostForm()
     if form.validate_on_submit():
         post = Post(body=form.post.data, author=current_user)
+        # on commit the post is also copied into the materialized timelines of the author and their followers (see fan_out_post in app/models.py)
         db.session.add(post)
         db.session.commit()
         flash('Your post is now live!')
         # but in redirect as otherwise have to deal with how browsers handle refreshes
         # refershes can ask the user if they wish to resibmit the form if a post request with a form submission returns a regular response
         # if using a redirect, the browser is then instructed to send a get request once the form is submitted to grab the page indicated in the redirect, now the last request is not a post and the refresh command works in a more predictable way
-        return redirect(url_for('index'))
-    page = request.args.get('page', 1, type=int)
-    # using pagination Flask-SQLAlchemy will execute the pagiation class which will limit the number of pages displayed
-    # in the thrid flag, if passed True, when an out of range page is requests a 404 error will be returned to the client, if False then an empty list will be returned for out of range pages
-    posts = current_user.followed_posts().paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    # pagination has attributes to find the number of the next and previous pages of results (next_num and prev_num respectively) and the existance of previous and next pages can be checked using has_next and has_prev respectively
-    # note: when using the url_for function, can add any keyword arguments to it and if the names of those arguments are note references in the URL directly, then Flask will include them in the URL query arguments
-    next_url = url_for('index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('index', page=posts.prev_num) if posts.has_prev else None
+        return redirect(url_for('main.index'))
+    # paginate_posts pages through the posts with a cursor on (timestame, id) rather than a page number, so every page is equally cheap to fetch however far back it is, and posts don't shift between pages when new ones arrive
+    # the cursors of the neighbouring pages are returned as ready made URLs (None if there is no such page), note: when using the url_for function, can add any keyword arguments to it and if the names of those arguments are note references in the URL directly, then Flask will include them in the URL query arguments
+    # the posts moved to the archive (see app/archive.py) follow on from the recent ones, and are only read once a page gets past them
+    posts, next_url, prev_url = paginate_posts(home_feed(current_user), 'main.index')
     # using the render_template functino that comes with Jinja2 in Flask
     # note the template file must be in the ./template directory which is not passed here
-    return render_template('index.html', title='Home', posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    return render_template('index.html', title='Home', posts=posts, form=form, next_url=next_url, prev_url=prev_url)
 
 # add methods attribute to highlight how function now accepts GET and POST requirests
 # GET requests return information to the client
 # POST requests are typically used when the client submits form data to the server
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     # In case user who is already logged in tries to go back to login page redirct to index
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = LoginForm()
 
     # when browser sends GET request to recieve web page with form, validate_on_submit is False
@@ -61,28 +73,32 @@ def login():
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+        # the password is only known at login, so this is when a hash made with an older method or cost is replaced by one made with the current settings
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         # request.args presentes content of the information the client sent as a dictionary
         next_page = request.args.get('next')
         # check if next_page has a value, or if ir does have a value, that the page is relative and not absoluted
         # not allowing absolute paths makes the site more secure as an attacker could input a malicious site in the next argument
         if not next_page or url_parse(next_page).netloc != '':
-            next_page = url_for('index')
+            next_page = url_for('main.index')
         # else return to the next_page
         return redirect(next_page)
         # flash shows message to the user
     return render_template('login.html', title='Sign In', form=form)
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = RegistrationForm()
     if form.validate_on_submit():
         user = User(username=form.username.data, email=form.email.data)
@@ -90,34 +106,58 @@ def register():
         db.session.add(user)
         db.session.commit()
         flash('Congratulations, you are now a registered user!')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('register.html', title='Register', form=form)
 
 # when a route has a dynamic component, Flask will accept any test in that portion of the URL, and will invoke the view function with the actual text as an argument               
-@app.route('/user/<username>')
+@bp.route('/user/<username>')
 @login_required
+# pages that only read are served from a read replica when there is one (see app/database.py)
+@db.read_only
 def user(username):
     # useing first_or_404 saves having to check if the query returned a usere in order to find ot if the user exists as if returns None then show 404
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestame.desc()).paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+    newest = newest_post(user)
+
+    def render():
+        posts, next_url, prev_url = paginate_posts(
+            [user_feed(user), user_archive(user)], 'main.user', username=user.username)
+        return render_template('user.html', user=user, posts=posts,
+                               next_url=next_url, prev_url=prev_url)
+    # the page only changes with the profile and the newest post of the user, when neither has changed since the client's copy it gets a 304 and nothing is queried or rendered (see app/conditional.py)
+    return conditional_page(render, user.profile_version(), newest)
 
 # before_request decorator regusters view funcytion to be used before any view function in an application
-@app.before_request
+@bp.before_app_request
 def before_request():
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        # no ned to have db/session.add() before commit as referencing current_user, Flask-Login will invoke the user loader callback function, which wil run a database query that will put the target user in the database session, so you can add the user again in this function, but it is not necessary becuase it is already there
-        db.session.commit()
+    # static files don't count as activity, and skipping them saves loading the user for every stylesheet and script
+    if request.endpoint != 'static' and current_user.is_authenticated:
+        # rather than setting current_user.last_seen and committing on every request, the tracker keeps the time in memory and writes the times of many users in one go every so often (see app/last_seen.py)
+        last_seen_tracker.seen(current_user)
+        # the trending, archive and last_seen jobs run in a thread of every worker, they are started here rather than by create_app so that a pre-fork server doesn't start them in the parent process
+        trending.trending_job.start()
+        archive.archive_job.start()
+        last_seen_flush_job.start()
+        # the search box is part of the navigation bar of every page, g keeps the form for the length of the request so that base.html can render it
+        if post_search.enabled:
+            g.search_form = SearchForm()
 
-@app.route('/edit_profile', methods=['GET', 'POST'])
+# downloads of all the posts or follows of the logged in user, e.g. /export/posts.csv or /export/follows.ndjson.gz for a gzipped file
+@bp.route('/export/<any(posts, follows):kind>.<any(ndjson, csv):format>',
+          defaults={'compress': False})
+@bp.route('/export/<any(posts, follows):kind>.<any(ndjson, csv):format>.gz',
+          defaults={'compress': True})
+@login_required
+def export(kind, format, compress):
+    # the file is written as it is read from the database (see app/export.py), stream_with_context keeps the request, and with it the database session, around until the last row has been sent
+    user = current_user._get_current_object()
+    response = Response(stream_with_context(exports.export(user, kind, format, compress)),
+                        mimetype=exports.mimetype(format, compress))
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        exports.filename(user, kind, format, compress))
+    return response
+
+@bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     # pass current_user.username to form as this will be used to check if username change is actually a change or the same before raising duplication error
@@ -126,9 +166,10 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
+        # committing the change also drops the copy of the user kept by load_user (see invalidate_cached_user in app/models.py)
         db.session.commit()
         flash('Your changes have been saved.')
-        return redirect(url_for('edit_profile'))
+        return redirect(url_for('main.edit_profile'))
     # if form is being requested with a GET requiest, wan to pre-populate the fields with the data that is stored in the databse
     # by checking request.method, it will be GET for the initial request, and POST for a submission and therefore will separate some errors
     elif request.method == 'GET':
@@ -137,56 +178,86 @@ def edit_profile():
     return render_template('edit_profile.html', title='Edit Profile',
                            form=form)
 
-@app.route('/follow/<username>')
+@bp.route('/follow/<username>')
 @login_required
 def follow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash('User {} not found.'.format(username))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     if user == current_user:
         flash('You cannot follow yourself!')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
     flash('You are following {}!'.format(username))
-    return redirect(url_for('user', username=username))
+    return redirect(url_for('main.user', username=username))
 
-@app.route('/unfollow/<username>')
+@bp.route('/unfollow/<username>')
 @login_required
 def unfollow(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash('User {} not found.'.format(username))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if user == current_user:
         flash('You cannot unfollow yourself!')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     current_user.unfollow(user)
     db.session.commit()
     flash('You are not following {}.'.format(username))
-    return redirect(url_for('user', username=username))
+    return redirect(url_for('main.user', username=username))
 
-@app.route('/explore')
+@bp.route('/explore')
 @login_required
+@db.read_only
 def explore():
-    # using request.args.get gets the value of the argument in the URL, e.g. .../index?page=1, if no page given then default to 1
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestame.desc()).paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    # since this page will look a lot like the index page, use the index page as a template to render, but do not want the blog post form and so do not pass this argument
-    return render_template("index.html", title='Explore', posts=posts.items,
-                          next_url=next_url, prev_url=prev_url)
-
-@app.route('/reset_password_request', methods=['GET', 'POST'])
+    # ?mode=trending ranks recent posts instead of showing them all newest first
+    if request.args.get('mode') == 'trending':
+        return explore_trending()
+    newest = newest_post()
+
+    def render():
+        # paginate_posts reads the cursor from the URL, e.g. .../explore?cursor=..., if no cursor is given then the first page is returned
+        posts, next_url, prev_url = paginate_posts([explore_feed(), explore_archive()],
+                                                   'main.explore')
+        # since this page will look a lot like the index page, use the index page as a template to render, but do not want the blog post form and so do not pass this argument
+        return render_template("index.html", title='Explore', mode='latest', posts=posts,
+                               next_url=next_url, prev_url=prev_url)
+    # the page is only rendered again once there is a newer post than in the client's copy
+    return conditional_page(render, newest)
+
+def explore_trending():
+    # the posts come straight from the snapshot the trending job writes (see app/trending.py), a page is a range of ranks
+    computed_at = trending.computed_at()
+
+    def render():
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = current_app.config['POSTS_PER_PAGE']
+        # one post more than the page tells whether there is a next page
+        posts = trending_feed((page - 1) * per_page, per_page + 1).all()
+        next_url = url_for('main.explore', mode='trending', page=page + 1) \
+            if len(posts) > per_page else None
+        prev_url = url_for('main.explore', mode='trending', page=page - 1) \
+            if page > 1 else None
+        return render_template('index.html', title='Trending', mode='trending',
+                               posts=posts[:per_page], next_url=next_url, prev_url=prev_url)
+    # the page only changes when a new snapshot is written
+    return conditional_page(render, 'trending', computed_at)
+
+# users to follow, read from the lists the batch job in app/suggestions.py precomputes for every user
+@bp.route('/suggestions')
+@login_required
+@db.read_only
+def suggestions():
+    return render_template('suggestions.html', title='Who to follow',
+                           suggestions=current_user.suggestions().all())
+
+@bp.route('/reset_password_request', methods=['GET', 'POST'])
 def reset_password_request():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = ResetPasswordRequestForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
@@ -194,27 +265,84 @@ def reset_password_request():
             send_password_reset_email(user)
         # note: flash message about checking email even if it is not found in the database, thus ensuring one cannot query the database for email addresses available
         flash('Check your email for the instructions to reset your password')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('reset_password_request.html',
                            title='Reset Password', form=form)
 
-@app.route('/reset_password/<token>', methods=['GET', 'POST'])
+@bp.route('/reset_password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     user = User.verify_reset_password_token(token)
     if not user:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
         flash('Your password has been reset.')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('reset_password.html', form=form)
 
-@app.route('/user/<username>/popup')
+@bp.route('/user/<username>/popup')
 @login_required
+@db.read_only
 def user_popup(username):
     user = User.query.filter_by(username=username).first_or_404()
-    return render_template('user_popup.html', user=user)
+    return conditional_page(lambda: render_template('user_popup.html', user=user),
+                            user.profile_version())
+
+# the hover cards of several users in one request, e.g. /popups?username=john&username=susan, which base.html asks for with the names of all the authors on the page
+@bp.route('/popups')
+@login_required
+@db.read_only
+def user_popups():
+    # the same name twice is only looked up once
+    usernames = list(dict.fromkeys(request.args.getlist('username')))
+    if len(usernames) > current_app.config['POPUP_BATCH_SIZE']:
+        abort(400)
+    response = jsonify(popups=render_popups(usernames))
+    # the browser can reuse the cards for as long as they are cached here
+    response.headers['Cache-Control'] = 'private, max-age={}'.format(
+        current_app.config['POPUP_CACHE_TTL'])
+    return response
+
+@bp.route('/search')
+@login_required
+def search():
+    if not post_search.enabled or not g.search_form.validate():
+        return redirect(url_for('main.explore'))
+    # results are ordered by how well they match rather than by time, so this page uses page numbers instead of the cursors of the other feeds
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    posts, total = post_search.query(g.search_form.q.data, page, per_page)
+    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
+        if total > page * per_page else None
+    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
+        if page > 1 else None
+    return render_template('search.html', title='Search', posts=posts,
+                           total=total, next_url=next_url, prev_url=prev_url)
+
+
+# the identicons of app/avatars.py, e.g. /avatar/<md5 of the email>/70.png?v=1
+# the URL names everything the image depends on, so browsers and proxies may keep it for a year without asking again
+@bp.route('/avatar/<string(length=32):digest>/<int:size>.png')
+def avatar(digest, size):
+    if size not in current_app.config['AVATAR_SIZES'] or \
+            digest.strip('0123456789abcdef'):
+        abort(404)
+    response = send_file(avatar_cache.path(digest, size), mimetype='image/png', conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# Prometheus scrapes this page, the numbers are those of the worker process that answers (see app/metrics.py)
+# the numbers tell how the site is used, so the page is only served to a scraper that sends METRICS_TOKEN as its bearer token (bearer_token in the scrape config), and not at all while no token is set
+@bp.route('/metrics')
+def prometheus_metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return 'Unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -0,0 +1,142 @@
+from sqlalchemy import event, text
+from sqlalchemy.orm import joinedload
+from flask import current_app
+from app import db
+from app.models import Post, ArchivedPost
+from app.feeds import with_authors
+
+# full-text search over the body of posts
+# the search index lives in the same database as the posts and is updated in the same transaction as the post itself, by the listeners at the bottom of this module
+# archived posts keep their rows in the index, the archive job moves posts without going through these listeners (see app/archive.py)
+# the work is done by a backend picked with SEARCH_BACKEND, so other databases can get a backend of their own with the same methods as SQLiteBackend
+
+
+def match_expression(query):
+    'turns what the user typed into an FTS5 query matching posts that contain every word, so that quotes and operators in the text are not taken as query syntax'
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+class SQLiteBackend(object):
+    '''
+    Search backed by an SQLite FTS5 virtual table, with the id of each post as the rowid of its row
+    Results are ranked by FTS5's bm25 score, best match first
+    '''
+
+    table = 'post_fts'
+
+    def create(self, connection):
+        connection.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(body)'.format(self.table)))
+
+    def drop(self, connection):
+        connection.execute(text('DROP TABLE IF EXISTS {}'.format(self.table)))
+
+    def add(self, connection, post_id, body):
+        connection.execute(text(
+            'INSERT INTO {} (rowid, body) VALUES (:id, :body)'.format(self.table)),
+            id=post_id, body=body or '')
+
+    def remove(self, connection, post_id):
+        connection.execute(text(
+            'DELETE FROM {} WHERE rowid = :id'.format(self.table)), id=post_id)
+
+    def reindex(self, connection):
+        'rebuilds the whole index from the post table and the archive, returns the number of posts indexed'
+        connection.execute(text('DELETE FROM {}'.format(self.table)))
+        return connection.execute(text(
+            'INSERT INTO {} (rowid, body) SELECT id, coalesce(body, \'\') FROM post '
+            'UNION ALL SELECT id, coalesce(body, \'\') FROM post_archive'.format(
+                self.table))).rowcount
+
+    def query(self, connection, query, page, per_page):
+        'returns the ids of one page of matching posts, best match first, and the total number of matches'
+        match = match_expression(query)
+        if not match:
+            return [], 0
+        ids = [id for id, in connection.execute(text(
+            'SELECT rowid FROM {0} WHERE {0} MATCH :match ORDER BY rank '
+            'LIMIT :limit OFFSET :offset'.format(self.table)),
+            match=match, limit=per_page, offset=(page - 1) * per_page)]
+        total = connection.execute(text(
+            'SELECT count(*) FROM {0} WHERE {0} MATCH :match'.format(self.table)),
+            match=match).scalar()
+        return ids, total
+
+
+class Search(object):
+    '''
+    Front of the search subsystem, forwarding to the backend named by SEARCH_BACKEND
+    With SEARCH_BACKEND set to 'none' search is turned off and nothing is indexed
+    '''
+
+    backends = {'sqlite': SQLiteBackend}
+
+    def __init__(self):
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            name = current_app.config['SEARCH_BACKEND']
+            if name and name != 'none':
+                self._backend = self.backends[name]()
+        return self._backend
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def init_app(self, app):
+        'the backend is created from the configuration of app on first use'
+        self.reset()
+
+    def reset(self):
+        self._backend = None
+
+    def reindex(self):
+        'rebuilds the index from the posts in the database, in the current transaction of db.session'
+        return self.backend.reindex(db.session.connection())
+
+    def query(self, query, page, per_page):
+        'returns one page of the posts matching query, best match first, and the total number of matches'
+        ids, total = self.backend.query(db.session.connection(), query, page, per_page)
+        if not ids:
+            return [], total
+        posts = {post.id: post for post in
+                 with_authors(Post.query.filter(Post.id.in_(ids))).all()}
+        # the matches that aren't recent posts are archived ones
+        archived = [id for id in ids if id not in posts]
+        if archived:
+            posts.update((post.id, post) for post in ArchivedPost.query.options(
+                joinedload(ArchivedPost.author)).filter(ArchivedPost.id.in_(archived)))
+        return [posts[id] for id in ids if id in posts], total
+
+
+search = Search()
+
+# the index table is created and dropped along with the post table, so db.create_all() and db.drop_all() (used by the tests) take care of it
+@event.listens_for(Post.__table__, 'after_create')
+def create_index(target, connection, **kw):
+    if search.enabled:
+        search.backend.create(connection)
+
+@event.listens_for(Post.__table__, 'before_drop')
+def drop_index(target, connection, **kw):
+    if search.enabled:
+        search.backend.drop(connection)
+
+@event.listens_for(Post, 'after_insert')
+def index_post(mapper, connection, post):
+    if search.enabled:
+        search.backend.add(connection, post.id, post.body)
+
+@event.listens_for(Post, 'after_update')
+def reindex_post(mapper, connection, post):
+    if search.enabled:
+        search.backend.remove(connection, post.id)
+        search.backend.add(connection, post.id, post.body)
+
+@event.listens_for(Post, 'after_delete')
+def unindex_post(mapper, connection, post):
+    if search.enabled:
+        search.backend.remove(connection, post.id)
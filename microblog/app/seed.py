@@ -0,0 +1,108 @@
+import bisect
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User, Post, Timeline, followers
+from app.search import search
+from app import suggestions
+
+# synthetic data for trying out and benchmarking the site at scale
+# real social graphs are very uneven: a few users have most of the followers and write most of the posts, so both are drawn from power-law (Zipf) distributions rather than uniformly
+# rows are written with bulk INSERTs that bypass the ORM, so the things the ORM events normally keep up to date (counters, timelines, suggestions, the search index) are rebuilt in bulk at the end
+
+WORDS = ('the a an my your this that today again finally just really never always '
+         'cat dog coffee tea code bug release flask python database query index cache '
+         'morning evening weekend holiday music book film game run walk train city '
+         'love hate like want need think know see make fix ship break test deploy').split()
+
+
+def zipf_weights(n, exponent):
+    'cumulative weights of a Zipf distribution over n items, the first item being the most likely'
+    return list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(n)))
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed(users, posts, mean_follows=20, exponent=1.0, days=90, password='password',
+         chunk_size=10000, random_seed=None, progress=None):
+    '''
+    Adds users users and posts posts to the database, returns the number of follow edges created
+    Each user follows on average mean_follows others, who are picked with a Zipf distribution of the given exponent so that some users end up with very many followers, and posts are spread over the users the same way and over the last days days
+    All users get the same password, hashed once. progress, if given, is called with a message after each step
+    '''
+    rng = random.Random(random_seed)
+    report = progress or (lambda message: None)
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    ids = list(range(first_id, first_id + users))
+    password_hash = generate_password_hash(password)
+    now = datetime.utcnow()
+    connection = db.session.connection()
+
+    def user_rows():
+        for id in ids:
+            email = 'user{}@example.com'.format(id)
+            yield {'id': id, 'username': 'user{}'.format(id), 'email': email,
+                   'avatar_hash': User.email_digest(email), 'password_hash': password_hash,
+                   'last_seen': now, 'followers_count': 0, 'following_count': 0,
+                   'posts_count': 0}
+    for chunk in chunks(user_rows(), chunk_size):
+        connection.execute(User.__table__.insert(), chunk)
+    report('{} users'.format(users))
+
+    # the popularity order is shuffled so that the most followed users are not simply the first ids
+    popular = ids[:]
+    rng.shuffle(popular)
+    weights = zipf_weights(users, exponent)
+    total = weights[-1]
+
+    def pick():
+        return popular[bisect.bisect(weights, rng.random() * total)]
+
+    def follow_rows():
+        for id in ids:
+            # the number of users followed is itself heavy tailed, with mean_follows on average
+            wanted = min(users - 1, int(rng.paretovariate(2) * mean_follows / 2))
+            for followed_id in set(pick() for _ in range(wanted)):
+                if followed_id != id:
+                    yield {'follower_id': id, 'followed_id': followed_id}
+    edges = 0
+    for chunk in chunks(follow_rows(), chunk_size):
+        connection.execute(followers.insert(), chunk)
+        edges += len(chunk)
+    report('{} follows'.format(edges))
+
+    seconds = days * 24 * 3600
+
+    def post_rows():
+        for _ in range(posts):
+            yield {'body': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+                   'timestame': now - timedelta(seconds=rng.random() * seconds),
+                   'user_id': pick()}
+    written = 0
+    for chunk in chunks(post_rows(), chunk_size):
+        connection.execute(Post.__table__.insert(), chunk)
+        written += len(chunk)
+        report('{} posts'.format(written))
+
+    User.repair_counters()
+    report('counters')
+    Timeline.rebuild()
+    report('timelines')
+    suggestions.rebuild()
+    report('suggestions')
+    if search.enabled:
+        search.reindex()
+        report('search index')
+    db.session.commit()
+    return edges
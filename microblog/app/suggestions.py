@@ -0,0 +1,79 @@
+import heapq
+from array import array
+from collections import Counter
+from flask import current_app
+from app import db
+from app.models import User, Suggestion, followers
+
+# "who to follow": users are suggested the users followed by most of the users they follow (the mutual-follow count)
+# counting that for everyone at once would be a self-join of followers with itself, so a batch job (flask suggestions rebuild) loads the follow graph into a compact index, counts in memory and writes the best SUGGESTIONS_PER_USER candidates of every user to the suggestion table
+# from then on follow and unfollow keep the lists up to date (see Suggestion in app/models.py), and /suggestions only reads the list of the current user
+
+BATCH_SIZE = 10000
+
+
+class FollowGraph(object):
+    '''
+    The followers table in compressed sparse row form: users are numbered 0 .. n-1 in the order of their ids, and the users that user i follows are targets[offsets[i]:offsets[i + 1]], in order
+    Three flat arrays of machine integers take a fraction of the memory of a dict of lists, about 4 bytes for each follow and 16 for each user
+    '''
+
+    def __init__(self, ids, offsets, targets):
+        self.ids = ids
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def load(cls):
+        'reads the graph with one pass over the users and one over the follows in follower order'
+        ids = array('q', (id for id, in db.session.query(User.id).order_by(User.id).yield_per(BATCH_SIZE)))
+        index = {id: i for i, id in enumerate(ids)}
+        offsets = array('l', [0] * (len(ids) + 1))
+        targets = array('i')
+        query = db.session.query(followers.c.follower_id, followers.c.followed_id).order_by(
+            followers.c.follower_id, followers.c.followed_id)
+        for follower_id, followed_id in query.yield_per(BATCH_SIZE):
+            offsets[index[follower_id] + 1] += 1
+            targets.append(index[followed_id])
+        # the counts become running totals, i.e. the position in targets where the follows of each user start
+        for i in range(len(ids)):
+            offsets[i + 1] += offsets[i]
+        return cls(ids, offsets, targets)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def following(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def suggestions(self, i, k):
+        'the best k (candidate, score) pairs for user i, by score and then by id'
+        followed = self.following(i)
+        counts = Counter()
+        for j in followed:
+            counts.update(self.following(j))
+        counts.pop(i, None)
+        for j in followed:
+            counts.pop(j, None)
+        # users are numbered in id order, so the lower number wins a tie just like the lower id does in Suggestion.trim
+        return heapq.nlargest(k, counts.items(), key=lambda item: (item[1], -item[0]))
+
+
+def rebuild():
+    'replaces the suggestions of every user with those computed from the current follows, returns the number of suggestions written'
+    k = current_app.config['SUGGESTIONS_PER_USER']
+    graph = FollowGraph.load()
+    table = Suggestion.__table__
+    db.session.execute(table.delete())
+    rows, written = [], 0
+    for i, user_id in enumerate(graph.ids):
+        for candidate, score in graph.suggestions(i, k):
+            rows.append({'user_id': user_id, 'candidate_id': graph.ids[candidate], 'score': score})
+        if len(rows) >= BATCH_SIZE:
+            db.session.execute(table.insert(), rows)
+            written += len(rows)
+            rows = []
+    if rows:
+        db.session.execute(table.insert(), rows)
+        written += len(rows)
+    return written
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import time
+from jinja2 import FileSystemBytecodeCache
+
+# Jinja compiles every template to Python code the first time a worker renders it, so after every deploy or worker restart the first requests to each page pay for parsing and compiling base.html, index.html, _post.html, ...
+# with TEMPLATE_CACHE set to 'filesystem' the compiled code is kept in TEMPLATE_CACHE_DIR, which all the workers of a machine share: a template is compiled by the first worker that needs it and the others load the code from the file
+# a cached file carries a checksum of the template source and the version of Jinja, so an edited template or an upgrade is compiled again instead of loading stale code
+# with TEMPLATE_WARMUP create_app also loads every template up front, so the first request of a worker doesn't compile any of them
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    'FileSystemBytecodeCache that writes to a temporary file and moves it into place, so that other workers never load half a file, like AvatarCache in app/avatars.py'
+
+    def __init__(self, directory):
+        FileSystemBytecodeCache.__init__(self, directory)
+        self.loads = 0
+        self.writes = 0
+
+    def load_bytecode(self, bucket):
+        FileSystemBytecodeCache.load_bytecode(self, bucket)
+        if bucket.code is not None:
+            self.loads += 1
+
+    def dump_bytecode(self, bucket):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp, self._get_cache_filename(bucket))
+        except OSError:
+            # the template was compiled anyway, it is only not cached
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.writes += 1
+
+
+def init_app(app):
+    'gives the Jinja environment of app the bytecode cache of TEMPLATE_CACHE, and compiles the templates up front with TEMPLATE_WARMUP'
+    if app.config['TEMPLATE_CACHE'] == 'filesystem':
+        directory = app.config['TEMPLATE_CACHE_DIR']
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # the environment only asks its bytecode cache when it loads a template, so setting it after the extensions have added their globals and filters is fine
+        app.jinja_env.bytecode_cache = SharedBytecodeCache(directory)
+    if app.config['TEMPLATE_WARMUP']:
+        warm_up(app)
+
+
+def warm_up(app):
+    '''
+    Loads every template app can render (those of app/templates and of the blueprints, e.g. the base template of Flask-Bootstrap) into its Jinja environment, compiling those the bytecode cache doesn't have yet, and returns their names
+    The environment keeps the loaded templates, so a pre-fork server that creates the application before forking hands them to every worker
+    '''
+    started = time.perf_counter()
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    app.logger.info('Loaded %d templates in %.1f ms', len(names),
+                    (time.perf_counter() - started) * 1000)
+    return names
+
+
+def stats(app):
+    'the templates loaded from and written to the bytecode cache of app by this worker, None when there is no cache'
+    cache = app.jinja_env.bytecode_cache
+    if not isinstance(cache, SharedBytecodeCache):
+        return None
+    return {'loads': cache.loads, 'writes': cache.writes}
@@ -0,0 +1,76 @@
+import heapq
+import math
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.models import User, Post, TrendingPost
+from app.jobs import PeriodicJob
+
+# the trending mode of /explore: recent posts ranked by how new they are and how many followers their author has
+# ranking is too much work to do per request, so a background job scores the posts of the last TRENDING_WINDOW hours every TRENDING_INTERVAL seconds and replaces the snapshot in the trending_post table, which /explore?mode=trending reads a page at a time
+# the snapshot is in the database, so it is shared by all workers: the job of each worker only rebuilds it when the snapshot is older than TRENDING_INTERVAL, whichever worker gets there first does the work
+
+
+def score(followers_count, age_hours, gravity):
+    'the follower count of the author on a log scale, divided by the age of the post in hours raised to gravity, the higher gravity the faster posts drop out'
+    return (1 + math.log1p(followers_count)) / (age_hours + 2) ** gravity
+
+
+def rebuild(now=None):
+    'replaces the snapshot with the top TRENDING_SIZE posts as of now, returns the number of posts in it'
+    now = now or datetime.utcnow()
+    config = current_app.config
+    # only reads the posts of the window through the index on post.timestame, together with the counter the author already keeps
+    query = db.session.query(Post.id, Post.timestame, User.followers_count).join(
+        User, User.id == Post.user_id).filter(
+            Post.timestame >= now - timedelta(hours=config['TRENDING_WINDOW']))
+    scored = ((score(followers_count, max((now - timestame).total_seconds(), 0) / 3600,
+                     config['TRENDING_GRAVITY']), id)
+              for id, timestame, followers_count in query.yield_per(1000))
+    top = heapq.nlargest(config['TRENDING_SIZE'], scored)
+    table = TrendingPost.__table__
+    db.session.execute(table.delete())
+    if top:
+        db.session.execute(table.insert(), [
+            {'rank': rank, 'post_id': id, 'score': value, 'computed_at': now}
+            for rank, (value, id) in enumerate(top, 1)])
+    return len(top)
+
+
+def computed_at():
+    'when the current snapshot was computed, None if there is none'
+    return db.session.query(TrendingPost.computed_at).filter(TrendingPost.rank == 1).scalar()
+
+
+class TrendingJob(PeriodicJob):
+    '''
+    Keeps the trending snapshot no older than TRENDING_INTERVAL seconds (0 turns the thread off, e.g. to run flask trending rebuild from cron instead)
+    '''
+
+    name = 'trending'
+    interval_setting = 'TRENDING_INTERVAL'
+    done_message = '%s: ranked %d posts in %.1f ms'
+
+    def task(self):
+        return rebuild()
+
+    def run_if_due(self):
+        'rebuilds the snapshot when it is missing or stale, returns the number of seconds until it is next due'
+        interval = self.app.config['TRENDING_INTERVAL']
+        last = computed_at()
+        if last is not None:
+            age = (datetime.utcnow() - last).total_seconds()
+            if age < interval:
+                return interval - age
+        self.run()
+        return interval
+
+    def stats(self):
+        'the counters of PeriodicJob and the age of the snapshot in seconds (None when there is none)'
+        stats = PeriodicJob.stats(self)
+        last = computed_at()
+        stats['age'] = None if last is None else (datetime.utcnow() - last).total_seconds()
+        return stats
+
+
+trending_job = TrendingJob()
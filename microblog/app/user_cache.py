@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+
+
+class UserCache(object):
+    '''
+    Per-process LRU cache with a time to live, used by load_user to keep the column values of recently seen users so that Flask-Login doesn't have to query the user row on every request
+    Holds at most USER_CACHE_SIZE users, each for at most USER_CACHE_TTL seconds, and counts hits, misses and evictions so that its effectiveness can be checked with stats()
+    Subclasses can keep other things about users by naming other settings for the size and the time to live
+    '''
+
+    size_setting = 'USER_CACHE_SIZE'
+    ttl_setting = 'USER_CACHE_TTL'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, id):
+        'returns the cached values for id, or None if they are missing or expired'
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[id]
+                self.misses += 1
+                return None
+            # most recently used entries are kept at the end, so the least recently used is always the first one
+            self.entries.move_to_end(id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, id, values):
+        expires = time.time() + current_app.config[self.ttl_setting]
+        with self.lock:
+            self.entries[id] = (expires, values)
+            self.entries.move_to_end(id)
+            while len(self.entries) > current_app.config[self.size_setting]:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *ids):
+        with self.lock:
+            for id in ids:
+                self.entries.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+user_cache = UserCache()
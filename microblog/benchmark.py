@@ -0,0 +1,268 @@
+'''
+Latency and throughput benchmarks of the main pages, run through the Flask test client against a database of synthetic data
+
+    python benchmark.py --users 1000 --posts 20000 --output bench.json
+    python benchmark.py --database sqlite:////tmp/big.db --no-seed --compare bench.json
+    python benchmark.py --startup 20 --output startup.json
+    python benchmark.py --startup 20 --templates --output templates.json
+
+Without --database a fresh SQLite file is created in a temporary directory and seeded (see app/seed.py). Results are written as JSON so that runs of different releases can be compared with --compare, which exits with status 1 when a route got slower than the tolerance allows
+With --startup the routes are not benchmarked, instead each of that many fresh interpreters times how long it takes from importing the app to answering its first request
+Adding --templates times the cold starts three times over: without the template bytecode cache, with a cache that an earlier worker has filled, and with the cache and TEMPLATE_WARMUP (see app/template_cache.py)
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# run in a fresh interpreter for every measurement, so that nothing is already imported or cached
+STARTUP_SCRIPT = '''
+import json
+import time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get('/login')
+answered = time.perf_counter()
+print(json.dumps({'status': response.status_code, 'import': imported - started,
+                  'create_app': created - imported, 'first_request': answered - created,
+                  'startup': answered - started}))
+'''
+
+
+def percentile(values, fraction):
+    'value below which the given fraction of the sorted values fall'
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(timings, elapsed):
+    timings = sorted(timings)
+    return {'requests': len(timings),
+            'mean_ms': 1000 * sum(timings) / len(timings),
+            'p50_ms': 1000 * percentile(timings, 0.5),
+            'p95_ms': 1000 * percentile(timings, 0.95),
+            'p99_ms': 1000 * percentile(timings, 0.99),
+            'max_ms': 1000 * timings[-1],
+            'throughput_rps': len(timings) / elapsed}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_routes(app, db, User, Post, rng):
+    '''
+    The requests to time, as {name: function returning the URL of the next request}
+    Profile pages are timed for the most followed user and for typical users, the last page of explore is reached with a cursor built from the oldest post
+    The app is only imported once the database has been chosen, hence the imports in here
+    '''
+    popular = User.query.order_by(User.followers_count.desc()).first()
+    ids = [id for id, in db.session.query(User.id)]
+    typical = [User.query.get(id).username for id in rng.sample(ids, min(len(ids), 50))]
+    oldest = Post.query.order_by(Post.timestame.asc()).first()
+    from app.pagination import encode_cursor
+    deep_cursor = encode_cursor('b', oldest) if oldest else None
+    routes = {
+        'index': lambda: '/index',
+        'explore': lambda: '/explore',
+        'explore_deep': lambda: '/explore?cursor={}'.format(deep_cursor),
+        'explore_page_50': lambda: '/explore?page=50',
+        'user_popular': lambda: '/user/{}'.format(popular.username),
+        'user_typical': lambda: '/user/{}'.format(rng.choice(typical)),
+    }
+    if app.config['SEARCH_BACKEND'] not in (None, '', 'none'):
+        from app.seed import WORDS
+        routes['search'] = lambda: '/search?q={}'.format(rng.choice(WORDS))
+    return routes
+
+
+def choose_database(args):
+    # the configuration is read when the app is imported, so the database has to be chosen first
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+    else:
+        directory = tempfile.mkdtemp(prefix='microblog-bench-')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+
+
+def meta(args):
+    return {'created': datetime.utcnow().isoformat() + 'Z',
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'database': os.environ['DATABASE_URL'].split(':', 1)[0],
+            'seed': args.seed}
+
+
+# the settings of each variant timed by --startup --templates, the cache directory is filled in by startup
+TEMPLATE_VARIANTS = [
+    ('no_cache', {'TEMPLATE_CACHE': 'none'}),
+    ('cache', {'TEMPLATE_CACHE': 'filesystem'}),
+    ('warmup', {'TEMPLATE_CACHE': 'filesystem', 'TEMPLATE_WARMUP': '1'}),
+]
+
+
+def cold_start(environ):
+    'the timings of one fresh interpreter, from the import of the app to the answer to its first request'
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], env=environ,
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    if result.pop('status') != 200:
+        raise SystemExit('the first request of a fresh app failed')
+    return result
+
+
+def startup(args):
+    '''
+    Times args.startup cold starts, from the import of the app to the answer to its first request (the login page, which needs no data)
+    The total is reported as the startup route, with the import, create_app and first request steps as routes of their own
+    With args.templates every variant of TEMPLATE_VARIANTS is timed and its name added to the routes. The variants with a cache start from one that an untimed start has filled, like the workers that come after the first one following a deploy
+    '''
+    choose_database(args)
+    variants = [('', {})]
+    if args.templates:
+        directory = tempfile.mkdtemp(prefix='microblog-templates-')
+        variants = [(name, dict(settings, TEMPLATE_CACHE_DIR=os.path.join(directory, name)))
+                    for name, settings in TEMPLATE_VARIANTS]
+    results = {}
+    for variant, settings in variants:
+        environ = dict(os.environ, **settings)
+        if settings.get('TEMPLATE_CACHE') == 'filesystem':
+            cold_start(environ)
+        # the throughput of each variant only counts its own timed starts, not the untimed one or those of the variants before it
+        started = time.time()
+        timings = {}
+        for i in range(args.startup):
+            for step, seconds in cold_start(environ).items():
+                timings.setdefault(step, []).append(seconds)
+        elapsed = time.time() - started
+        for step, values in sorted(timings.items()):
+            name = step if step == 'startup' else 'startup_' + step
+            if variant:
+                name += '_' + variant
+            results[name] = summarize(values, elapsed)
+            print('{:<34} p50 {p50_ms:8.2f} ms  p95 {p95_ms:8.2f} ms'.format(name, **results[name]),
+                  file=sys.stderr)
+    return {'meta': dict(meta(args), runs=args.startup), 'results': results}
+
+
+def run(args):
+    choose_database(args)
+    from app import create_app, db
+    from app.models import User, Post
+    from app.seed import seed
+    app = create_app()
+    app.app_context().push()
+
+    rng = random.Random(args.seed)
+    if not args.no_seed:
+        if not args.database:
+            db.create_all()
+        started = time.time()
+        seed(args.users, args.posts, random_seed=args.seed,
+             progress=lambda message: print('seeded', message, file=sys.stderr))
+        print('seeding took {:.1f}s'.format(time.time() - started), file=sys.stderr)
+
+    ids = [id for id, in db.session.query(User.id)]
+    readers = rng.sample(ids, min(len(ids), args.readers))
+    clients = []
+    for id in readers:
+        client = app.test_client()
+        # log in by putting the user straight into the session, password hashing is not what is being measured
+        with client.session_transaction() as session:
+            session['user_id'] = str(id)
+            session['_fresh'] = True
+        clients.append(client)
+
+    routes = build_routes(app, db, User, Post, rng)
+    if args.routes:
+        routes = {name: routes[name] for name in args.routes}
+    results = {}
+    for name, next_url in sorted(routes.items()):
+        for i in range(args.warmup):
+            clients[i % len(clients)].get(next_url())
+        timings = []
+        started = time.time()
+        for i in range(args.requests):
+            url = next_url()
+            request_started = time.perf_counter()
+            response = clients[i % len(clients)].get(url)
+            timings.append(time.perf_counter() - request_started)
+            if response.status_code != 200:
+                raise SystemExit('{} answered {} for {}'.format(name, response.status_code, url))
+        results[name] = summarize(timings, time.time() - started)
+        print('{:<16} p50 {p50_ms:8.2f} ms  p95 {p95_ms:8.2f} ms  {throughput_rps:8.1f} req/s'.format(
+            name, **results[name]), file=sys.stderr)
+        db.session.remove()
+
+    return {'meta': dict(meta(args),
+                         users=db.session.query(db.func.count(User.id)).scalar(),
+                         posts=db.session.query(db.func.count(Post.id)).scalar(),
+                         requests=args.requests, warmup=args.warmup, readers=len(readers)),
+            'results': results}
+
+
+def compare(current, baseline, tolerance):
+    'prints how each route changed against baseline, returns the routes whose p50 or p95 latency grew by more than tolerance'
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        changes = {key: result[key] / before[key] if before[key] else 1.0
+                   for key in ('p50_ms', 'p95_ms')}
+        print('{:<16} p50 x{p50_ms:.2f}  p95 x{p95_ms:.2f}'.format(name, **changes),
+              file=sys.stderr)
+        if any(change > 1 + tolerance for change in changes.values()):
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the microblog routes.')
+    parser.add_argument('--database', help='database URL to use instead of a new temporary SQLite file')
+    parser.add_argument('--no-seed', action='store_true', help='benchmark the data already in --database')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the data and the requests')
+    parser.add_argument('--readers', type=int, default=20, help='number of logged in users making the requests')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per route before timing')
+    parser.add_argument('--routes', nargs='*', help='only benchmark these routes')
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help='time this many cold starts of the app instead of the routes')
+    parser.add_argument('--templates', action='store_true',
+                        help='with --startup, time the cold starts without and with the template cache and warm-up')
+    parser.add_argument('--output', default='bench.json', help='where to write the results')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against --compare, 0.2 is 20%%')
+    args = parser.parse_args(argv)
+
+    results = startup(args) if args.startup else run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('slower than {}: {}'.format(args.compare, ', '.join(regressions)), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,6 +12,17 @@ class Config(object):
     
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
+    # read-only pages (see Database.read_only in app/database.py) are served from one of these databases, a comma separated list of URLs, everything else uses the primary DATABASE_URL
+    DATABASE_REPLICA_URLS = [url.strip() for url in
+                             (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url.strip()]
+    # connection pool of a database server (SQLite opens a connection whenever it needs one): DATABASE_POOL_SIZE connections are kept open, up to DATABASE_MAX_OVERFLOW more are opened when they are all busy, and connections are replaced after DATABASE_POOL_RECYCLE seconds so that the server never finds them idle for too long
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
+    # pragmas for SQLite connections: write-ahead logging lets pages be read while a post is being written, with synchronous 'normal' a commit only waits for the log to reach the disk at checkpoints, and each connection caches up to SQLITE_CACHE_SIZE KiB of pages
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'wal'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'normal'
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or 20000)
     # set to False the feature which signals the application every time a change is about to be made in the database which is not needed
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
@@ -23,5 +34,89 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    # the log is written to LOG_FILE ('-' for standard error) by a background thread, as JSON lines or, with LOG_FORMAT 'text', as plain lines
+    # the file is rotated once it reaches LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files, and up to LOG_QUEUE_SIZE records can wait to be written before new ones are dropped
+    LOG_FILE = os.environ.get('LOG_FILE') or os.path.join(basedir, 'logs', 'microblog.log')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'json'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
+    # at most LOG_RATE_LIMIT records from the same line with the same message are logged (and emailed) every LOG_RATE_WINDOW seconds, 0 turns the limit off
+    # LOG_SAMPLE_RATE is the fraction of records below WARNING that are kept, and LOG_REQUESTS logs a line for every request
+    LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT') or 10)
+    LOG_RATE_WINDOW = int(os.environ.get('LOG_RATE_WINDOW') or 60)
+    LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE') or 1.0)
+    LOG_REQUESTS = os.environ.get('LOG_REQUESTS') is not None
+    # email is sent by MAIL_WORKERS background threads from a queue of at most MAIL_QUEUE_SIZE messages, in batches of up to MAIL_BATCH_SIZE messages per connection
+    # a failed batch is retried MAIL_MAX_RETRIES times, waiting MAIL_RETRY_BACKOFF seconds before the first retry and doubling the wait each time
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 1)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 3)
+    MAIL_RETRY_BACKOFF = float(os.environ.get('MAIL_RETRY_BACKOFF') or 1)
     POSTS_PER_PAGE = 3
+    # the JSON API returns API_POSTS_PER_PAGE posts unless the client asks for another count, which can be at most API_MAX_POSTS_PER_PAGE
+    API_POSTS_PER_PAGE = int(os.environ.get('API_POSTS_PER_PAGE') or 20)
+    API_MAX_POSTS_PER_PAGE = int(os.environ.get('API_MAX_POSTS_PER_PAGE') or 100)
+    # backend of the full-text search of posts, 'sqlite' uses an FTS5 table in the SQLite database and 'none' turns search off
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or \
+        ('sqlite' if SQLALCHEMY_DATABASE_URI.startswith('sqlite') else 'none')
+    # passwords are hashed with PASSWORD_HASH_METHOD (a werkzeug method, for pbkdf2 the number of iterations is the last part) and a salt of PASSWORD_SALT_LENGTH characters, stored hashes made with other settings are replaced at the next login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
+    # hashing runs in PASSWORD_HASH_WORKERS processes (0 to hash in the request thread), with at most PASSWORD_HASH_MAX_PENDING hashes waiting or running, a request that waits more than PASSWORD_HASH_QUEUE_TIMEOUT seconds for a place gets a 503
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING') or 8)
+    PASSWORD_HASH_QUEUE_TIMEOUT = float(os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT') or 5)
+    # the rendered HTML of posts is cached in the worker's memory ('memory'), in files shared by all workers ('filesystem') or not at all (set FRAGMENT_CACHE to 'none')
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE') or 'memory'
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR') or \
+        os.path.join(basedir, 'cache', 'fragments')
+    # the compiled code of the templates is kept in files in TEMPLATE_CACHE_DIR shared by all workers ('filesystem') or only in the memory of each worker (set TEMPLATE_CACHE to 'none')
+    # with TEMPLATE_WARMUP set every template is loaded when the application is created, instead of by the first request that renders it
+    TEMPLATE_CACHE = os.environ.get('TEMPLATE_CACHE') or 'filesystem'
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or \
+        os.path.join(basedir, 'cache', 'templates')
+    TEMPLATE_WARMUP = os.environ.get('TEMPLATE_WARMUP') is not None
+    # avatars are identicons drawn by the site ('local') or Gravatar images ('gravatar')
+    # local avatars come in the AVATAR_SIZES sizes (a comma separated list, other sizes are rounded up to one of them) and are kept as files in AVATAR_CACHE_DIR, at most AVATAR_CACHE_SIZE of them
+    AVATAR_BACKEND = os.environ.get('AVATAR_BACKEND') or 'local'
+    AVATAR_SIZES = [int(size) for size in (os.environ.get('AVATAR_SIZES') or '36,70,128,256').split(',')]
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or \
+        os.path.join(basedir, 'cache', 'avatars')
+    AVATAR_CACHE_SIZE = int(os.environ.get('AVATAR_CACHE_SIZE') or 100000)
+    # load_user keeps up to USER_CACHE_SIZE users in memory for up to USER_CACHE_TTL seconds
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 1024)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)
+    # /popups returns the hover cards of up to POPUP_BATCH_SIZE users at once, rendered cards are kept for POPUP_CACHE_TTL seconds, at most POPUP_CACHE_SIZE of them
+    POPUP_BATCH_SIZE = int(os.environ.get('POPUP_BATCH_SIZE') or 50)
+    POPUP_CACHE_TTL = int(os.environ.get('POPUP_CACHE_TTL') or 30)
+    POPUP_CACHE_SIZE = int(os.environ.get('POPUP_CACHE_SIZE') or 1024)
+    # last_seen is only updated when it has moved on by more than LAST_SEEN_GRANULARITY seconds, and the updates are written in bulk once LAST_SEEN_FLUSH_SIZE users are pending or every LAST_SEEN_FLUSH_INTERVAL seconds
+    # a background thread writes them on time when no more requests come in, 0 turns it off and writes every update straight away
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    LAST_SEEN_FLUSH_SIZE = int(os.environ.get('LAST_SEEN_FLUSH_SIZE') or 100)
+    # home timelines are materialized per user: new posts are copied to every follower unless the author has more than TIMELINE_FANOUT_LIMIT followers, in which case their posts are merged in when the timeline is read
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 5000)
+    # number of posts of a newly followed user copied into the timeline of the follower
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    # number of users suggested to each user on /suggestions, the batch job and the updates on follow and unfollow keep this many per user (see app/suggestions.py)
+    SUGGESTIONS_PER_USER = int(os.environ.get('SUGGESTIONS_PER_USER') or 20)
+    # /explore?mode=trending shows a snapshot of the top TRENDING_SIZE posts of the last TRENDING_WINDOW hours, ranked by age (the higher TRENDING_GRAVITY, the sooner posts drop) and the followers of their author
+    # the snapshot is rebuilt every TRENDING_INTERVAL seconds by a background thread, 0 turns the thread off (flask trending rebuild does the same from cron)
+    TRENDING_WINDOW = int(os.environ.get('TRENDING_WINDOW') or 48)
+    TRENDING_SIZE = int(os.environ.get('TRENDING_SIZE') or 500)
+    TRENDING_GRAVITY = float(os.environ.get('TRENDING_GRAVITY') or 1.5)
+    TRENDING_INTERVAL = int(os.environ.get('TRENDING_INTERVAL') or 300)
+    # posts older than ARCHIVE_AFTER_DAYS are moved from post to the post_archive table, ARCHIVE_BATCH_SIZE posts per transaction (see app/archive.py)
+    # moving posts takes them out of the post table, so it is off unless asked for: either set ARCHIVE_INTERVAL to run the move in a background thread every so many seconds, or run flask archive run from cron
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 30)
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 1000)
+    ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL') or 0)
+    # /metrics is only served to requests sending the header "Authorization: Bearer <METRICS_TOKEN>", without a token the page is off
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # requests running more than METRICS_QUERY_BUDGET SQL statements are logged as warnings (0 turns the warning off)
+    METRICS_QUERY_BUDGET = int(os.environ.get('METRICS_QUERY_BUDGET') or 20)
     LANGUAGES = ['en', 'es']
@@ -1,6 +1,9 @@
-from app import app, db
+from app import create_app, db
 from app.models import User, Post
 
+# the application that the flask command and the WSGI server load
+app = create_app()
+
 @app.shell_context_processor
 def make_shell_context():
     return {'db':db, 'User':User, 'Post':Post}
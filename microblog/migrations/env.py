@@ -33,6 +33,11 @@ target_metadata = current_app.extensions['migrate'].db.metadata
 # ... etc.
 
 
+# tables that are managed outside of the models, e.g. the full-text search index of posts (see app/search.py) and the shadow tables SQLite keeps for it, are left alone by autogenerate
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ == 'table' and name.startswith('post_fts'))
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -47,7 +52,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -83,6 +89,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,40 @@
+"""archive of old posts
+
+Revision ID: 3b8d0f4a72c1
+Revises: e61b7a0d9c25
+Create Date: 2026-10-18 19:12:40.318275
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8d0f4a72c1'
+down_revision = 'e61b7a0d9c25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the archive job (or flask archive run) moves the old posts over after the upgrade
+    op.create_table('post_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('body', sa.String(length=140), nullable=True),
+    sa.Column('timestame', sa.DateTime(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_post_archive_timestame_id', 'post_archive', ['timestame', 'id'], unique=False)
+    op.create_index('ix_post_archive_user_id_timestame_id', 'post_archive', ['user_id', 'timestame', 'id'], unique=False)
+
+
+def downgrade():
+    # the archived posts go back to the post table first, so nothing is lost
+    # only the posts themselves are copied back: run flask timeline rebuild afterwards so the timelines hold them again, and flask search reindex so the search index is rebuilt from the post table alone
+    op.execute('INSERT INTO post (id, body, timestame, user_id) '
+               'SELECT id, body, timestame, user_id FROM post_archive')
+    op.drop_index('ix_post_archive_user_id_timestame_id', table_name='post_archive')
+    op.drop_index('ix_post_archive_timestame_id', table_name='post_archive')
+    op.drop_table('post_archive')
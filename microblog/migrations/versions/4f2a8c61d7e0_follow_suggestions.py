@@ -0,0 +1,34 @@
+"""precomputed follow suggestions
+
+Revision ID: 4f2a8c61d7e0
+Revises: 71c0e5ab93f8
+Create Date: 2026-10-18 16:02:45.118273
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2a8c61d7e0'
+down_revision = '71c0e5ab93f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the table starts out empty, flask suggestions rebuild fills it from the existing follows
+    op.create_table('suggestion',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('candidate_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['candidate_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'candidate_id')
+    )
+    op.create_index('ix_suggestion_user_id_score', 'suggestion', ['user_id', 'score'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_suggestion_user_id_score', table_name='suggestion')
+    op.drop_table('suggestion')
@@ -0,0 +1,37 @@
+"""denormalized follower, following and post counters on user
+
+Revision ID: 5a9e3d61f0b2
+Revises: c47a19e05b3d
+Create Date: 2026-10-18 13:21:09.554127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a9e3d61f0b2'
+down_revision = 'c47a19e05b3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # batch mode so that the NOT NULL columns can be added on SQLite too
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+    # same bulk recompute as `flask counters repair`
+    op.execute(
+        'UPDATE "user" SET '
+        'followers_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'following_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id), '
+        'posts_count = (SELECT count(*) FROM post WHERE post.user_id = "user".id)')
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('posts_count')
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('followers_count')
@@ -0,0 +1,30 @@
+"""full-text search index of posts
+
+Revision ID: 71c0e5ab93f8
+Revises: d2f86a4c1e97
+Create Date: 2026-10-18 15:37:12.904411
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '71c0e5ab93f8'
+down_revision = 'd2f86a4c1e97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # only the SQLite backend keeps its index in the database, see app/search.py
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)')
+    op.execute("INSERT INTO post_fts (rowid, body) SELECT id, coalesce(body, '') FROM post")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE IF EXISTS post_fts')
@@ -0,0 +1,42 @@
+"""materialized home timeline
+
+Revision ID: 8e6d4b7f2c10
+Revises: 3b1f0c2a9d44
+Create Date: 2026-10-18 09:40:02.731655
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e6d4b7f2c10'
+down_revision = '3b1f0c2a9d44'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestame', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timeline_user_id_timestame', 'timeline', ['user_id', 'timestame'], unique=False)
+    # fill the timelines from the existing posts: every user sees their own posts and the posts of the users they follow
+    op.execute(
+        'INSERT INTO timeline (user_id, post_id, timestame) '
+        'SELECT user_id, id, timestame FROM post')
+    op.execute(
+        'INSERT INTO timeline (user_id, post_id, timestame) '
+        'SELECT DISTINCT followers.follower_id, post.id, post.timestame '
+        'FROM followers JOIN post ON post.user_id = followers.followed_id '
+        'WHERE followers.follower_id != post.user_id')
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestame', table_name='timeline')
+    op.drop_table('timeline')
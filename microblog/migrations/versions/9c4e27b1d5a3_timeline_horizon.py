@@ -0,0 +1,36 @@
+"""horizon of the materialized timeline
+
+Revision ID: 9c4e27b1d5a3
+Revises: 3b8d0f4a72c1
+Create Date: 2026-10-18 21:36:05.412907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e27b1d5a3'
+down_revision = '3b8d0f4a72c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('timeline_horizon', sa.DateTime(), nullable=True))
+    # the timelines built so far may be missing older posts of the users followed, the horizon of each user is set to the newest post of a user they follow (and who fans out on write) that isn't in their timeline
+    op.get_bind().execute(sa.text(
+        'UPDATE "user" SET timeline_horizon = ('
+        '  SELECT max(post.timestame) FROM followers '
+        '  JOIN post ON post.user_id = followers.followed_id '
+        '  JOIN "user" AS author ON author.id = followers.followed_id '
+        '  WHERE followers.follower_id = "user".id AND author.followers_count <= :limit '
+        '  AND NOT EXISTS (SELECT 1 FROM timeline '
+        '    WHERE timeline.user_id = "user".id AND timeline.post_id = post.id))'),
+        limit=current_app.config['TIMELINE_FANOUT_LIMIT'])
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('timeline_horizon')
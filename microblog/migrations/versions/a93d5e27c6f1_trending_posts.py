@@ -0,0 +1,32 @@
+"""trending posts snapshot
+
+Revision ID: a93d5e27c6f1
+Revises: 4f2a8c61d7e0
+Create Date: 2026-10-18 16:41:09.552806
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a93d5e27c6f1'
+down_revision = '4f2a8c61d7e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the trending job fills the table within TRENDING_INTERVAL of the first request
+    op.create_table('trending_post',
+    sa.Column('rank', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.Column('computed_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.PrimaryKeyConstraint('rank')
+    )
+
+
+def downgrade():
+    op.drop_table('trending_post')
@@ -0,0 +1,33 @@
+"""keyset pagination indexes
+
+Revision ID: c47a19e05b3d
+Revises: 8e6d4b7f2c10
+Create Date: 2026-10-18 11:05:47.208934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a19e05b3d'
+down_revision = '8e6d4b7f2c10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_timestame_id', 'post', ['timestame', 'id'], unique=False)
+    # (timestame, id) covers everything the index on timestame alone did
+    op.drop_index('ix_post_timestame', table_name='post')
+    op.create_index('ix_post_user_id_timestame_id', 'post', ['user_id', 'timestame', 'id'], unique=False)
+    op.drop_index('ix_timeline_user_id_timestame', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestame_post_id', 'timeline', ['user_id', 'timestame', 'post_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestame_post_id', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestame', 'timeline', ['user_id', 'timestame'], unique=False)
+    op.drop_index('ix_post_user_id_timestame_id', table_name='post')
+    op.create_index('ix_post_timestame', 'post', ['timestame'], unique=False)
+    op.drop_index('ix_post_timestame_id', table_name='post')
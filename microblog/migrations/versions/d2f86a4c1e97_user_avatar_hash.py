@@ -0,0 +1,38 @@
+"""stored avatar digest on user
+
+Revision ID: d2f86a4c1e97
+Revises: 5a9e3d61f0b2
+Create Date: 2026-10-18 14:02:44.190326
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f86a4c1e97'
+down_revision = '5a9e3d61f0b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('avatar_hash', sa.String(length=32), nullable=True))
+    # compute the digests of the existing users, SQLite has no MD5 function so this is done here
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('avatar_hash', sa.String))
+    connection = op.get_bind()
+    rows = connection.execute(sa.select([user.c.id, user.c.email]).where(
+        user.c.email.isnot(None))).fetchall()
+    if rows:
+        connection.execute(user.update().where(
+            user.c.id == sa.bindparam('user_id')).values(
+                avatar_hash=sa.bindparam('digest')),
+            [{'user_id': id, 'digest': md5(email.lower().encode('utf-8')).hexdigest()}
+             for id, email in rows])
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('avatar_hash')
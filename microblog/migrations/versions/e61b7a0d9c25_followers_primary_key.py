@@ -0,0 +1,52 @@
+"""primary key and index on followers
+
+Revision ID: e61b7a0d9c25
+Revises: a93d5e27c6f1
+Create Date: 2026-10-18 17:20:36.640129
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e61b7a0d9c25'
+down_revision = 'a93d5e27c6f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite can't add a primary key to an existing table, so the table is copied into a new one that has it, keeping one row of every follow and dropping rows with a missing end
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute(
+        'INSERT INTO followers_new (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    # duplicates were counted twice, the counters are recomputed from the remaining rows (like flask counters repair)
+    op.execute(
+        'UPDATE "user" SET '
+        'followers_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'following_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)')
+
+
+def downgrade():
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) SELECT follower_id, followed_id FROM followers')
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
@@ -1,19 +1,83 @@
 from datetime import datetime, timedelta
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
 import unittest
-from app import app, db
-from app.models import User, Post
+from flask_mail import Message
+from app import create_app, db, mail
+from app.models import User, Post, ArchivedPost, Timeline, Suggestion, TrendingPost, load_user, followers
+from app.user_cache import user_cache
+from app.feeds import home_feed, home_timeline, explore_feed, user_feed, home_archive, explore_archive, user_archive
+from app.fragments import fragment_cache
+from app.passwords import password_hasher
+from app.search import search
+from app.seed import seed
+from app import suggestions
+from app.metrics import Histogram
+from app import trending
+from app.trending import TrendingJob
+from app import archive
+from app.export import post_rows
+from app.email import MailQueue, mail_queue, send_password_reset_email
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+from app.pagination import keyset_paginate, offset_page, encode_cursor, fetch_posts, older_than, Source
+from app.last_seen import LastSeenTracker, LastSeenFlushJob
+from app.logs import LogPipeline, RateLimitFilter, JSONFormatter
+from app.avatars import identicon, identicon_cells, avatar_cache
+from app.popups import popup_cache
+from app import template_cache
+from sqlalchemy import event, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from config import Config
+
+class TestConfig(Config):
+    # ensure that tests don't use regular database for development, SQLAlchemy uses an in-memory SQLite database dureing tests
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # the trending job is run by hand in TrendingCase, a thread of its own would not see the in-memory database
+    TRENDING_INTERVAL = 0
+    # and the archive job is run by hand in ArchiveCase
+    ARCHIVE_INTERVAL = 0
+    # and the last_seen flush job in LastSeenTrackerCase
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    # templates are compiled in memory, TemplateCacheCase gives the cache a directory of its own
+    TEMPLATE_CACHE = 'none'
+    METRICS_TOKEN = 'scraper'
+
+def home_posts(user):
+    'every post of the home feed of user, in the order the pages show them'
+    return [post for partition, post in fetch_posts(home_feed(user), 1000)]
+
+def scrape(client):
+    'the text of /metrics, as Prometheus reads it'
+    return client.get('/metrics', headers={'Authorization': 'Bearer scraper'}).get_data(as_text=True)
 
 class UserModelCase(unittest.TestCase):
 
     def setUp(self):
-        # ensure that tests don't use regular database for development by changing application configuration, which gets SQLAlchemy to use in-memory SQLite database dureing tests
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        # every test gets an application of its own, created with the test configuration
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
         # fast qay to create databases with migration etc.
         db.create_all()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        self.app_context.pop()
 
     def test_password_hashing(self):
         u = User(username='susan')
@@ -21,12 +85,52 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan')
+        calls = password_hasher.stats()['calls']
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(u.password_needs_rehash())
+        self.assertEqual(password_hasher.stats()['calls'] - calls, 1)
+        # a higher cost makes the stored hash outdated, it still checks out
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertTrue(u.password_needs_rehash())
+        self.assertTrue(u.check_password('cat'))
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), '/avatar/d4c74594d841139328695756648b6bd6/128.png?v=1')
+            # sizes are rounded up to one of AVATAR_SIZES
+            self.assertEqual(u.avatar(50), '/avatar/d4c74594d841139328695756648b6bd6/70.png?v=1')
+        self.app.config['AVATAR_BACKEND'] = 'gravatar'
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_avatar_hash(self):
+        self.app.config['AVATAR_BACKEND'] = 'gravatar'
+        u = User(username='john', email='John@example.com')
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertEqual(u.avatar(70), ('https://www.gravatar.com/avatar/'
+                                        '{}?d=identicon&s=70'.format(
+                                            User.email_digest('susan@example.com'))))
+
+    def test_feed_loads_authors(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([Post(body='post from john', author=u1),
+                            Post(body='post from susan', author=u2)])
+        db.session.commit()
+        db.session.remove()
+        posts = explore_feed().all()
+        # the authors came with the posts, so reading them runs no query
+        self.assertTrue(all('author' in post.__dict__ for post in posts))
+        self.assertEqual(sorted(post.author.username for post in posts),
+                         ['john', 'susan'])
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -61,13 +165,13 @@ class UserModelCase(unittest.TestCase):
         # create four posts
         now = datetime.utcnow()
         p1 = Post(body="post from john", author=u1,
-                  timestamp=now + timedelta(seconds=1))
+                  timestame=now + timedelta(seconds=1))
         p2 = Post(body="post from susan", author=u2,
-                  timestamp=now + timedelta(seconds=4))
+                  timestame=now + timedelta(seconds=4))
         p3 = Post(body="post from mary", author=u3,
-                  timestamp=now + timedelta(seconds=3))
+                  timestame=now + timedelta(seconds=3))
         p4 = Post(body="post from david", author=u4,
-                  timestamp=now + timedelta(seconds=2))
+                  timestame=now + timedelta(seconds=2))
         db.session.add_all([p1, p2, p3, p4])
         db.session.commit()
 
@@ -78,15 +182,1559 @@ class UserModelCase(unittest.TestCase):
         u3.follow(u4)  # mary follows david
         db.session.commit()
 
-        # check the followed posts of each user
-        f1 = u1.followed_posts().all()
-        f2 = u2.followed_posts().all()
-        f3 = u3.followed_posts().all()
-        f4 = u4.followed_posts().all()
-        self.assertEqual(f1, [p2, p4, p1])
-        self.assertEqual(f2, [p2, p3])
-        self.assertEqual(f3, [p3, p4])
-        self.assertEqual(f4, [p4])
+        # check the followed posts of each user, read from the post table and through the timeline
+        for user, expected in ((u1, [p2, p4, p1]), (u2, [p2, p3]), (u3, [p3, p4]), (u4, [p4])):
+            self.assertEqual(user.followed_posts().all(), expected)
+            self.assertEqual(home_posts(user), expected)
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.add(Post(body="post from susan", author=u2))
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.following_count), (0, 1))
+        self.assertEqual((u2.followers_count, u2.posts_count), (1, 1))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.following_count, u2.followers_count), (0, 0))
+
+        # repair_counters puts counters that drifted back in line
+        u1.follow(u2)
+        u2.posts_count = 7
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 2)
+        db.session.commit()
+        self.assertEqual((u1.following_count, u2.followers_count), (1, 1))
+        self.assertEqual(u2.posts_count, 1)
+
+    def test_cached_user_loader(self):
+        user_cache.clear()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        before = user_cache.stats()
+        self.assertEqual(load_user(str(u.id)).username, 'john')
+        db.session.remove()
+        cached = load_user(str(u.id))
+        self.assertEqual(cached.username, 'john')
+        stats = user_cache.stats()
+        self.assertEqual(stats['misses'] - before['misses'], 1)
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+
+        # changing the user drops the cached copy
+        cached.username = 'johnny'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(str(u.id)).username, 'johnny')
+        self.assertEqual(user_cache.stats()['misses'] - stats['misses'], 1)
+        cached = load_user(str(u.id))
+        cached.set_password('cat')
+        self.assertIsNone(user_cache.get(u.id))
+
+    def test_timeline_fan_out(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # a new post is copied to the author and to every follower
+        p1 = Post(body="post from susan", author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(post_id=p1.id).count(), 2)
+        self.assertEqual(home_posts(u1), [p1])
+
+        # unfollowing prunes the timeline and following again backfills it
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(home_posts(u1), [])
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(home_posts(u1), [p1])
+
+    def test_timeline_fan_out_on_read(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        p1 = Post(body="post from susan", author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        # susan has more followers than the limit so the post is only materialized for her, john reads it through the fallback
+        self.assertEqual(Timeline.query.filter_by(post_id=p1.id).count(), 1)
+        self.assertEqual(home_posts(u1), [p1])
+
+    def test_timeline_fan_out_limit_crossed_down(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        self.app.config['TIMELINE_LENGTH'] = 2
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u3, timestame=now - timedelta(seconds=i))
+                 for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        # mary has more followers than the limit, her posts are read on the fly
+        self.assertEqual(Timeline.query.filter_by(user_id=u1.id).count(), 0)
+        self.assertEqual(home_posts(u1), posts)
+
+        # once she is back at the limit her latest posts are copied to the timelines of her followers, and the older ones are read from the post table
+        u2.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.fanout_on_read_ids(), [])
+        self.assertEqual(Timeline.query.filter_by(user_id=u1.id).count(), 2)
+        self.assertEqual(u1.timeline_horizon, posts[2].timestame)
+        self.assertEqual(home_posts(u1), posts)
+
+    def test_timeline_horizon(self):
+        self.app.config['TIMELINE_LENGTH'] = 3
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u2, timestame=now - timedelta(seconds=i))
+                 for i in range(6)]
+        db.session.add_all([u1, u2] + posts)
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        # only the latest 3 posts are copied, the older ones are read from the post table
+        self.assertEqual(Timeline.query.filter_by(user_id=u1.id).count(), 3)
+        self.assertEqual(u1.timeline_horizon, posts[3].timestame)
+        self.assertEqual(home_posts(u1), posts)
+        pages, cursor = [], None
+        while True:
+            page = keyset_paginate(home_feed(u1), cursor, 2)
+            pages.extend(page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(pages, posts)
+
+        # a new post goes to the timeline, above the horizon
+        p = Post(body='new post', author=u2, timestame=now + timedelta(seconds=1))
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(home_posts(u1), [p] + posts)
+
+        # the rebuild sets the same horizon
+        expected = [post.id for post in [p] + posts]
+        horizon = posts[2].timestame
+        result = self.app.test_cli_runner().invoke(args=['timeline', 'rebuild'])
+        self.assertIn('Copied 6 posts to the timelines.', result.output)
+        u1 = User.query.filter_by(username='john').one()
+        self.assertEqual(u1.timeline_horizon, horizon)
+        self.assertEqual([post.id for post in home_posts(u1)], expected)
+
+class KeysetPaginationCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_walk_pages(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        # two pairs of posts share a timestamp, the id breaks the tie
+        posts = [Post(body='post {}'.format(i), author=u,
+                      timestame=now - timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        query = Post.query.order_by(Post.timestame.desc())
+        expected = query.order_by(None).order_by(
+            Post.timestame.desc(), Post.id.desc()).all()
+
+        first = keyset_paginate(query, None, 3)
+        self.assertEqual(first.items, expected[:3])
+        self.assertFalse(first.has_prev)
+        second = keyset_paginate(query, first.next_cursor, 3)
+        self.assertEqual(second.items, expected[3:6])
+        third = keyset_paginate(query, second.next_cursor, 3)
+        self.assertEqual(third.items, expected[6:])
+        self.assertFalse(third.has_next)
+
+        # walking back lands on the same pages
+        back = keyset_paginate(query, third.prev_cursor, 3)
+        self.assertEqual(back.items, expected[3:6])
+        back = keyset_paginate(query, back.prev_cursor, 3)
+        self.assertEqual(back.items, expected[:3])
+        self.assertFalse(back.has_prev)
+
+    def test_followed_posts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=u,
+                                 timestame=now - timedelta(seconds=i))
+                            for i, u in enumerate([u1, u2, u1, u2, u1])])
+        db.session.commit()
+        expected = u1.followed_posts().all()
+        first = keyset_paginate(home_feed(u1), None, 2)
+        second = keyset_paginate(home_feed(u1), first.next_cursor, 2)
+        third = keyset_paginate(home_feed(u1), second.next_cursor, 2)
+        self.assertEqual(first.items + second.items + third.items, expected)
+        self.assertFalse(third.has_next)
+
+class LastSeenTrackerCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_coalesced_writes(self):
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 30
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        start = u1.last_seen
+        tracker = LastSeenTracker()
+
+        # changes smaller than the granularity are not recorded at all
+        self.assertFalse(tracker.seen(u1, start + timedelta(seconds=1)))
+        later = start + timedelta(minutes=5)
+        self.assertTrue(tracker.seen(u1, later))
+        self.assertTrue(tracker.seen(u2, later))
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u1.id).last_seen, start)
+
+        # both users are written by a single flush
+        self.assertEqual(tracker.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u1.id).last_seen, later)
+        self.assertEqual(User.query.get(u2.id).last_seen, later)
+        self.assertEqual(tracker.flush(), 0)
+
+    def test_flush_interval(self):
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 30
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        start = u.last_seen
+        tracker = LastSeenTracker()
+        job = LastSeenFlushJob(tracker)
+        job.init_app(self.app)
+        later = start + timedelta(minutes=5)
+        self.assertTrue(tracker.seen(u, later))
+        # the time stays pending until the interval has passed, even without another request
+        self.assertGreater(job.run_if_due(), 0)
+        self.assertEqual(tracker.pending, {u.id: later})
+        tracker.last_flush -= 30
+        self.assertEqual(job.run_if_due(), 30)
+        self.assertEqual(tracker.pending, {})
+        self.assertEqual(job.stats()['runs'], 1)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u.id).last_seen, later)
+        # nothing pending, nothing to run
+        tracker.last_flush -= 30
+        job.run_if_due()
+        self.assertEqual(job.stats()['runs'], 1)
+
+class FragmentCacheCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        fragment_cache.reset()
+
+    def tearDown(self):
+        fragment_cache.reset()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_render_post(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='post from john', author=u)
+        db.session.add(p)
+        db.session.commit()
+        with self.app.test_request_context():
+            misses = fragment_cache.misses
+            html = fragment_cache.render_post(p)
+            self.assertIn('post from john', html)
+            self.assertEqual(fragment_cache.render_post(p), html)
+            self.assertEqual(fragment_cache.misses - misses, 1)
+
+            # a new username gives the author a new version, so the post is rendered again
+            u.username = 'johnny'
+            db.session.commit()
+            self.assertIn('johnny', fragment_cache.render_post(p))
+            self.assertEqual(fragment_cache.misses - misses, 2)
+
+    def test_filesystem_backend(self):
+        backend = fragment_cache.backends['filesystem'](2, tempfile.mkdtemp())
+        try:
+            backend.set('post/1', 'v1', '<p>one</p>')
+            self.assertEqual(backend.get('post/1'), ('v1', '<p>one</p>'))
+            backend.delete('post/1')
+            self.assertIsNone(backend.get('post/1'))
+            for i in range(3):
+                backend.set('post/{}'.format(i), 'v1', 'x')
+            backend.prune()
+            self.assertEqual(len(os.listdir(backend.directory)), 2)
+        finally:
+            shutil.rmtree(backend.directory)
+
+class SearchCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat on the mat', author=u)
+        p2 = Post(body='a cat, another cat and one more cat', author=u)
+        p3 = Post(body='no animals here', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+
+        posts, total = search.query('cat', 1, 10)
+        self.assertEqual(total, 2)
+        # the post that mentions cats the most ranks first
+        self.assertEqual(posts, [p2, p1])
+        self.assertEqual(search.query('cat mat', 1, 10), ([p1], 1))
+        self.assertEqual(search.query('cat', 2, 1), ([p1], 2))
+        # text that looks like FTS5 syntax is searched for as words
+        self.assertEqual(search.query('"cat" OR', 1, 10), ([], 0))
+
+        # updates and deletes are reflected in the index
+        p3.body = 'a cat after all'
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(sorted(p.id for p in search.query('cat', 1, 10)[0]),
+                         [p2.id, p3.id])
+
+    def test_reindex(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(Post(body='the cat sat on the mat', author=u))
+        db.session.commit()
+        db.session.execute('DELETE FROM post_fts')
+        self.assertEqual(search.query('cat', 1, 10)[1], 0)
+        self.assertEqual(search.reindex(), 1)
+        self.assertEqual(search.query('cat', 1, 10)[1], 1)
+
+class SeedCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_seed(self):
+        edges = seed(50, 300, mean_follows=5, random_seed=1)
+        self.assertEqual(User.query.count(), 50)
+        self.assertEqual(Post.query.count(), 300)
+        # the bulk loaded data ends up exactly as if it had gone through the ORM
+        self.assertEqual(db.session.query(db.func.sum(User.following_count)).scalar(), edges)
+        self.assertEqual(db.session.query(db.func.sum(User.posts_count)).scalar(), 300)
+        u = max(User.query.all(), key=lambda user: user.following_count)
+        followed = Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(
+            followers.c.follower_id == u.id)
+        expected = followed.union(Post.query.filter_by(user_id=u.id)).order_by(
+            Post.timestame.desc()).all()
+        self.assertEqual(u.followed_posts().all(), expected)
+        self.assertEqual(home_posts(u), expected)
+        self.assertEqual(search.query('cat', 1, 1)[1],
+                         Post.query.filter(Post.body.like('%cat%')).count())
+
+class MetricsCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, client, user):
+        with client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def test_histogram(self):
+        h = Histogram('test_seconds', 'A test.', (0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            h.observe('index', value)
+        lines = h.render()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{endpoint="index",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{endpoint="index",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{endpoint="index",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{endpoint="index"} 6.05', lines)
+        self.assertIn('test_seconds_count{endpoint="index"} 4', lines)
+
+    def test_metrics_endpoint(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        self.login(client, u)
+        before = scrape(client)
+        self.assertEqual(client.get('/explore').status_code, 200)
+        response = client.get('/metrics', headers={'Authorization': 'Bearer scraper'})
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertNotEqual(text, before)
+        for name in ('microblog_request_duration_seconds', 'microblog_request_sql_queries',
+                     'microblog_request_sql_duration_seconds',
+                     'microblog_request_render_duration_seconds'):
+            self.assertIn('{}_count{{endpoint="main.explore"}}'.format(name), text)
+        self.assertIn('microblog_user_cache_hits_total', text)
+
+    def test_metrics_token(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/metrics').status_code, 401)
+        self.assertEqual(client.get('/metrics', headers={
+            'Authorization': 'Bearer guess'}).status_code, 401)
+        # without a token the page isn't there at all
+        self.app.config['METRICS_TOKEN'] = None
+        self.assertEqual(client.get('/metrics', headers={
+            'Authorization': 'Bearer scraper'}).status_code, 404)
+
+    def test_query_budget(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        self.login(client, u)
+        self.app.config['METRICS_QUERY_BUDGET'] = 1
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            client.get('/user/john')
+        self.assertIn('GET /user/john? ran', logs.output[0])
+        self.assertIn('(budget 1)', logs.output[0])
+
+
+class DatabaseCase(unittest.TestCase):
+
+    def setUp(self):
+        # files rather than in-memory databases, as the journal mode only applies to files and the replica has to be a database of its own
+        directory = self.directory = tempfile.mkdtemp()
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'primary.db')
+            DATABASE_REPLICA_URLS = ['sqlite:///' + os.path.join(directory, 'replica.db')]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.replica = db.get_engine(self.app, bind='replica0')
+        db.Model.metadata.create_all(self.replica)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def add_user(self, session, body):
+        u = User(id=1, username='john', email='john@example.com')
+        session.add(Post(body=body, author=u))
+        session.commit()
+
+    def test_sqlite_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        # 1 is NORMAL
+        self.assertEqual(db.session.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(db.session.execute('PRAGMA cache_size').scalar(), -20000)
+
+    def test_pool_options(self):
+        options = {}
+        db.apply_driver_hacks(self.app, make_url('postgresql://localhost/microblog'), options)
+        self.assertEqual((options['pool_size'], options['max_overflow'], options['pool_recycle']),
+                         (10, 20, 1800))
+
+    def test_read_only_views_use_replica(self):
+        self.add_user(db.session, 'post on the primary')
+        replica_session = db.create_scoped_session({'bind': self.replica, 'binds': {}})
+        self.add_user(replica_session, 'post on the replica')
+        replica_session.remove()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = '1'
+            session['_fresh'] = True
+        for url in ('/explore', '/user/john'):
+            page = client.get(url).get_data(as_text=True)
+            self.assertIn('post on the replica', page)
+            self.assertNotIn('post on the primary', page)
+        page = client.get('/index').get_data(as_text=True)
+        self.assertIn('post on the primary', page)
+
+    def test_writes_go_to_primary(self):
+        db.session.info['replica'] = 'replica0'
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.assertEqual(self.replica.execute('SELECT count(*) FROM user').scalar(), 0)
+        self.assertEqual(db.engine.execute('SELECT count(*) FROM user').scalar(), 1)
+
+
+class ConditionalGetCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user_cache.clear()
+        self.u = User(username='john', email='john@example.com')
+        db.session.add(Post(body='first post', author=self.u))
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(self.u.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_explore(self):
+        response = self.client.get('/explore')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertNotIn('Last-Modified', response.headers)
+        self.assertIn('private', response.headers['Cache-Control'])
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        # the time of the newest post doesn't validate a copy, the page also shows the viewer
+        response = self.client.get('/explore', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+        # a new post makes the old copy out of date
+        db.session.add(Post(body='second post', author=self.u,
+                            timestame=datetime.utcnow() + timedelta(seconds=5)))
+        db.session.commit()
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('second post', response.get_data(as_text=True))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_user_profile_change(self):
+        etag = self.client.get('/user/john').headers['ETag']
+        self.assertEqual(self.client.get('/user/john', headers={
+            'If-None-Match': etag}).status_code, 304)
+        self.u.about_me = 'hello'
+        db.session.commit()
+        response = self.client.get('/user/john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hello', response.get_data(as_text=True))
+
+    def test_flashed_message_is_rendered(self):
+        etag = self.client.get('/explore').headers['ETag']
+        with self.client.session_transaction() as session:
+            session['_flashes'] = [('message', 'flashed message')]
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('flashed message', response.get_data(as_text=True))
+
+
+class APICase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user_cache.clear()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+        self.u1.follow(self.u2)
+        db.session.commit()
+        self.now = datetime.utcnow()
+        self.posts = [Post(body='post {}'.format(i), author=[self.u1, self.u2][i % 2],
+                           timestame=self.now - timedelta(seconds=10 - i)) for i in range(5)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self):
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(self.u1.id)
+            session['_fresh'] = True
+
+    def bodies(self, response):
+        return [post['body'] for post in response.get_json()['posts']]
+
+    def test_login_required(self):
+        response = self.client.get('/api/timeline')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json()['error'], 'Unauthorized')
+
+    def test_max_id(self):
+        self.login()
+        response = self.client.get('/api/timeline?count=2')
+        data = response.get_json()
+        self.assertEqual(self.bodies(response), ['post 4', 'post 3'])
+        self.assertTrue(data['has_more'])
+        # every author is listed once, next to the posts that refer to them by id
+        self.assertEqual(sorted(user['username'] for user in data['users']), ['john', 'susan'])
+        self.assertEqual(data['posts'][0]['author_id'], self.u1.id)
+        self.assertTrue(data['_links']['older'].startswith('/api/v1/timeline?'))
+        response = self.client.get(data['_links']['older'])
+        self.assertEqual(self.bodies(response), ['post 2', 'post 1'])
+        response = self.client.get(response.get_json()['_links']['older'])
+        self.assertEqual(self.bodies(response), ['post 0'])
+        self.assertNotIn('older', response.get_json()['_links'])
+
+    def test_since_id(self):
+        self.login()
+        newer = self.client.get('/api/v1/timeline').get_json()['_links']['newer']
+        self.assertEqual(self.bodies(self.client.get(newer)), [])
+        new = [Post(body='new {}'.format(i), author=self.u2,
+                    timestame=self.now + timedelta(seconds=i + 1)) for i in range(3)]
+        db.session.add_all(new)
+        db.session.commit()
+        # a client that is behind gets the posts right after its newest one first
+        response = self.client.get('/api/timeline?since_id={}&count=2'.format(self.posts[4].id))
+        self.assertEqual(self.bodies(response), ['new 1', 'new 0'])
+        self.assertTrue(response.get_json()['has_more'])
+        response = self.client.get(response.get_json()['_links']['newer'])
+        self.assertEqual(self.bodies(response), ['new 2'])
+        self.assertFalse(response.get_json()['has_more'])
+
+    def test_since_id_past_the_horizon(self):
+        self.app.config['TIMELINE_LENGTH'] = 2
+        u3 = User(username='mary', email='mary@example.com')
+        # the two oldest posts of mary are archived, of the others only the latest two are copied to john's timeline
+        posts = [Post(body='mary {}'.format(i), author=u3,
+                      timestame=self.now - timedelta(days=2, seconds=10 - i)) for i in range(2)]
+        posts += [Post(body='mary {}'.format(i), author=u3,
+                       timestame=self.now - timedelta(seconds=100 - i)) for i in range(2, 6)]
+        db.session.add_all([u3] + posts)
+        db.session.commit()
+        self.u1.follow(u3)
+        db.session.commit()
+        ids = [post.id for post in posts]
+        self.assertEqual(self.u1.timeline_horizon, posts[3].timestame)
+        self.assertEqual(archive.archive_posts(days=1), 2)
+        self.login()
+        response = self.client.get('/api/timeline?since_id={}&count=3'.format(ids[2]))
+        self.assertEqual(self.bodies(response), ['mary 5', 'mary 4', 'mary 3'])
+        response = self.client.get('/api/timeline?since_id={}&count=3'.format(ids[0]))
+        self.assertEqual(self.bodies(response), ['mary 3', 'mary 2', 'mary 1'])
+        response = self.client.get('/api/timeline?max_id={}'.format(ids[2]))
+        self.assertEqual(self.bodies(response), ['mary 1', 'mary 0'])
+
+    def test_user_posts_and_explore(self):
+        self.login()
+        response = self.client.get('/api/users/susan/posts')
+        self.assertEqual(self.bodies(response), ['post 3', 'post 1'])
+        self.assertEqual(self.client.get('/api/users/nobody/posts').status_code, 404)
+        response = self.client.get('/api/explore?max_id={}'.format(self.posts[2].id))
+        self.assertEqual(self.bodies(response), ['post 1', 'post 0'])
+
+    def test_bad_parameters(self):
+        self.login()
+        self.assertEqual(self.client.get('/api/explore?since_id=abc').status_code, 400)
+        response = self.client.get('/api/explore?since_id=1000')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('since_id', response.get_json()['message'])
+
+
+class ExportCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user_cache.clear()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        self.u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.u1, self.u2, self.u3])
+        db.session.commit()
+        self.u1.follow(self.u2)
+        self.u3.follow(self.u1)
+        db.session.add_all([Post(body='post, with "quotes" {}'.format(i), author=self.u1)
+                            for i in range(3)])
+        db.session.add(Post(body='not mine', author=self.u2))
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(self.u1.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_posts_ndjson(self):
+        response = self.client.get('/export/posts.ndjson')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertIn('john-posts.ndjson', response.headers['Content-Disposition'])
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([row['body'] for row in rows],
+                         ['post, with "quotes" {}'.format(i) for i in range(3)])
+        self.assertEqual(sorted(rows[0]), ['body', 'id', 'timestamp'])
+
+    def test_follows_csv_gzip(self):
+        response = self.client.get('/export/follows.csv.gz')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        text = gzip.decompress(response.get_data()).decode('utf-8')
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(rows, [['follower_id', 'follower', 'followed_id', 'followed'],
+                                [str(self.u1.id), 'john', str(self.u2.id), 'susan'],
+                                [str(self.u3.id), 'mary', str(self.u1.id), 'john']])
+        self.assertEqual(self.client.get('/export/everything.csv').status_code, 404)
+
+    def test_cli(self):
+        result = self.app.test_cli_runner().invoke(args=['export', 'posts', 'john',
+                                                         '--format', 'csv'])
+        self.assertEqual(result.exit_code, 0)
+        rows = list(csv.reader(io.StringIO(result.output)))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][2], 'post, with "quotes" 0')
+        result = self.app.test_cli_runner().invoke(args=['export', 'posts', 'nobody'])
+        self.assertNotEqual(result.exit_code, 0)
+
+
+class SuggestionsCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user_cache.clear()
+        names = ['john', 'susan', 'mary', 'david', 'ann', 'kate']
+        self.users = {name: User(username=name, email=name + '@example.com') for name in names}
+        db.session.add_all(self.users.values())
+        db.session.commit()
+        for follower, followed in [('john', 'susan'), ('john', 'mary'), ('susan', 'david'),
+                                   ('mary', 'david'), ('mary', 'ann'), ('kate', 'john'),
+                                   ('kate', 'susan')]:
+            self.users[follower].follow(self.users[followed])
+        db.session.commit()
+        suggestions.rebuild()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def suggested(self, name):
+        return [(user.username, score) for user, score in self.users[name].suggestions()]
+
+    def test_rebuild(self):
+        self.assertEqual(self.suggested('john'), [('david', 2), ('ann', 1)])
+        # ties go to the lower id
+        self.assertEqual(self.suggested('kate'), [('mary', 1), ('david', 1)])
+        self.assertEqual(self.suggested('ann'), [])
+
+    def test_graph(self):
+        graph = suggestions.FollowGraph.load()
+        self.assertEqual(len(graph), 6)
+        john = list(graph.ids).index(self.users['john'].id)
+        self.assertEqual(sorted(graph.ids[i] for i in graph.following(john)),
+                         sorted([self.users['susan'].id, self.users['mary'].id]))
+
+    def test_matches_self_join(self):
+        seed(50, 0, mean_follows=8, random_seed=3)
+        self.app.config['SUGGESTIONS_PER_USER'] = 1000
+        suggestions.rebuild()
+        via, back = followers.alias(), followers.alias()
+        for user in User.query.limit(10):
+            followed = [id for id, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == user.id)]
+            expected = db.session.query(back.c.followed_id, db.func.count()).filter(
+                via.c.follower_id == user.id, back.c.follower_id == via.c.followed_id,
+                back.c.followed_id != user.id, back.c.followed_id.notin_(followed or [0])).group_by(
+                    back.c.followed_id).all()
+            self.assertEqual(sorted((u.id, score) for u, score in user.suggestions()),
+                             sorted(expected))
+
+    def test_follow(self):
+        self.users['david'].follow(self.users['ann'])
+        self.users['john'].follow(self.users['david'])
+        db.session.commit()
+        # david is followed now, ann is also followed by david, and for kate david is followed by one more of the users she follows
+        self.assertEqual(self.suggested('john'), [('ann', 2)])
+        self.assertEqual(self.suggested('kate'), [('david', 2), ('mary', 1)])
+
+    def test_follow_of_followed(self):
+        # kate follows john, who now follows ann, so ann is suggested to kate without a rebuild
+        self.users['john'].follow(self.users['ann'])
+        self.users['susan'].follow(self.users['ann'])
+        db.session.commit()
+        incremental = {name: self.suggested(name) for name in self.users}
+        self.assertEqual(incremental['kate'], [('ann', 2), ('mary', 1), ('david', 1)])
+        suggestions.rebuild()
+        db.session.commit()
+        self.assertEqual({name: self.suggested(name) for name in self.users}, incremental)
+
+    def test_follow_of_followed_limits(self):
+        self.app.config['SUGGESTIONS_PER_USER'] = 2
+        suggestions.rebuild()
+        self.users['john'].follow(self.users['ann'])
+        db.session.commit()
+        # the list of kate is trimmed again
+        self.assertEqual(self.suggested('kate'), [('mary', 1), ('david', 1)])
+        # users with more followers than the fan-out limit only update the lists that have the candidate already
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        self.users['susan'].follow(self.users['kate'])
+        db.session.commit()
+        self.assertEqual(Suggestion.query.filter_by(candidate_id=self.users['kate'].id).count(), 0)
+
+    def test_unfollow(self):
+        self.users['john'].unfollow(self.users['mary'])
+        db.session.commit()
+        self.assertEqual(self.suggested('john'), [('david', 1)])
+        self.assertEqual(self.suggested('kate'), [('david', 1)])
+        # the incremental updates leave the same lists as a rebuild
+        self.users['kate'].unfollow(self.users['john'])
+        db.session.commit()
+        incremental = {name: self.suggested(name) for name in self.users}
+        suggestions.rebuild()
+        db.session.commit()
+        self.assertEqual({name: self.suggested(name) for name in self.users}, incremental)
+        self.assertEqual(incremental['kate'], [('david', 1)])
+
+    def test_limit(self):
+        self.app.config['SUGGESTIONS_PER_USER'] = 1
+        suggestions.rebuild()
+        self.assertEqual(self.suggested('john'), [('david', 2)])
+        self.assertEqual(Suggestion.query.filter_by(user_id=self.users['john'].id).count(), 1)
+
+    def test_page(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(self.users['john'].id)
+            session['_fresh'] = True
+        page = client.get('/suggestions').get_data(as_text=True)
+        self.assertIn('david', page)
+        self.assertIn('Followed by 2 users you follow', page)
+        result = self.app.test_cli_runner().invoke(args=['suggestions', 'rebuild'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Wrote 4 suggestions', result.output)
+
+
+class TrendingCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user_cache.clear()
+        self.popular = User(username='john', email='john@example.com', followers_count=1000)
+        self.quiet = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.popular, self.quiet])
+        now = datetime.utcnow()
+        self.posts = [Post(body='popular, new', author=self.popular, timestame=now - timedelta(minutes=10)),
+                      Post(body='quiet, new', author=self.quiet, timestame=now - timedelta(minutes=5)),
+                      Post(body='popular, old', author=self.popular, timestame=now - timedelta(hours=30)),
+                      Post(body='popular, too old', author=self.popular, timestame=now - timedelta(days=5))]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(self.quiet.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_rank(self):
+        self.assertEqual(trending.rebuild(), 3)
+        ranked = Post.query.join(TrendingPost, TrendingPost.post_id == Post.id).order_by(
+            TrendingPost.rank).all()
+        self.assertEqual([p.body for p in ranked], ['popular, new', 'quiet, new', 'popular, old'])
+        self.assertIsNotNone(trending.computed_at())
+
+    def test_page(self):
+        self.assertIn('Nothing is trending yet', self.client.get('/explore?mode=trending').get_data(as_text=True))
+        trending.trending_job.run()
+        self.app.config['POSTS_PER_PAGE'] = 2
+        page = self.client.get('/explore?mode=trending').get_data(as_text=True)
+        self.assertLess(page.index('popular, new'), page.index('quiet, new'))
+        self.assertNotIn('popular, old', page)
+        self.assertIn('mode=trending&amp;page=2', page)
+        page = self.client.get('/explore?mode=trending&page=2').get_data(as_text=True)
+        self.assertIn('popular, old', page)
+        # new posts only show up once the snapshot is rebuilt
+        db.session.add(Post(body='brand new', author=self.popular))
+        db.session.commit()
+        self.assertNotIn('brand new', self.client.get('/explore?mode=trending').get_data(as_text=True))
+        self.assertIn('brand new', self.client.get('/explore').get_data(as_text=True))
+
+    def test_job(self):
+        job = TrendingJob()
+        job.init_app(self.app)
+        # TRENDING_INTERVAL is 0 in the tests, which means no thread
+        job.start()
+        self.assertIsNone(job.thread)
+        self.app.config['TRENDING_INTERVAL'] = 60
+        self.assertEqual(job.run_if_due(), 60)
+        # the snapshot is fresh, so the next run is only due later
+        self.assertLessEqual(job.run_if_due(), 60)
+        stats = job.stats()
+        self.assertEqual((stats['runs'], stats['failures']), (1, 0))
+        self.assertLess(stats['age'], 60)
+
+    def test_metrics(self):
+        text = scrape(self.client)
+        self.assertIn('microblog_trending_runs_total', text)
+        self.assertNotIn('microblog_trending_snapshot_age_seconds', text)
+        trending.trending_job.run()
+        text = scrape(self.client)
+        self.assertIn('microblog_trending_snapshot_age_seconds', text)
+
+    def test_cli(self):
+        result = self.app.test_cli_runner().invoke(args=['trending', 'rebuild'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Ranked 3 posts', result.output)
+
+
+class ArchiveCase(unittest.TestCase):
+    'posts older than ARCHIVE_AFTER_DAYS move to the archive, and the feeds, the API, search and exports carry on into it'
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['ARCHIVE_AFTER_DAYS'] = 30
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.john.follow(self.susan)
+        now = datetime.utcnow()
+        # posts 0 to 4 are old enough to be archived, 5 to 7 are not
+        self.posts = [Post(body='post {}'.format(i), author=self.susan if i % 2 else self.john,
+                           timestame=now - timedelta(days=80 - i * 10 if i < 5 else 8 - i))
+                      for i in range(8)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        # the post objects are gone from the session once they are archived
+        self.ids = [post.id for post in self.posts]
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(self.john.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def bodies(self, posts):
+        return [int(post.body.split()[1]) for post in posts]
+
+    def test_move(self):
+        self.assertEqual(archive.archive_posts(batch_size=2), 5)
+        self.assertEqual(sorted(id for id, in db.session.query(Post.id)),
+                         self.ids[5:])
+        self.assertEqual(self.bodies(ArchivedPost.query.order_by(ArchivedPost.id)), [0, 1, 2, 3, 4])
+        # the timelines only point at the posts left in the post table
+        self.assertEqual(Timeline.query.filter(Timeline.post_id.in_(
+            self.ids[:5])).count(), 0)
+        self.assertEqual(archive.archive_posts(), 0)
+        sizes = archive.partition_sizes()
+        self.assertEqual([(size['table'], size['posts']) for size in sizes],
+                         [('post', 3), ('post_archive', 5)])
+        # archived posts still count
+        User.repair_counters()
+        self.assertEqual((self.john.posts_count, self.susan.posts_count), (4, 4))
+
+    def test_keep_last_post(self):
+        # with every post old enough, the one with the highest id stays so that its id is never handed out again
+        self.assertEqual(archive.archive_posts(days=0), 7)
+        self.assertEqual([post.id for post in Post.query], [self.ids[-1]])
+        post = Post(body='post 8', author=self.john)
+        db.session.add(post)
+        db.session.commit()
+        self.assertGreater(post.id, self.ids[-1])
+
+    def test_pages(self):
+        archive.archive_posts()
+        newest_first = list(range(7, -1, -1))
+        pages, cursor = [], None
+        while True:
+            page = keyset_paginate([explore_feed(), explore_archive()], cursor, 3)
+            pages.append(self.bodies(page.items))
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(pages, [[7, 6, 5], [4, 3, 2], [1, 0]])
+        back = keyset_paginate([explore_feed(), explore_archive()], page.prev_cursor, 3)
+        self.assertEqual(self.bodies(back.items), [4, 3, 2])
+        back = keyset_paginate([explore_feed(), explore_archive()], back.prev_cursor, 3)
+        self.assertEqual(self.bodies(back.items), [7, 6, 5])
+        self.assertFalse(back.has_prev)
+        # the feeds of the pages go on into the archive as well
+        self.app.config['POSTS_PER_PAGE'] = 3
+        for url, expected in (('/index', newest_first), ('/explore', newest_first),
+                              ('/user/susan', [7, 5, 3, 1])):
+            seen = []
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                page = response.get_data(as_text=True)
+                seen += [int(i) for i in re.findall(r'^\s*post (\d)$', page, re.M)]
+                older = re.search(r'<li class="next">\s*<a href="([^"]+)"', page)
+                url = older and older.group(1).replace('&amp;', '&')
+            self.assertEqual(seen, expected)
+
+    def test_page_numbers(self):
+        archive.archive_posts()
+        # the old ?page= numbers start each page after the post found by an OFFSET on the partitions' keys
+        for feed in ([explore_feed(), explore_archive()], home_feed(self.john)):
+            pages = [offset_page(feed, page, 3) for page in range(1, 4)]
+            self.assertEqual([(self.bodies(posts), has_next) for posts, has_next in pages],
+                             [([7, 6, 5], True), ([4, 3, 2], True), ([1, 0], False)])
+            self.assertEqual(offset_page(feed, 100000, 3), ([], False))
+
+    def test_api(self):
+        archive.archive_posts()
+        response = self.client.get('/api/explore?count=4')
+        self.assertEqual([p['body'] for p in response.get_json()['posts']],
+                         ['post 7', 'post 6', 'post 5', 'post 4'])
+        older = response.get_json()['_links']['older']
+        self.assertEqual([p['body'] for p in self.client.get(older).get_json()['posts']],
+                         ['post 3', 'post 2', 'post 1', 'post 0'])
+        # ids of archived posts still work in both directions
+        response = self.client.get('/api/explore?count=2&since_id={}'.format(self.ids[2]))
+        self.assertEqual([p['body'] for p in response.get_json()['posts']], ['post 4', 'post 3'])
+        response = self.client.get('/api/explore?count=2&since_id={}'.format(self.ids[4]))
+        self.assertEqual([p['body'] for p in response.get_json()['posts']], ['post 6', 'post 5'])
+        response = self.client.get('/api/users/susan/posts?max_id={}'.format(self.ids[5]))
+        self.assertEqual([p['body'] for p in response.get_json()['posts']], ['post 3', 'post 1'])
+
+    def test_bad_cursor(self):
+        # a cursor into a partition the feed doesn't have
+        cursor = encode_cursor('a', self.posts[0], 5)
+        self.assertEqual(self.client.get('/explore?cursor=' + cursor).status_code, 400)
+
+    def test_search_and_export(self):
+        archive.archive_posts()
+        posts, total = search.query('post', 1, 10)
+        self.assertEqual((sorted(self.bodies(posts)), total), (list(range(8)), 8))
+        self.assertEqual(search.reindex(), 8)
+        rows = list(post_rows(self.susan))
+        self.assertEqual([row[2] for row in rows], ['post 1', 'post 3', 'post 5', 'post 7'])
+
+    def test_cli(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['archive', 'run', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Moved 5 posts', result.output)
+        result = runner.invoke(args=['archive', 'status'])
+        self.assertIn('post: 3 posts', result.output)
+        self.assertIn('post_archive: 5 posts', result.output)
+
+    def test_job(self):
+        job = archive.ArchiveJob()
+        job.init_app(self.app)
+        job.start()
+        self.assertIsNone(job.thread)
+        self.assertEqual(job.run(), 5)
+        self.assertEqual(job.stats()['runs'], 1)
+        self.assertIn('microblog_archive_runs_total', scrape(self.client))
+
+
+class QueryPlanCase(unittest.TestCase):
+    '''
+    Runs EXPLAIN QUERY PLAN on the queries behind every page view and follow, so that a change to a query or to the schema that makes SQLite stop using an index fails here instead of slowing the site down once the tables are large
+    '''
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def plan(self, query):
+        'the detail column of the plan of query, one string per step'
+        statement = getattr(query, 'statement', query).compile(db.engine)
+        params = tuple(statement.params[name] for name in statement.positiontup)
+        return [row[3] for row in db.engine.execute(
+            'EXPLAIN QUERY PLAN ' + str(statement), params)]
+
+    def assertSearches(self, query, table, index):
+        'query looks rows of table up through index, rather than reading the whole table'
+        plan = self.plan(query)
+        self.assertTrue(any(step.startswith('SEARCH {} '.format(table)) and index in step
+                            for step in plan), plan)
+        self.assertFalse(any(step == 'SCAN {}'.format(table) for step in plan), plan)
+
+    def test_follows(self):
+        self.assertSearches(self.u1.followed.filter(followers.c.followed_id == self.u2.id),
+                            'followers', 'sqlite_autoindex_followers_1 (follower_id=? AND followed_id=?)')
+        self.assertSearches(self.u1.followed, 'followers', 'sqlite_autoindex_followers_1 (follower_id=?)')
+        self.assertSearches(self.u1.followers, 'followers', 'ix_followers_followed_id_follower_id (followed_id=?)')
+
+    def test_fan_out(self):
+        # the followers a new post is copied to, and the popular users merged into a timeline when it is read
+        self.assertSearches(select([followers.c.follower_id]).where(followers.c.followed_id == self.u1.id),
+                            'followers', 'ix_followers_followed_id_follower_id')
+        self.assertSearches(db.session.query(followers.c.followed_id).join(
+            User, User.id == followers.c.followed_id).filter(
+                followers.c.follower_id == self.u1.id, User.followers_count > 1),
+                            'followers', 'sqlite_autoindex_followers_1')
+
+    def test_feeds(self):
+        newest_first = (Post.timestame.desc(), Post.id.desc())
+        # a page of the home timeline is a range of its index, both the first page and a page after a cursor, without sorting the reader's timeline
+        timeline = Source(home_timeline(self.u1), Timeline.timestame, Timeline.post_id)
+        for page in (timeline.query.limit(3),
+                     older_than(timeline, datetime.utcnow(), 10).limit(3)):
+            self.assertSearches(page, 'timeline', 'ix_timeline_user_id_timestame_post_id (user_id=?')
+            self.assertFalse(any('TEMP B-TREE' in step for step in self.plan(page)), self.plan(page))
+        self.assertIn('(user_id=? AND timestame<?)', ' '.join(self.plan(
+            older_than(timeline, datetime.utcnow(), 10).limit(3))))
+        self.assertSearches(user_feed(self.u1).order_by(None).order_by(*newest_first).limit(3),
+                            'post', 'ix_post_user_id_timestame_id (user_id=?)')
+        # the explore feed reads the newest posts in index order, without sorting them
+        plan = self.plan(explore_feed().order_by(None).order_by(*newest_first).limit(3))
+        self.assertTrue(any(step.startswith('SCAN post USING') and 'INDEX ix_post_timestame' in step
+                            for step in plan), plan)
+        self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
+    def test_archive(self):
+        newest_first = (ArchivedPost.timestame.desc(), ArchivedPost.id.desc())
+        self.assertSearches(user_archive(self.u1).order_by(*newest_first).limit(3),
+                            'post_archive', 'ix_post_archive_user_id_timestame_id (user_id=?)')
+        self.assertSearches(home_archive(self.u1).order_by(*newest_first).limit(3),
+                            'post_archive', 'ix_post_archive_user_id_timestame_id (user_id=?)')
+        plan = self.plan(explore_archive().order_by(*newest_first).limit(3))
+        self.assertTrue(any(step.startswith('SCAN post_archive USING') and
+                            'INDEX ix_post_archive_timestame_id' in step for step in plan), plan)
+
+    def test_suggestions(self):
+        self.assertSearches(self.u1.suggestions(), 'suggestion', 'ix_suggestion_user_id_score (user_id=?)')
+
+    def test_duplicate_follow(self):
+        self.u1.follow(self.u2)
+        db.session.commit()
+        with self.assertRaises(IntegrityError):
+            db.session.execute(followers.insert().values(follower_id=self.u1.id, followed_id=self.u2.id))
+        db.session.rollback()
+
+
+class LoggingCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(TestConfig)
+        self.app.config.update(LOG_FILE=os.path.join(self.directory, 'logs', 'microblog.log'),
+                               LOG_MAX_BYTES=2000, LOG_BACKUP_COUNT=2, LOG_RATE_LIMIT=0)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.pipeline = LogPipeline()
+        self.pipeline.app = self.app
+
+    def tearDown(self):
+        self.pipeline.stop()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def record(self, msg, level=logging.ERROR, lineno=1):
+        return logging.LogRecord('app', level, 'app/routes.py', lineno, msg, None, None)
+
+    def lines(self):
+        with open(self.app.config['LOG_FILE']) as f:
+            return [json.loads(line) for line in f]
+
+    def test_rate_limit(self):
+        limit = RateLimitFilter(rate=2, per=60)
+        results = [limit.filter(self.record('boom')) for _ in range(5)]
+        self.assertEqual(results, [True, True, False, False, False])
+        # another line, or another message, has a window of its own
+        self.assertTrue(limit.filter(self.record('boom', lineno=2)))
+        self.assertTrue(limit.filter(self.record('bang')))
+        self.assertEqual(limit.suppressed, 3)
+        # once the window is over, the first record says how many were dropped
+        limit.per = 0
+        record = self.record('boom')
+        self.assertTrue(limit.filter(record))
+        self.assertEqual(record.suppressed, 3)
+        self.assertEqual(record.getMessage(), 'boom (3 similar messages suppressed)')
+
+    def test_sampling(self):
+        limit = RateLimitFilter(rate=0, per=60, sample_rate=0.0)
+        self.assertFalse(limit.filter(self.record('hello', level=logging.INFO)))
+        self.assertTrue(limit.filter(self.record('oops', level=logging.WARNING)))
+        self.assertEqual(limit.sampled_out, 1)
+
+    def test_json_formatter(self):
+        record = self.record('hello %s')
+        record.args = ('world',)
+        record.request_id = 'abc123'
+        record.created = 0
+        line = json.loads(JSONFormatter().format(record))
+        self.assertEqual(line, {'time': '1970-01-01T00:00:00Z', 'level': 'ERROR', 'logger': 'app',
+                                'message': 'hello world', 'location': 'app/routes.py:1',
+                                'request_id': 'abc123'})
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            record = self.record('failed')
+            record.exc_info = sys.exc_info()
+        line = json.loads(JSONFormatter().format(record))
+        self.assertNotIn('request_id', line)
+        self.assertIn('ZeroDivisionError', line['exception'])
+
+    def test_pipeline(self):
+        self.pipeline.start()
+        self.app.logger.setLevel(logging.INFO)
+        with self.app.test_request_context('/explore', headers={'X-Request-ID': 'abc123'}):
+            self.app.preprocess_request()
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                self.app.logger.exception('failed %s', 'here')
+        self.pipeline.stop()
+        line, = [line for line in self.lines() if line['message'] == 'failed here']
+        self.assertEqual((line['level'], line['request_id'], line['path']), ('ERROR', 'abc123', '/explore'))
+        self.assertIn('ZeroDivisionError', line['exception'])
+
+    def test_rotation(self):
+        self.pipeline.start()
+        self.app.logger.setLevel(logging.INFO)
+        for i in range(100):
+            self.app.logger.info('message number %d', i)
+        self.pipeline.stop()
+        files = sorted(os.listdir(os.path.dirname(self.app.config['LOG_FILE'])))
+        self.assertEqual(files, ['microblog.log', 'microblog.log.1', 'microblog.log.2'])
+        self.assertEqual(self.lines()[-1]['message'], 'message number 99')
+
+    def test_full_queue(self):
+        self.app.config['LOG_QUEUE_SIZE'] = 1
+        self.pipeline.start()
+        # with the listener stopped nothing takes records off the queue, logging must still return straight away
+        self.pipeline.listener.stop()
+        for i in range(3):
+            self.app.logger.warning('warning %d', i)
+        self.assertEqual(self.pipeline.stats()['dropped'], 2)
+        self.pipeline.listener.start()
+
+    def test_request_id(self):
+        client = self.app.test_client()
+        response = client.get('/login', headers={'X-Request-ID': 'from-proxy'})
+        self.assertEqual(response.headers['X-Request-ID'], 'from-proxy')
+        self.assertEqual(len(client.get('/login').headers['X-Request-ID']), 32)
+
+
+class AvatarCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(TestConfig)
+        self.app.config['AVATAR_CACHE_DIR'] = os.path.join(self.directory, 'avatars')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.digest = User.email_digest('john@example.com')
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def test_identicon(self):
+        image = identicon(self.digest, 70)
+        self.assertTrue(image.startswith(b'\x89PNG\r\n\x1a\n'))
+        # width and height in the IHDR chunk
+        self.assertEqual(image[16:24], (70).to_bytes(4, 'big') * 2)
+        self.assertEqual(image, identicon(self.digest, 70))
+        self.assertNotEqual(image, identicon(User.email_digest('susan@example.com'), 70))
+        for row in identicon_cells(self.digest):
+            self.assertEqual(row, row[::-1])
+
+    def test_served_and_cached(self):
+        client = self.app.test_client()
+        url = '/avatar/{}/70.png?v=1'.format(self.digest)
+        misses = avatar_cache.misses
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response.data, identicon(self.digest, 70))
+        self.assertEqual(os.listdir(self.app.config['AVATAR_CACHE_DIR']),
+                         ['{}-70-v1.png'.format(self.digest)])
+        # the second time the file is sent as it is
+        self.assertEqual(client.get(url).data, response.data)
+        self.assertEqual(avatar_cache.misses, misses + 1)
+
+    def test_bad_requests(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/avatar/{}/71.png'.format(self.digest)).status_code, 404)
+        self.assertEqual(client.get('/avatar/{}/70.png'.format('x' * 32)).status_code, 404)
+        self.assertEqual(client.get('/avatar/abc/70.png').status_code, 404)
+
+
+class PopupCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user_cache.clear()
+        popup_cache.clear()
+        self.users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i),
+                           about_me='about user{}'.format(i)) for i in range(10)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        for user in self.users[1:]:
+            user.follow(self.users[0])
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(self.users[1].id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_queries(self, url):
+        'the JSON of url and the number of SQL statements it ran'
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            response = self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(response.status_code, 200)
+        return response, len(statements)
+
+    def test_batch(self):
+        url = '/popups?' + '&'.join('username=user{}'.format(i) for i in range(10)) + \
+            '&username=user0&username=nobody'
+        response, queries = self.count_queries(url)
+        popups = response.get_json()['popups']
+        self.assertEqual(sorted(popups), sorted('user{}'.format(i) for i in range(10)))
+        self.assertIn('9 followers', popups['user0'])
+        self.assertIn('about user3', popups['user3'])
+        self.assertEqual(response.headers['Cache-Control'], 'private, max-age=30')
+        # loading the logged in user and then all ten cards at once, whatever the number of users
+        self.assertLessEqual(queries, 2)
+        # the second time the cards come from the cache, only the unknown name is looked up again
+        response, queries = self.count_queries(url)
+        self.assertEqual(response.get_json()['popups'], popups)
+        self.assertLessEqual(queries, 1)
+
+    def test_batch_size(self):
+        self.app.config['POPUP_BATCH_SIZE'] = 3
+        self.assertEqual(self.client.get('/popups?username=a&username=b&username=c&username=d').status_code, 400)
+        self.assertEqual(self.client.get('/popups').get_json(), {'popups': {}})
+
+    def test_single(self):
+        response = self.client.get('/user/user0/popup')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('about user0', response.get_data(as_text=True))
+
+
+class TemplateCacheCase(unittest.TestCase):
+    'compiled templates are shared between workers through TEMPLATE_CACHE_DIR, every new application here stands for a new worker'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_app(self, warm_up=False):
+        app = create_app(TestConfig)
+        app.config['TEMPLATE_CACHE'] = 'filesystem'
+        app.config['TEMPLATE_CACHE_DIR'] = os.path.join(self.directory, 'templates')
+        app.config['TEMPLATE_WARMUP'] = warm_up
+        template_cache.init_app(app)
+        return app
+
+    def test_shared(self):
+        app = self.make_app()
+        self.assertEqual(app.test_client().get('/login').status_code, 200)
+        written = template_cache.stats(app)['writes']
+        # login.html, base.html and the templates of Flask-Bootstrap they use
+        self.assertGreaterEqual(written, 3)
+        files = os.listdir(app.config['TEMPLATE_CACHE_DIR'])
+        self.assertEqual(len(files), written)
+        self.assertFalse([name for name in files if name.startswith('.tmp')])
+        # the next worker loads them instead of compiling them again
+        app = self.make_app()
+        self.assertEqual(app.test_client().get('/login').status_code, 200)
+        self.assertEqual(template_cache.stats(app), {'loads': written, 'writes': 0})
+
+    def test_warm_up(self):
+        app = self.make_app(warm_up=True)
+        names = app.jinja_env.list_templates()
+        self.assertIn('_post.html', names)
+        self.assertEqual(template_cache.stats(app), {'loads': 0, 'writes': len(names)})
+        # the first request finds every template loaded already
+        self.assertEqual(app.test_client().get('/login').status_code, 200)
+        self.assertEqual(template_cache.stats(app)['writes'], len(names))
+        app = self.make_app(warm_up=True)
+        self.assertEqual(template_cache.stats(app), {'loads': len(names), 'writes': 0})
+
+    def test_off(self):
+        app = create_app(TestConfig)
+        self.assertIsNone(app.jinja_env.bytecode_cache)
+        self.assertIsNone(template_cache.stats(app))
+
+    def test_cli(self):
+        app = self.make_app()
+        result = app.test_cli_runner().invoke(args=['templates', 'compile'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Compiled {} templates'.format(len(app.jinja_env.list_templates())), result.output)
+        self.assertTrue(os.listdir(app.config['TEMPLATE_CACHE_DIR']))
+
+
+class SinkHandler(object):
+    'aiosmtpd handler that keeps every message it receives'
+
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return '250 OK'
+
+def unused_port():
+    'a socket bound to a port of 127.0.0.1 that nothing else has, which refuses connections until it is closed'
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+class MailTestConfig(TestConfig):
+    # the messages go to the aiosmtpd server started by the tests, on a port set by MailQueueCase, Flask-Mail would not send anything in testing mode otherwise
+    MAIL_SERVER = '127.0.0.1'
+    MAIL_SUPPRESS_SEND = False
+    MAIL_RETRY_BACKOFF = 0
+    SERVER_NAME = 'localhost'
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+class MailQueueCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = SinkHandler()
+        # the controller checks the server is up by connecting to the port it was given, so it needs an actual port rather than 0
+        sock = unused_port()
+        port = sock.getsockname()[1]
+        sock.close()
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.controller.start()
+        self.app = create_app(MailTestConfig)
+        self.app.config['MAIL_PORT'] = port
+        # Flask-Mail reads its settings when it is initialised
+        mail.init_app(self.app)
+        self.queue = MailQueue()
+        self.queue.init_app(self.app)
+
+    def tearDown(self):
+        self.queue.stop()
+        self.controller.stop()
+
+    def test_send_batch(self):
+        for i in range(3):
+            self.assertTrue(self.queue.submit(Message(
+                'hello {}'.format(i), sender='no-reply@example.com',
+                recipients=['john@example.com'], body='hello')))
+        self.queue.join()
+        self.assertEqual(self.queue.sent, 3)
+        self.assertEqual(len(self.handler.envelopes), 3)
+
+    def test_password_reset_email(self):
+        u = User(id=1, username='john', email='john@example.com')
+        with self.app.app_context():
+            send_password_reset_email(u)
+        mail_queue.join()
+        self.assertEqual(len(self.handler.envelopes), 1)
+        self.assertIn(b'/reset_password/', self.handler.envelopes[0].content)
+
+    def test_retry_gives_up(self):
+        # the port is bound without listening, so the connection is refused
+        sock = unused_port()
+        self.addCleanup(sock.close)
+        self.app.config.update(MAIL_PORT=sock.getsockname()[1], MAIL_MAX_RETRIES=1)
+        mail.init_app(self.app)
+        self.queue.submit(Message('hello', sender='no-reply@example.com',
+                                  recipients=['john@example.com'], body='hello'))
+        self.queue.join()
+        self.assertEqual((self.queue.sent, self.queue.failed), (0, 1))
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)